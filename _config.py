@@ -1,16 +1,16 @@
-import plugins.app_open_commands
-import plugins.webbrowser_commands
-import plugins.clipboard_commands
-import plugins.aws_utility_commands
-import plugins.hyperpod_commands
+import plugins.perf_commands
 
 class Config:
+
+    # Plugins given as "module.Class" strings are imported on first use of their commands.
+    # Plugins given as classes are imported at startup.
     plugins = [
-        plugins.app_open_commands.AppOpenCommands,
-        plugins.webbrowser_commands.WebBrowserCommands,
-        plugins.clipboard_commands.ClipboardCommands,
-        plugins.aws_utility_commands.AwsUtilityCommands,
-        plugins.hyperpod_commands.HyperPodCommands,
+        "plugins.app_open_commands.AppOpenCommands",
+        "plugins.webbrowser_commands.WebBrowserCommands",
+        "plugins.clipboard_commands.ClipboardCommands",
+        "plugins.aws_utility_commands.AwsUtilityCommands",
+        "plugins.hyperpod_commands.HyperPodCommands",
+        plugins.perf_commands.PerfCommands,
     ]
 
 
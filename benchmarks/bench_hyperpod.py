@@ -0,0 +1,224 @@
+import os
+import sys
+import io
+import time
+import json
+import atexit
+import shutil
+import argparse
+import platform
+import tempfile
+import contextlib
+import statistics
+import subprocess
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from fake_aws import FakeAwsState, FakeAwsServer
+
+
+# Benchmarks of HyperPod hot paths against an in-process fake of the SageMaker and
+# CloudWatch Logs APIs, at several cluster sizes. Results are written as JSON, so
+# they can be compared across commits.
+#
+#   python benchmarks/bench_hyperpod.py --sizes 10,100,1000,5000 --output results.json
+
+
+def get_git_commit():
+    try:
+        result = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)), stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        return result.stdout.decode("utf-8").strip() or None
+    except FileNotFoundError:
+        return None
+
+
+class BenchmarkContext:
+
+    def __init__(self, app, state, cluster_name):
+
+        from plugins.hyperpod_misc import list_cluster_nodes_all
+
+        self.app = app
+        self.state = state
+        self.cluster_name = cluster_name
+        self.log_group = state.clusters[cluster_name]["log_group"]
+
+        self.hyperpod = app.get_plugin("plugins.hyperpod_commands.HyperPodCommands")
+        self.sagemaker_client = self.hyperpod.get_sagemaker_client()
+        self.cluster = self.sagemaker_client.describe_cluster(ClusterName=cluster_name)
+        self.nodes = list_cluster_nodes_all(self.sagemaker_client, cluster_name)
+
+    def run_command(self, line):
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.app.onecmd_plus_hooks(line)
+
+
+def bench_list_cluster_nodes_all(ctx):
+    from plugins.hyperpod_misc import list_cluster_nodes_all
+    list_cluster_nodes_all(ctx.sagemaker_client, ctx.cluster_name)
+
+def bench_hostnames_resolve(ctx):
+    from plugins.hyperpod_misc import Hostnames
+    Hostnames._instance = None
+    Hostnames.instance().resolve(ctx.sagemaker_client, ctx.cluster, ctx.nodes)
+
+def bench_choices_node_ids(ctx):
+    from plugins.hyperpod_misc import Hostnames
+    Hostnames._instance = None
+    ctx.hyperpod.cached_node_id_choices = {}
+    ctx.hyperpod.choices_node_ids({ "cluster_name" : [ctx.cluster_name] }, with_cwlog=True)
+
+def bench_describe(ctx):
+    from plugins.hyperpod_misc import Hostnames
+    Hostnames._instance = None
+    ctx.run_command(f"hyperpod describe {ctx.cluster_name}")
+
+def bench_describe_summary(ctx):
+    ctx.run_command(f"hyperpod describe {ctx.cluster_name} --summary")
+
+def bench_wait_tick(ctx):
+    # the cluster is settled, so a wait is a single status check
+    ctx.run_command(f"hyperpod wait {ctx.cluster_name}")
+
+def bench_print_log(ctx):
+    from plugins.hyperpod_commands import print_log
+    from plugins.aws_misc import get_boto3_client
+    node = ctx.nodes[-1]
+    stream = f"LifecycleConfig/{node['InstanceGroupName']}/{node['InstanceId']}"
+    with contextlib.redirect_stdout(io.StringIO()):
+        print_log(get_boto3_client("logs"), ctx.log_group, stream)
+
+
+benchmarks = {
+    "list_cluster_nodes_all" : bench_list_cluster_nodes_all,
+    "hostnames_resolve" : bench_hostnames_resolve,
+    "choices_node_ids" : bench_choices_node_ids,
+    "describe" : bench_describe,
+    "describe_summary" : bench_describe_summary,
+    "wait_tick" : bench_wait_tick,
+    "print_log" : bench_print_log,
+}
+
+
+def main():
+
+    argparser = argparse.ArgumentParser(description="Benchmark HyperPod hot paths against a local fake of SageMaker and CloudWatch Logs")
+    argparser.add_argument("--sizes", action="store", default="10,100,1000,5000", help="Comma separated cluster sizes (number of nodes)")
+    argparser.add_argument("--benchmarks", action="store", default=",".join(benchmarks.keys()), help="Comma separated benchmark names")
+    argparser.add_argument("--repeat", action="store", type=int, default=3, help="Number of measured runs per benchmark and size")
+    argparser.add_argument("--latency", action="store", type=float, default=0.0, help="Server side latency of each API call in milliseconds")
+    argparser.add_argument("--server-max-rps", action="store", type=float, default=0.0, help="Requests per second per API before the fake server throttles (0 for no throttling)")
+    argparser.add_argument("--client-max-rps", action="store", type=float, default=None, help="Client side rate limit per API (api_max_rps settable, 0 to disable, default: as shipped)")
+    argparser.add_argument("--log-events", action="store", type=int, default=1000, help="Number of log events per log stream")
+    argparser.add_argument("--output", action="store", default=None, help="JSON output file (default: stdout)")
+    args = argparser.parse_args()
+
+    sizes = [ int(size) for size in args.sizes.split(",") ]
+    names = args.benchmarks.split(",")
+    for name in names:
+        if name not in benchmarks:
+            argparser.error(f"Unknown benchmark [{name}]. Choose from {', '.join(benchmarks.keys())}")
+
+    state = FakeAwsState(latency=args.latency / 1000, max_rps=args.server_max_rps, log_events_per_stream=args.log_events)
+    for size in sizes:
+        state.add_cluster(f"bench-{size}", size)
+
+    server = FakeAwsServer(state)
+    server.start()
+
+    # isolated home directory and credentials, all AWS endpoints pointing to the fake server
+    home_dir = tempfile.mkdtemp(prefix="cshell_bench_")
+    atexit.register(shutil.rmtree, home_dir, ignore_errors=True)
+    os.environ["HOME"] = home_dir
+    os.environ["AWS_ACCESS_KEY_ID"] = "fake"
+    os.environ["AWS_SECRET_ACCESS_KEY"] = "fake"
+    os.environ["AWS_REGION"] = "us-west-2"
+    os.environ["AWS_DEFAULT_REGION"] = "us-west-2"
+    os.environ["AWS_ENDPOINT_URL"] = server.endpoint_url
+    os.environ["AWS_EC2_METADATA_DISABLED"] = "true"
+    os.environ.pop("AWS_PROFILE", None)
+    os.environ.pop("HYPERPOD_ENDPOINT", None)
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        import main as cshell_main
+        app = cshell_main.CraftShellApp()
+        app.load_all_plugins()
+    app.stdout = io.StringIO()
+
+    from plugins.aws_misc import ApiCallLimiter, ApiCallMemo
+    if args.client_max_rps is None:
+        args.client_max_rps = ApiCallLimiter.instance().max_rps
+    ApiCallLimiter.instance().max_rps = args.client_max_rps
+
+    results = []
+
+    for size in sizes:
+
+        ctx = BenchmarkContext(app, state, f"bench-{size}")
+        ApiCallMemo.instance().end_command()
+
+        for name in names:
+
+            # warm up once, then measure
+            benchmarks[name](ctx)
+            ApiCallMemo.instance().end_command()
+
+            seconds = []
+            api_calls = []
+            throttles = []
+            for i in range(args.repeat):
+
+                state.reset_counters()
+                app.stdout = io.StringIO()
+
+                t0 = time.perf_counter()
+                benchmarks[name](ctx)
+                seconds.append(time.perf_counter() - t0)
+
+                ApiCallMemo.instance().end_command()
+
+                api_calls.append(state.get_num_calls())
+                throttles.append(state.throttles)
+
+            result = {
+                "name" : name,
+                "nodes" : size,
+                "repeat" : args.repeat,
+                "seconds" : {
+                    "min" : round(min(seconds), 6),
+                    "median" : round(statistics.median(seconds), 6),
+                    "max" : round(max(seconds), 6),
+                },
+                "api_calls" : max(api_calls),
+                "throttles" : max(throttles),
+            }
+            results.append(result)
+
+            print(f"{name:<24} {size:>6} nodes : {result['seconds']['median']*1000:>10.1f} ms median : {result['api_calls']:>6} API calls : {result['throttles']:>5} throttles", file=sys.stderr)
+
+    server.stop()
+
+    output = {
+        "time" : time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "commit" : get_git_commit(),
+        "python" : platform.python_version(),
+        "platform" : platform.platform(),
+        "config" : {
+            "latency_ms" : args.latency,
+            "server_max_rps" : args.server_max_rps,
+            "client_max_rps" : args.client_max_rps,
+            "log_events" : args.log_events,
+            "page_size" : state.page_size,
+        },
+        "results" : results,
+    }
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(output, f, indent=2)
+    else:
+        print(json.dumps(output, indent=2))
+
+
+if __name__ == "__main__":
+    main()
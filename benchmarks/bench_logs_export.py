@@ -0,0 +1,187 @@
+import os
+import io
+import sys
+import json
+import time
+import gzip
+import shutil
+import argparse
+import platform
+import resource
+import tempfile
+import contextlib
+import statistics
+import multiprocessing
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from gen_log_corpus import generate_corpus
+from bench_hyperpod import get_git_commit
+
+
+# Throughput benchmark of the local stages of LogsExporter, on a synthetic CloudWatch
+# Logs export tree. Each stage runs in a fresh process, so that peak RSS is per stage.
+#
+#   python benchmarks/bench_logs_export.py --size-mb 200 --streams 64 --output results.json
+
+
+def get_dir_size(dirname):
+    size = 0
+    for place, dirs, files in os.walk(dirname):
+        for filename in files:
+            size += os.path.getsize(os.path.join(place, filename))
+    return size
+
+
+def get_uncompressed_size(dirname):
+    size = 0
+    for place, dirs, files in os.walk(dirname):
+        for filename in files:
+            if filename.endswith(".gz"):
+                with gzip.open(os.path.join(place, filename)) as fd:
+                    while True:
+                        d = fd.read(1024 * 1024)
+                        if not d:
+                            break
+                        size += len(d)
+    return size
+
+
+def get_max_rss():
+    # ru_maxrss is in KB on Linux and in bytes on macOS
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform != "darwin":
+        max_rss *= 1024
+    return max_rss
+
+
+def run_stage(stage, src, dst, queue):
+
+    from plugins.aws_misc import LogsExporter
+
+    exporter = LogsExporter(None, None, None, None, None)
+    baseline_rss = get_max_rss()
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        t0 = time.perf_counter()
+        if stage == "normalize":
+            exporter.convertToPlainTextAndNormalize(src, dst)
+        elif stage == "zip":
+            exporter.createZipFile(src, dst)
+        seconds = time.perf_counter() - t0
+
+    queue.put({
+        "seconds" : seconds,
+        "baseline_rss" : baseline_rss,
+        "peak_rss" : get_max_rss(),
+    })
+
+
+def measure_stage(stage, src, dst):
+
+    ctx = multiprocessing.get_context("spawn")
+    queue = ctx.Queue()
+    process = ctx.Process(target=run_stage, args=(stage, src, dst, queue))
+    process.start()
+    result = queue.get()
+    process.join()
+
+    if stage == "zip":
+        result["output_bytes"] = os.path.getsize(dst + ".zip")
+    else:
+        result["output_bytes"] = get_dir_size(dst)
+
+    return result
+
+
+def main():
+
+    argparser = argparse.ArgumentParser(description="Benchmark LogsExporter stages on a synthetic CloudWatch Logs export tree")
+    argparser.add_argument("--corpus", action="store", default=None, help="Existing export tree to use instead of generating one")
+    argparser.add_argument("--size-mb", action="store", type=float, default=100.0, help="Total uncompressed size of the generated corpus in MB")
+    argparser.add_argument("--streams", action="store", type=int, default=16, help="Number of log streams in the generated corpus")
+    argparser.add_argument("--seed", action="store", type=int, default=0, help="Random seed of the generated corpus")
+    argparser.add_argument("--repeat", action="store", type=int, default=3, help="Number of measured runs per stage")
+    argparser.add_argument("--work-dir", action="store", default=None, help="Directory for the corpus and stage outputs (default: a temporary directory)")
+    argparser.add_argument("--output", action="store", default=None, help="JSON output file (default: stdout)")
+    args = argparser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix="cshell_bench_logs_", dir=args.work_dir)
+
+    try:
+        if args.corpus:
+            corpus_dir = args.corpus
+            corpus = {
+                "uncompressed_bytes" : get_uncompressed_size(corpus_dir),
+                "compressed_bytes" : get_dir_size(corpus_dir),
+            }
+        else:
+            corpus_dir = os.path.join(work_dir, "corpus")
+            print(f"Generating {args.size_mb:.0f} MB corpus with {args.streams} streams", file=sys.stderr)
+            corpus = generate_corpus(corpus_dir, size_mb=args.size_mb, num_streams=args.streams, seed=args.seed)
+
+        plaintext_dir = os.path.join(work_dir, "plaintext")
+        zip_filename_wo_ext = os.path.join(work_dir, "exported_logs")
+
+        # throughput is measured on the uncompressed log size each stage processes
+        stages = [
+            ("normalize", corpus_dir, plaintext_dir, corpus["uncompressed_bytes"]),
+            ("zip", plaintext_dir, zip_filename_wo_ext, None),
+        ]
+
+        results = []
+
+        for stage, src, dst, input_bytes in stages:
+
+            if input_bytes is None:
+                input_bytes = get_dir_size(src)
+
+            runs = []
+            for i in range(args.repeat):
+                if stage == "normalize":
+                    shutil.rmtree(dst, ignore_errors=True)
+                    os.makedirs(dst)
+                runs.append(measure_stage(stage, src, dst))
+
+            seconds = [ run["seconds"] for run in runs ]
+            median_seconds = statistics.median(seconds)
+
+            result = {
+                "stage" : stage,
+                "repeat" : args.repeat,
+                "input_bytes" : input_bytes,
+                "seconds" : {
+                    "min" : round(min(seconds), 6),
+                    "median" : round(median_seconds, 6),
+                    "max" : round(max(seconds), 6),
+                },
+                "mb_per_sec" : round(input_bytes / median_seconds / (1024 * 1024), 2),
+                "peak_rss_mb" : round(max( run["peak_rss"] for run in runs ) / (1024 * 1024), 1),
+                "rss_increase_mb" : round(max( run["peak_rss"] - run["baseline_rss"] for run in runs ) / (1024 * 1024), 1),
+                "disk_mb" : round(runs[-1]["output_bytes"] / (1024 * 1024), 1),
+            }
+            results.append(result)
+
+            print(f"{stage:<10} : {result['mb_per_sec']:>8.1f} MB/s : {result['seconds']['median']:>8.2f} s median : {result['peak_rss_mb']:>8.1f} MB peak RSS (+{result['rss_increase_mb']:.1f}) : {result['disk_mb']:>8.1f} MB on disk", file=sys.stderr)
+
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    output = {
+        "time" : time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "commit" : get_git_commit(),
+        "python" : platform.python_version(),
+        "platform" : platform.platform(),
+        "corpus" : corpus,
+        "results" : results,
+    }
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(output, f, indent=2)
+    else:
+        print(json.dumps(output, indent=2))
+
+
+if __name__ == "__main__":
+    main()
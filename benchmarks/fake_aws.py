@@ -0,0 +1,230 @@
+import json
+import time
+import threading
+import http.server
+
+
+# In-process stand-in for the SageMaker (HyperPod) and CloudWatch Logs JSON APIs.
+# Clients reach it through real botocore (endpoint_url / AWS_ENDPOINT_URL), so
+# retries, throttling handling and the shell's API call layers are all exercised.
+
+class FakeAwsState:
+
+    def __init__(self, latency=0.0, max_rps=0.0, page_size=100, log_events_per_stream=1000):
+
+        self.latency = latency
+        self.max_rps = max_rps
+        self.page_size = page_size
+        self.log_events_per_stream = log_events_per_stream
+
+        self.lock = threading.Lock()
+        self.clusters = {}
+        self.calls = {}
+        self.throttles = 0
+        self.buckets = {}
+
+    def add_cluster(self, cluster_name, num_nodes, instance_groups=("controller", "worker")):
+
+        cluster_id = f"{cluster_name}id"[:12]
+        launch_time = time.time() - 24 * 60 * 60
+
+        nodes = []
+        for i in range(num_nodes):
+            instance_group_name = instance_groups[0] if i == 0 else instance_groups[1 + i % (len(instance_groups) - 1)]
+            nodes.append({
+                "InstanceGroupName" : instance_group_name,
+                "InstanceId" : f"i-{i:017x}",
+                "InstanceStatus" : { "Status" : "Running", "Message" : "" },
+                "InstanceType" : "ml.p5.48xlarge",
+                "LaunchTime" : launch_time + i,
+                "PrivateDnsHostname" : f"ip-10-{i // 65536 % 256}-{i // 256 % 256}-{i % 256}.ec2.internal",
+            })
+
+        instance_group_descriptions = []
+        for instance_group_name in instance_groups:
+            count = len([ node for node in nodes if node["InstanceGroupName"] == instance_group_name ])
+            instance_group_descriptions.append({
+                "InstanceGroupName" : instance_group_name,
+                "InstanceType" : "ml.p5.48xlarge",
+                "Status" : "InService",
+                "CurrentCount" : count,
+                "TargetCount" : count,
+            })
+
+        self.clusters[cluster_name] = {
+            "cluster" : {
+                "ClusterName" : cluster_name,
+                "ClusterArn" : f"arn:aws:sagemaker:us-west-2:123456789012:cluster/{cluster_id}",
+                "ClusterStatus" : "InService",
+                "CreationTime" : launch_time,
+                "InstanceGroups" : instance_group_descriptions,
+                "RestrictedInstanceGroups" : [],
+            },
+            "nodes" : nodes,
+            "log_group" : f"/aws/sagemaker/Clusters/{cluster_name}/{cluster_id}",
+        }
+
+    def reset_counters(self):
+        with self.lock:
+            self.calls = {}
+            self.throttles = 0
+
+    def get_num_calls(self):
+        with self.lock:
+            return sum(self.calls.values())
+
+    def is_throttled(self, operation_name):
+
+        if self.max_rps <= 0:
+            return False
+
+        now = time.monotonic()
+        with self.lock:
+            tokens, last_time = self.buckets.get(operation_name, (self.max_rps, now))
+            tokens = min(self.max_rps, tokens + (now - last_time) * self.max_rps)
+            if tokens < 1.0:
+                self.buckets[operation_name] = (tokens, now)
+                self.throttles += 1
+                return True
+            self.buckets[operation_name] = (tokens - 1.0, now)
+            return False
+
+    def find_cluster(self, cluster_name):
+        if cluster_name not in self.clusters:
+            raise FakeAwsError("ResourceNotFound", f"Cluster {cluster_name} not found")
+        return self.clusters[cluster_name]
+
+    def find_cluster_by_log_group(self, log_group):
+        for cluster in self.clusters.values():
+            if cluster["log_group"] == log_group:
+                return cluster
+        raise FakeAwsError("ResourceNotFoundException", f"Log group {log_group} not found")
+
+    def paginate(self, items, params, token_key="NextToken"):
+        start = int(params.get(token_key) or 0)
+        end = start + self.page_size
+        response = { "items" : items[start:end] }
+        if end < len(items):
+            response[token_key] = str(end)
+        return response
+
+    # SageMaker
+
+    def DescribeCluster(self, params):
+        return self.find_cluster(params["ClusterName"])["cluster"]
+
+    def ListClusters(self, params):
+        summaries = [ { key : cluster["cluster"][key] for key in ["ClusterName", "ClusterArn", "ClusterStatus", "CreationTime"] } for cluster in self.clusters.values() ]
+        return { "ClusterSummaries" : summaries }
+
+    def ListClusterNodes(self, params):
+        nodes = self.find_cluster(params["ClusterName"])["nodes"]
+        summaries = [ { key : value for key, value in node.items() if key != "PrivateDnsHostname" } for node in nodes ]
+        page = self.paginate(summaries, params)
+        page["ClusterNodeSummaries"] = page.pop("items")
+        return page
+
+    def DescribeClusterNode(self, params):
+        for node in self.find_cluster(params["ClusterName"])["nodes"]:
+            if node["InstanceId"] == params["NodeId"]:
+                return { "NodeDetails" : node }
+        raise FakeAwsError("ResourceNotFound", f"Node {params['NodeId']} not found")
+
+    def ListClusterEvents(self, params):
+        self.find_cluster(params["ClusterName"])
+        return { "Events" : [] }
+
+    # CloudWatch Logs
+
+    def DescribeLogStreams(self, params):
+        cluster = self.find_cluster_by_log_group(params["logGroupName"])
+        streams = [ { "logStreamName" : f"LifecycleConfig/{node['InstanceGroupName']}/{node['InstanceId']}" } for node in cluster["nodes"] ]
+        page = self.paginate(streams, params, token_key="nextToken")
+        page["logStreams"] = page.pop("items")
+        return page
+
+    def GetLogEvents(self, params):
+
+        self.find_cluster_by_log_group(params["logGroupName"])
+
+        # 'f/N' tokens, returning the same token at the end as the real API does
+        token = params.get("nextToken") or "f/0"
+        start = int(token.split("/")[1])
+        end = min(start + self.page_size * 10, self.log_events_per_stream)
+
+        base_time = int(time.time() * 1000) - 60 * 60 * 1000
+        events = [ { "timestamp" : base_time + i, "message" : f"[{i}] lifecycle script step {i} completed on {params['logStreamName']}" } for i in range(start, end) ]
+
+        return { "events" : events, "nextForwardToken" : f"f/{end}", "nextBackwardToken" : f"b/{start}" }
+
+
+class FakeAwsError(Exception):
+
+    def __init__(self, code, message):
+        super().__init__(message)
+        self.code = code
+        self.message = message
+
+
+class FakeAwsServer:
+
+    def __init__(self, state):
+
+        self.state = state
+
+        class RequestHandler(http.server.BaseHTTPRequestHandler):
+
+            protocol_version = "HTTP/1.1"
+
+            # headers and body are written separately, don't let Nagle delay the body
+            disable_nagle_algorithm = True
+
+            def do_POST(handler):
+
+                body = handler.rfile.read(int(handler.headers.get("Content-Length", 0)))
+                operation_name = handler.headers.get("X-Amz-Target", "").split(".")[-1]
+
+                with state.lock:
+                    state.calls[operation_name] = state.calls.get(operation_name, 0) + 1
+
+                if state.latency:
+                    time.sleep(state.latency)
+
+                status = 200
+                try:
+                    if state.is_throttled(operation_name):
+                        raise FakeAwsError("ThrottlingException", "Rate exceeded")
+                    operation = getattr(state, operation_name, None)
+                    if operation is None:
+                        raise FakeAwsError("UnknownOperationException", operation_name)
+                    response = operation(json.loads(body or b"{}"))
+                except FakeAwsError as e:
+                    status = 400
+                    response = { "__type" : e.code, "message" : e.message }
+
+                data = json.dumps(response).encode("utf-8")
+
+                handler.send_response(status)
+                handler.send_header("Content-Type", "application/x-amz-json-1.1")
+                handler.send_header("Content-Length", str(len(data)))
+                handler.send_header("x-amzn-RequestId", "00000000-0000-0000-0000-000000000000")
+                handler.end_headers()
+                handler.wfile.write(data)
+
+            def log_message(handler, format, *args):
+                pass
+
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), RequestHandler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def endpoint_url(self):
+        return f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
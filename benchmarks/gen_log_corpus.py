@@ -0,0 +1,148 @@
+import os
+import gzip
+import json
+import random
+import argparse
+import datetime
+
+
+# Generator of synthetic CloudWatch Logs export trees, in the layout LogsExporter
+# downloads them to (one directory per log stream, gzipped chunks in it). Lines carry
+# out-of-order timestamps, multi-line stack traces, blank lines and NUL bytes.
+#
+#   python benchmarks/gen_log_corpus.py ./corpus --size-mb 200 --streams 64
+
+
+messages = [
+    b"Starting lifecycle script on_create.sh",
+    b"Mounting FSx for Lustre file system at /fsx",
+    b"Installing packages: docker enroot pyxis",
+    b"[INFO] Slurm daemon slurmd started with pid %d",
+    b"[INFO] NCCL version 2.18.3+cuda12.1, rank %d of 512",
+    b"[WARNING] GPU %d ECC error count increased",
+    b"[INFO] epoch 3 step %d loss=1.2345 lr=3.0e-4 throughput=1234.5 samples/s",
+    b"health check passed: nvidia-smi, efa, dcgm (%d ms)",
+    b"Connection to 10.1.2.3:%d timed out, retrying",
+    b"kubelet: Successfully pulled image \"public.ecr.aws/neuron/pytorch-training:%d\"",
+]
+
+stack_trace = [
+    b"Traceback (most recent call last):",
+    b"  File \"/opt/ml/code/train.py\", line 412, in <module>",
+    b"    main()",
+    b"  File \"/opt/ml/code/train.py\", line 388, in main",
+    b"    loss = trainer.step(batch)",
+    b"  File \"/usr/lib/python3.10/site-packages/torch/nn/modules/module.py\", line 1501, in _call_impl",
+    b"    return forward_call(*args, **kwargs)",
+    b"RuntimeError: CUDA error: an illegal memory access was encountered",
+]
+
+
+def format_timestamp(t):
+    return datetime.datetime.fromtimestamp(t, datetime.timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3].encode("ascii") + b"Z"
+
+
+def generate_stream_lines(rng, num_bytes, start_time, end_time):
+
+    # yields lines until num_bytes is reached, timestamps mostly increasing with local jitter
+    written = 0
+    t = start_time
+    step = (end_time - start_time) / max(num_bytes // 80, 1)
+
+    while written < num_bytes:
+
+        t += step
+        timestamp = format_timestamp(t + rng.uniform(-30, 30))
+
+        r = rng.random()
+        if r < 0.02:
+            lines = [ timestamp + b" " + stack_trace[0] ] + stack_trace[1:]
+        elif r < 0.03:
+            lines = [ timestamp + b" binary output: \0\x01\x02\0 end", b"" ]
+        else:
+            message = rng.choice(messages)
+            if b"%d" in message:
+                message = message % rng.randrange(100000)
+            lines = [ timestamp + b" " + message ]
+
+        for line in lines:
+            written += len(line) + 1
+            yield line
+
+
+def generate_corpus(dirname, size_mb=100.0, num_streams=16, chunk_mb=1.0, seed=0):
+
+    rng = random.Random(seed)
+
+    total_bytes = int(size_mb * 1024 * 1024)
+    chunk_bytes = int(chunk_mb * 1024 * 1024)
+
+    # skewed stream sizes, some streams are much larger than others
+    weights = [ rng.paretovariate(1.5) for i in range(num_streams) ]
+    weights_sum = sum(weights)
+
+    end_time = datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc).timestamp()
+    start_time = end_time - 24 * 60 * 60
+
+    stats = {
+        "streams" : num_streams,
+        "files" : 0,
+        "lines" : 0,
+        "uncompressed_bytes" : 0,
+        "compressed_bytes" : 0,
+    }
+
+    for i_stream in range(num_streams):
+
+        instance_group = f"worker-group-{i_stream % 4 + 1}"
+        instance_id = "i-%017x" % rng.getrandbits(68)
+        stream_dirname = os.path.join(dirname, "LifecycleConfig", instance_group, instance_id)
+        os.makedirs(stream_dirname, exist_ok=True)
+
+        stream_bytes = max(int(total_bytes * weights[i_stream] / weights_sum), 1)
+
+        # export chunks are not in time order, shuffle the order of chunks in the stream
+        chunks = []
+        chunk = []
+        chunk_size = 0
+        for line in generate_stream_lines(rng, stream_bytes, start_time, end_time):
+            # split only before a timestamped line, so stack traces stay in one file
+            if chunk_size >= chunk_bytes and line[:4].isdigit():
+                chunks.append(chunk)
+                chunk = []
+                chunk_size = 0
+            chunk.append(line)
+            chunk_size += len(line) + 1
+        chunks.append(chunk)
+        rng.shuffle(chunks)
+
+        for i_chunk, chunk in enumerate(chunks):
+            d = b"\n".join(chunk) + b"\n"
+            filename = os.path.join(stream_dirname, "%06d.gz" % i_chunk)
+            with gzip.open(filename, "wb", compresslevel=6) as fd:
+                fd.write(d)
+
+            stats["files"] += 1
+            stats["lines"] += len(chunk)
+            stats["uncompressed_bytes"] += len(d)
+            stats["compressed_bytes"] += os.path.getsize(filename)
+
+    return stats
+
+
+def main():
+
+    argparser = argparse.ArgumentParser(description="Generate a synthetic CloudWatch Logs export tree")
+    argparser.add_argument("dirname", action="store", help="Output directory")
+    argparser.add_argument("--size-mb", action="store", type=float, default=100.0, help="Total uncompressed size in MB")
+    argparser.add_argument("--streams", action="store", type=int, default=16, help="Number of log streams")
+    argparser.add_argument("--chunk-mb", action="store", type=float, default=1.0, help="Uncompressed size of each .gz file in MB")
+    argparser.add_argument("--seed", action="store", type=int, default=0, help="Random seed")
+    args = argparser.parse_args()
+
+    stats = generate_corpus(args.dirname, size_mb=args.size_mb, num_streams=args.streams, chunk_mb=args.chunk_mb, seed=args.seed)
+    print(json.dumps(stats, indent=2))
+
+
+if __name__ == "__main__":
+    main()
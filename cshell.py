@@ -0,0 +1,104 @@
+import os
+import sys
+import socket
+import struct
+import argparse
+
+
+# Thin client of the CraftShell daemon (python3 main.py --daemon). It only uses the
+# standard library, so that scripted invocations start fast. Ctrl-C interrupts the
+# command in the daemon, a second Ctrl-C leaves without waiting.
+#
+#   python3 cshell.py -c "hyperpod describe my-cluster"
+
+FRAME_REQUEST = b"R"
+FRAME_INTERRUPT = b"I"
+FRAME_EXIT = b"X"
+
+frame_header_format = "!cI"
+frame_header_size = struct.calcsize(frame_header_format)
+
+
+def get_socket_path():
+    return os.environ.get("CSHELL_SOCKET", os.path.expanduser("~/.cshell/daemon.sock"))
+
+
+def send_frame(sock, frame_type, payload):
+    sock.sendall(struct.pack(frame_header_format, frame_type, len(payload)) + payload)
+
+
+def recv_exactly(sock, size):
+    chunks = []
+    while size > 0:
+        chunk = sock.recv(min(size, 1024 * 1024))
+        if not chunk:
+            return None
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b"".join(chunks)
+
+
+def recv_frame(sock):
+
+    # returns (None, None) when the connection is closed
+    header = recv_exactly(sock, frame_header_size)
+    if header is None:
+        return None, None
+
+    frame_type, size = struct.unpack(frame_header_format, header)
+    payload = recv_exactly(sock, size)
+    if payload is None:
+        return None, None
+
+    return frame_type, payload
+
+
+def run_command(socket_path, command):
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_path)
+    except (FileNotFoundError, ConnectionRefusedError):
+        print(f"CraftShell daemon is not running at {socket_path}. Start it with 'python3 main.py --daemon'.", file=sys.stderr)
+        return 2
+
+    with sock:
+
+        # working directory and command line, with stdin, stdout and stderr attached, so
+        # that the daemon writes to them directly
+        payload = (os.getcwd() + "\0" + command).encode("utf-8")
+        socket.send_fds(sock, [ struct.pack(frame_header_format, FRAME_REQUEST, len(payload)) + payload ], [0, 1, 2])
+
+        interrupted = False
+        while True:
+            try:
+                frame_type, payload = recv_frame(sock)
+            except KeyboardInterrupt:
+                if interrupted:
+                    raise
+                interrupted = True
+                send_frame(sock, FRAME_INTERRUPT, b"")
+                continue
+
+            if frame_type is None:
+                print("Connection to CraftShell daemon was closed.", file=sys.stderr)
+                return 1
+            elif frame_type == FRAME_EXIT:
+                return struct.unpack("!i", payload)[0]
+
+
+def main():
+
+    argparser = argparse.ArgumentParser(description="Run a command in the CraftShell daemon")
+    argparser.add_argument("-c", "--command", action="store", required=True, help="Command line to run")
+    argparser.add_argument("--socket", action="store", default=get_socket_path(), help="Unix domain socket of the daemon (default: $CSHELL_SOCKET or ~/.cshell/daemon.sock)")
+    args = argparser.parse_args()
+
+    try:
+        sys.exit(run_command(args.socket, args.command))
+    except KeyboardInterrupt:
+        sys.exit(130)
+
+
+if __name__ == "__main__":
+    main()
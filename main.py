@@ -1,5 +1,17 @@
+import sys
+import time
+
+# measure startup from here, and imports too when profiling startup
+from plugins.perf_misc import StartupProfiler
+startup_profiler = StartupProfiler.instance()
+profile_startup = "--profile-startup" in sys.argv
+if profile_startup:
+    startup_profiler.enable_import_timing()
+
 import os
 import shutil
+import signal
+import argparse
 
 from rich.style import Style
 
@@ -7,6 +19,9 @@ import cmd2
 from cmd2 import stylize, Color
 
 import misc
+import cshell
+
+startup_profiler.add_phase("import", time.perf_counter() - startup_profiler.start_time)
 
 
 # .cshell paths
@@ -14,6 +29,7 @@ data_dir = os.path.expanduser("~/.cshell")
 history_file_path = os.path.join(data_dir, "history.dat")
 config_file_path = os.path.join(data_dir, "config.py")
 startup_file_path = os.path.join(data_dir, "startup.csh")
+plugin_manifest_file_path = os.path.join(data_dir, "plugin_manifest.json")
 
 
 # create config.py if it doesn't exist
@@ -27,15 +43,24 @@ if not os.path.exists(startup_file_path):
 
 # load config.py
 user_config = misc.UserConfig.instance()
-user_config.reload(config_file_path)
+with startup_profiler.phase("config reload"):
+    user_config.reload(config_file_path)
 
 Config = user_config.get("Config")
 
+# register plugins, lazily loaded ones from the manifest
+with startup_profiler.phase("plugin registration"):
+    plugin_manifest = misc.PluginManifest.instance()
+    plugin_manifest.load(plugin_manifest_file_path)
+    plugin_classes = misc.get_plugin_classes(Config.plugins)
 
-class CraftShellApp(*Config.plugins, cmd2.Cmd):
+
+class CraftShellApp(*plugin_classes, misc.LazyPluginLoader, cmd2.Cmd):
 
     def __init__(self):
 
+        t0 = time.perf_counter()
+
         super().__init__(
             multiline_commands=["echo"],
             persistent_history_file=history_file_path,
@@ -44,6 +69,8 @@ class CraftShellApp(*Config.plugins, cmd2.Cmd):
             include_ipy=True,
         )
 
+        startup_profiler.add_phase("app init", time.perf_counter() - t0 - startup_profiler.phases.get("history load", 0.0))
+
         #self.intro = stylize("Welcome to CraftShell", style=Style(color=Color.RED, bgcolor=Color.WHITE, bold=True))
         self.prompt = stylize("▶ ", style=Style(color=Color.GREEN, bold=False))
 
@@ -53,7 +80,73 @@ class CraftShellApp(*Config.plugins, cmd2.Cmd):
         # Set the default category name
         self.default_category = "cmd2 Built-in Commands"
 
+        # Apply changes of config.py without restarting
+        self.register_precmd_hook(self.on_command_started)
+
+        self.register_postcmd_hook(self.on_command_finished)
+
+        self.register_preloop_hook(self.on_preloop)
+
+    def _initialize_history(self, hist_file):
+        with startup_profiler.phase("history load"):
+            super()._initialize_history(hist_file)
+
+    def on_preloop(self) -> None:
+
+        # Run the startup script here instead of in cmdloop(), to time it
+        with startup_profiler.phase("startup script"):
+            stop = self.runcmds_plus_hooks(self._startup_commands)
+        self._startup_commands = ["quit"] if stop else []
+
+        startup_profiler.end()
+
+        if profile_startup and self.get_command_func("perf") is not None:
+            self.onecmd("perf startup-report", add_to_history=False)
+
+    def on_command_started(self, data: cmd2.plugin.PrecommandData) -> cmd2.plugin.PrecommandData:
+
+        try:
+            if user_config.reload_if_modified():
+                self.print_to(sys.stderr, f"Reloaded {config_file_path}")
+                if user_config.get("Config").plugins != Config.plugins:
+                    self.pwarning("Changes of Config.plugins take effect after restarting the shell")
+        except Exception as e:
+            self.perror(f"Failed to reload {config_file_path} : {e}")
+
+        return data
+
+    def on_command_finished(self, data: cmd2.plugin.PostcommandData) -> cmd2.plugin.PostcommandData:
+
+        # Drop memoized AWS API results, and roll up hit counts. aws_misc (and boto3) is
+        # imported only when a plugin using AWS is loaded.
+        aws_misc = sys.modules.get("plugins.aws_misc")
+        if aws_misc is not None:
+            aws_misc.ApiCallMemo.instance().end_command()
+
+        return data
+
 
 if __name__ == "__main__":
+
+    argparser = argparse.ArgumentParser(description="CraftShell")
+    argparser.add_argument("--daemon", action="store_true", default=False, help="Keep running and serve commands from 'cshell.py -c' over a Unix domain socket")
+    argparser.add_argument("--socket", action="store", default=cshell.get_socket_path(), help="Unix domain socket of the daemon (default: $CSHELL_SOCKET or ~/.cshell/daemon.sock)")
+    argparser.add_argument("--profile-startup", action="store_true", default=False, help="Time imports and startup phases, and show 'perf startup-report' before the first prompt")
+    args, remaining_args = argparser.parse_known_args()
+
+    # other arguments are commands for cmd2
+    sys.argv = sys.argv[:1] + remaining_args
+
     app = CraftShellApp()
-    app.cmdloop()
+
+    if args.daemon:
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        try:
+            misc.ShellDaemon(app, args.socket).serve_forever()
+        except KeyboardInterrupt:
+            pass
+        except RuntimeError as e:
+            print(e, file=sys.stderr)
+            sys.exit(1)
+    else:
+        app.cmdloop()
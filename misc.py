@@ -1,4 +1,23 @@
 import os
+import sys
+import json
+import queue
+import select
+import signal
+import socket
+import struct
+import threading
+import contextlib
+import socketserver
+import marshal
+import hashlib
+import importlib
+import importlib.util
+
+import cmd2
+from cmd2 import constants
+
+import cshell
 
 class UserConfig:
 
@@ -12,13 +31,96 @@ class UserConfig:
 
     def __init__(self):
         self.user_namespace = {}
+        self.filename = None
+        self.file_stat = None
+        self.reload_listeners = []
+
+    @staticmethod
+    def get_code_cache_filename(filename):
+        return os.path.join(os.path.dirname(filename), "__pycache__", os.path.basename(filename) + ".marshal")
+
+    @staticmethod
+    def load_code(filename, file_stat):
+
+        # Compiled code is cached next to the config file, keyed by mtime and size of
+        # the source, and by its hash when only mtime changed
+        cache_filename = UserConfig.get_code_cache_filename(filename)
+        header_format = "<4sQQ32s"
+        header_size = struct.calcsize(header_format)
+
+        try:
+            with open(cache_filename, "rb") as fd:
+                cached = fd.read()
+            magic, mtime_ns, size, source_hash = struct.unpack(header_format, cached[:header_size])
+        except (OSError, struct.error):
+            magic = None
+
+        if magic == importlib.util.MAGIC_NUMBER and (mtime_ns, size) == file_stat:
+            try:
+                return marshal.loads(cached[header_size:])
+            except (EOFError, ValueError, TypeError):
+                magic = None
+
+        with open(filename, "rb") as fd:
+            fileimage = fd.read()
+
+        if magic == importlib.util.MAGIC_NUMBER and source_hash == hashlib.sha256(fileimage).digest():
+            try:
+                code = marshal.loads(cached[header_size:])
+            except (EOFError, ValueError, TypeError):
+                code = None
+        else:
+            code = None
+
+        if code is None:
+            code = compile(fileimage, os.path.basename(filename), 'exec')
+
+        try:
+            os.makedirs(os.path.dirname(cache_filename), exist_ok=True)
+            tmp_filename = cache_filename + ".tmp"
+            with open(tmp_filename, "wb") as fd:
+                fd.write(struct.pack(header_format, importlib.util.MAGIC_NUMBER, *file_stat, hashlib.sha256(fileimage).digest()))
+                fd.write(marshal.dumps(code))
+            os.replace(tmp_filename, cache_filename)
+        except OSError:
+            pass
+
+        return code
 
     def reload(self, filename):
-        fd = open(filename, 'rb')
-        fileimage = fd.read()
-        self.user_namespace = {}
-        code = compile(fileimage, os.path.basename(filename), 'exec')
-        exec(code, self.user_namespace, self.user_namespace)
+
+        st = os.stat(filename)
+        self.filename = filename
+        self.file_stat = (st.st_mtime_ns, st.st_size)
+
+        code = self.load_code(filename, self.file_stat)
+
+        # keep the current namespace if the config fails
+        user_namespace = {}
+        exec(code, user_namespace, user_namespace)
+        self.user_namespace = user_namespace
+
+        for listener in self.reload_listeners:
+            listener(self)
+
+    def reload_if_modified(self):
+
+        if self.filename is None:
+            return False
+
+        try:
+            st = os.stat(self.filename)
+        except OSError:
+            return False
+
+        if (st.st_mtime_ns, st.st_size) == self.file_stat:
+            return False
+
+        self.reload(self.filename)
+        return True
+
+    def add_reload_listener(self, listener):
+        self.reload_listeners.append(listener)
 
     def get(self, symbol_name, default=None):
         try:
@@ -27,3 +129,517 @@ class UserConfig:
             if default is None:
                 raise
             return default
+
+
+class PluginManifest:
+
+    # Command names, categories and descriptions of plugins, cached so that plugins can
+    # be registered without importing them. An entry is rebuilt when any .py file next
+    # to the plugin module changes.
+
+    _instance = None
+
+    @staticmethod
+    def instance():
+        if PluginManifest._instance is None:
+            PluginManifest._instance = PluginManifest()
+        return PluginManifest._instance
+
+    def __init__(self):
+        self.filename = None
+        self.entries = {}
+        self.modified = False
+
+    def load(self, filename):
+
+        self.filename = filename
+        self.entries = {}
+        self.modified = False
+
+        try:
+            with open(filename) as fd:
+                self.entries = json.load(fd)
+        except (OSError, ValueError):
+            pass
+
+    def save(self):
+
+        if not self.modified or self.filename is None:
+            return
+
+        tmp_filename = self.filename + ".tmp"
+        with open(tmp_filename, "w") as fd:
+            json.dump(self.entries, fd, indent=2)
+        os.replace(tmp_filename, self.filename)
+
+        self.modified = False
+
+    @staticmethod
+    def get_fingerprint(module_name):
+
+        spec = importlib.util.find_spec(module_name)
+        if spec is None or spec.origin is None:
+            raise ImportError(f"Plugin module not found [{module_name}]")
+
+        dirname = os.path.dirname(spec.origin)
+
+        fingerprint = []
+        for filename in sorted(os.listdir(dirname)):
+            if filename.endswith(".py"):
+                st = os.stat(os.path.join(dirname, filename))
+                fingerprint.append([filename, st.st_mtime_ns, st.st_size])
+
+        return [spec.origin, fingerprint]
+
+    @staticmethod
+    def build_entry(class_path, fingerprint):
+
+        module_name, class_name = class_path.rsplit(".", 1)
+        plugin_class = getattr(importlib.import_module(module_name), class_name)
+
+        commands = []
+        for name in dir(plugin_class):
+
+            if not name.startswith(constants.COMMAND_FUNC_PREFIX):
+                continue
+
+            func = getattr(plugin_class, name)
+
+            description = func.__doc__
+            spec = getattr(func, constants.ARGPARSE_COMMAND_ATTR_SPEC, None)
+            if spec is not None and isinstance(spec.parser_source, cmd2.Cmd2ArgumentParser) and spec.parser_source.description:
+                description = spec.parser_source.description
+
+            commands.append({
+                "name" : name[len(constants.COMMAND_FUNC_PREFIX):],
+                "category" : getattr(func, constants.COMMAND_ATTR_HELP_CATEGORY, None),
+                "description" : description,
+            })
+
+        return {
+            "fingerprint" : fingerprint,
+            "commands" : commands,
+            "dependencies" : list(getattr(plugin_class, "PLUGIN_DEPENDENCIES", [])),
+        }
+
+    def get(self, class_path):
+
+        fingerprint = self.get_fingerprint(class_path.rsplit(".", 1)[0])
+
+        entry = self.entries.get(class_path)
+        if entry is None or entry["fingerprint"] != fingerprint:
+            entry = self.build_entry(class_path, fingerprint)
+            self.entries[class_path] = entry
+            self.modified = True
+
+        return entry
+
+
+class LazyPlugin:
+
+    # Stand-in for a plugin which is not imported yet. Its commands are stubs which load
+    # the plugin on first use.
+
+    class_path = None
+    dependencies = []
+
+
+def create_lazy_command(class_path, name, category, description):
+
+    def do_lazy(self, statement):
+        self.load_plugin(class_path)
+        return getattr(self, constants.COMMAND_FUNC_PREFIX + name)(statement)
+
+    do_lazy.__name__ = constants.COMMAND_FUNC_PREFIX + name
+    do_lazy.__doc__ = description
+    do_lazy.lazy_plugin_class_path = class_path
+    if category is not None:
+        setattr(do_lazy, constants.COMMAND_ATTR_HELP_CATEGORY, category)
+
+    def complete_lazy(self, text, line, begidx, endidx):
+
+        self.load_plugin(class_path)
+
+        command_func = self.get_command_func(name)
+        parser = self.command_parsers.get(command_func)
+        if parser is None:
+            completer_func = getattr(self, constants.COMPLETER_FUNC_PREFIX + name, self.completedefault)
+            return completer_func(text, line, begidx, endidx)
+
+        tokens, raw_tokens = self.tokens_for_completion(line, begidx, endidx)
+        spec = getattr(command_func, constants.ARGPARSE_COMMAND_ATTR_SPEC)
+        completer = parser.completer_class(parser, self)
+        return completer.complete(text, line, begidx, endidx, raw_tokens[1:] if spec.preserve_quotes else tokens[1:], cmd_set=self.find_commandset_for_command(name))
+
+    complete_lazy.__name__ = constants.COMPLETER_FUNC_PREFIX + name
+
+    return do_lazy, complete_lazy
+
+
+def create_lazy_plugin_class(class_path, entry):
+
+    attributes = {
+        "class_path" : class_path,
+        "dependencies" : entry["dependencies"],
+    }
+
+    for command in entry["commands"]:
+        do_lazy, complete_lazy = create_lazy_command(class_path, command["name"], command["category"], command["description"])
+        attributes[do_lazy.__name__] = do_lazy
+        attributes[complete_lazy.__name__] = complete_lazy
+
+    return type("Lazy" + class_path.rsplit(".", 1)[1], (LazyPlugin,), attributes)
+
+
+# bundled plugins whose hooks must see every command, and so stay mixed in when listed as classes
+eager_plugin_class_paths = { "plugins.perf_commands.PerfCommands" }
+
+
+def get_plugin_classes(plugins):
+
+    # Classes are mixed in as they are, "module.Class" strings are registered lazily from the manifest.
+    # Bundled plugins listed as classes by config.py of older versions are registered lazily
+    # too, by class path, without touching the file.
+    plugin_manifest = PluginManifest.instance()
+
+    plugin_classes = []
+    for plugin in plugins:
+        if not isinstance(plugin, str) and plugin.__module__.startswith("plugins."):
+            class_path = f"{plugin.__module__}.{plugin.__qualname__}"
+            if class_path not in eager_plugin_class_paths:
+                plugin = class_path
+
+        if isinstance(plugin, str):
+            plugin_classes.append(create_lazy_plugin_class(plugin, plugin_manifest.get(plugin)))
+        else:
+            plugin_classes.append(plugin)
+
+    plugin_manifest.save()
+
+    return plugin_classes
+
+
+class PluginDelegate(cmd2.CommandSet):
+
+    # Runs a lazily loaded plugin, written as a cmd2.Cmd mixin, as a CommandSet of the app.
+    # Attributes the plugin doesn't define are looked up in the app.
+
+    def __init__(self, app):
+        self._app = app
+        super().__init__()
+
+    def __getattr__(self, name):
+        if name == "_app":
+            raise AttributeError(name)
+        return getattr(self._app, name)
+
+
+class LazyPluginLoader:
+
+    def __init__(self, *args, **kwargs):
+
+        # class path -> loaded plugin
+        self.plugin_delegates = {}
+        self.loading_plugin_class_paths = set()
+
+        super().__init__(*args, **kwargs)
+
+        self.register_precmd_hook(self.on_lazy_plugin_command_started)
+
+
+    # -----
+    # Hooks
+
+    def on_lazy_plugin_command_started(self, data: cmd2.plugin.PrecommandData) -> cmd2.plugin.PrecommandData:
+
+        args = [ arg for arg in data.statement.arg_list if not arg.startswith("-") ]
+
+        # Help of a command needs its parser
+        if data.statement.command == "help" and args:
+            command_func = self.get_command_func(args[0])
+            class_path = getattr(command_func, "lazy_plugin_class_path", None)
+            if class_path is not None:
+                self.load_plugin(class_path)
+
+        # Settables are added when plugins are initialized
+        elif data.statement.command == "set" and (not args or args[0] not in self.settables):
+            self.load_all_plugins()
+
+        return data
+
+    def _resolve_func_self(self, cmd_support_func, cmd_self):
+
+        # Choices providers and completers of a loaded plugin are methods of its plugin
+        # class, which cmd2 doesn't know as a CommandSet type
+        func_class = cmd2.utils.get_defining_class(cmd_support_func)
+        if func_class is not None and not issubclass(func_class, cmd2.CommandSet):
+            for plugin_delegate in [cmd_self, *self.plugin_delegates.values()]:
+                if isinstance(plugin_delegate, PluginDelegate) and isinstance(plugin_delegate, func_class):
+                    return plugin_delegate
+
+        return super()._resolve_func_self(cmd_support_func, cmd_self)
+
+    def get_lazy_plugin_classes(self):
+        # the app class inherits class_path too, look only at the stand-in classes themselves
+        return [ cls for cls in type(self).__mro__ if vars(cls).get("class_path") is not None ]
+
+    def get_plugin(self, class_path):
+
+        # Plugin object of a "module.Class" entry, loading it if needed. Plugins given as
+        # classes are mixed into the app.
+        plugin_delegate = self.load_plugin(class_path)
+        if plugin_delegate is not None:
+            return plugin_delegate
+
+        module_name, class_name = class_path.rsplit(".", 1)
+        plugin_class = getattr(sys.modules.get(module_name), class_name, None)
+        if plugin_class is not None and isinstance(self, plugin_class):
+            return self
+
+        return None
+
+    def load_plugin(self, class_path):
+
+        if class_path in self.plugin_delegates:
+            return self.plugin_delegates[class_path]
+
+        lazy_plugin_class = None
+        for cls in self.get_lazy_plugin_classes():
+            if cls.class_path == class_path:
+                lazy_plugin_class = cls
+                break
+
+        # not a lazy plugin, or dependencies loading each other
+        if lazy_plugin_class is None or class_path in self.loading_plugin_class_paths:
+            return None
+
+        self.loading_plugin_class_paths.add(class_path)
+        try:
+            for dependency in lazy_plugin_class.dependencies:
+                self.load_plugin(dependency)
+
+            module_name, class_name = class_path.rsplit(".", 1)
+            plugin_class = getattr(importlib.import_module(module_name), class_name)
+
+            # Hooks added by a plugin which fails to load are removed, and the stubs are
+            # put back, so that the next use of its commands tries again
+            hook_lists = [ self._preloop_hooks, self._postloop_hooks, self._postparsing_hooks, self._precmd_hooks, self._postcmd_hooks, self._cmdfinalization_hooks ]
+            hook_list_lengths = [ len(hook_list) for hook_list in hook_lists ]
+
+            stubs = {}
+            try:
+                delegate_class = type(class_name, (plugin_class, PluginDelegate), {})
+                plugin_delegate = delegate_class(self)
+
+                for name, value in list(vars(lazy_plugin_class).items()):
+                    if name.startswith((constants.COMMAND_FUNC_PREFIX, constants.COMPLETER_FUNC_PREFIX)):
+                        stubs[name] = value
+                        delattr(lazy_plugin_class, name)
+
+                self.register_command_set(plugin_delegate)
+
+            except Exception:
+                for name, value in stubs.items():
+                    setattr(lazy_plugin_class, name, value)
+                for hook_list, length in zip(hook_lists, hook_list_lengths):
+                    del hook_list[length:]
+                raise
+
+        finally:
+            self.loading_plugin_class_paths.discard(class_path)
+
+        self.plugin_delegates[class_path] = plugin_delegate
+        return plugin_delegate
+
+    def load_all_plugins(self):
+        for cls in self.get_lazy_plugin_classes():
+            self.load_plugin(cls.class_path)
+
+
+class ShellDaemon:
+
+    # Keeps one app alive behind a Unix domain socket. Clients pass their stdin, stdout
+    # and stderr with the request, so output (including of subprocesses) goes straight to
+    # them. Clients are accepted on threads, and their commands run one at a time on the
+    # main thread, as in the interactive shell.
+
+    def __init__(self, app, socket_path):
+        self.app = app
+        self.socket_path = socket_path
+        self.jobs = queue.Queue()
+        self.current_job = None
+        self.server = None
+
+    def serve_forever(self):
+
+        self.remove_stale_socket()
+
+        daemon = self
+
+        class RequestHandler(socketserver.BaseRequestHandler):
+            def handle(self):
+                daemon.handle_client(self.request)
+
+        old_umask = os.umask(0o077)
+        try:
+            self.server = socketserver.ThreadingUnixStreamServer(self.socket_path, RequestHandler)
+        finally:
+            os.umask(old_umask)
+        self.server.daemon_threads = True
+
+        # the interrupt signal is only unblocked while a command runs, so that it can't land
+        # while the client's fds are swapped in or out. Threads inherit the mask.
+        signal.signal(signal.SIGUSR1, self.on_interrupt_signal)
+        signal.pthread_sigmask(signal.SIG_BLOCK, {signal.SIGUSR1})
+
+        server_thread = threading.Thread(target=self.server.serve_forever, name="DaemonServer", daemon=True)
+        server_thread.start()
+
+        print(f"CraftShell daemon is listening on {self.socket_path}", file=sys.stderr)
+
+        # same start and end as cmdloop() of the interactive shell
+        for func in self.app._preloop_hooks:
+            func()
+        self.app.runcmds_plus_hooks(self.app._startup_commands)
+        self.app._startup_commands.clear()
+
+        try:
+            while True:
+                try:
+                    job = self.jobs.get(timeout=1)
+                except queue.Empty:
+                    continue
+                try:
+                    self.run_job(job)
+                finally:
+                    job["done"].set()
+        finally:
+            self.server.shutdown()
+            self.server.server_close()
+            with contextlib.suppress(FileNotFoundError):
+                os.unlink(self.socket_path)
+            for func in self.app._postloop_hooks:
+                func()
+
+    def remove_stale_socket(self):
+
+        if not os.path.exists(self.socket_path):
+            return
+
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(self.socket_path)
+        except ConnectionRefusedError:
+            os.unlink(self.socket_path)
+            return
+        finally:
+            sock.close()
+
+        raise RuntimeError(f"CraftShell daemon is already running at {self.socket_path}")
+
+    def handle_client(self, sock):
+
+        # the request arrives with the client's stdin, stdout and stderr attached
+        data, fds, flags, address = socket.recv_fds(sock, 64 * 1024, 3)
+        if len(fds) != 3 or len(data) < cshell.frame_header_size:
+            for fd in fds:
+                os.close(fd)
+            return
+
+        frame_type, size = struct.unpack(cshell.frame_header_format, data[:cshell.frame_header_size])
+        payload = data[cshell.frame_header_size:]
+        if len(payload) < size:
+            payload += cshell.recv_exactly(sock, size - len(payload)) or b""
+
+        cwd, command = payload.decode("utf-8").split("\0", 1)
+
+        job = {
+            "cwd" : cwd,
+            "command" : command,
+            "fds" : fds,
+            "sock" : sock,
+            "done" : threading.Event(),
+            "interrupted" : False,
+            "errors" : 0,
+        }
+        self.jobs.put(job)
+
+        # Ctrl-C of the client, or the client going away, interrupts its command
+        while not job["done"].is_set():
+            readable, _, _ = select.select([sock], [], [], 0.1)
+            if readable:
+                frame_type, payload = cshell.recv_frame(sock)
+                if self.current_job is job:
+                    job["interrupted"] = True
+                    signal.pthread_kill(threading.main_thread().ident, signal.SIGUSR1)
+                if frame_type is None:
+                    break
+
+        job["done"].wait()
+
+    def on_interrupt_signal(self, signum, frame):
+        # a signal left pending by a job that already finished must not interrupt the next one
+        job = self.current_job
+        if job is not None and job["interrupted"]:
+            raise KeyboardInterrupt
+
+    def run_job(self, job):
+
+        app = self.app
+
+        cwd = os.getcwd()
+        sys.stdout.flush()
+        sys.stderr.flush()
+        saved_fds = [ os.dup(fd) for fd in (0, 1, 2) ]
+        for fd, client_fd in zip((0, 1, 2), job["fds"]):
+            os.dup2(client_fd, fd)
+
+        # consoles cached by cmd2 belong to the previous client's terminal, and go quiet after a broken pipe
+        app._console_cache.stdout = None
+        app._console_cache.stderr = None
+
+        # unknown commands and failing commands report through perror() or pexcept()
+        def perror(*args, **kwargs):
+            job["errors"] += 1
+            type(app).perror(app, *args, **kwargs)
+
+        def pexcept(*args, **kwargs):
+            job["errors"] += 1
+            type(app).pexcept(app, *args, **kwargs)
+
+        app.perror = perror
+        app.pexcept = pexcept
+        app.last_result = None
+        self.current_job = job
+
+        status = 0
+        try:
+            os.chdir(job["cwd"])
+            signal.pthread_sigmask(signal.SIG_UNBLOCK, {signal.SIGUSR1})
+            try:
+                app.onecmd_plus_hooks(job["command"], raise_keyboard_interrupt=True)
+            finally:
+                # an interrupt that arrived before this point is raised from here
+                signal.pthread_sigmask(signal.SIG_BLOCK, {signal.SIGUSR1})
+        except KeyboardInterrupt:
+            status = 130
+        except Exception as e:
+            app.perror(e)
+        finally:
+            self.current_job = None
+            del app.perror
+            del app.pexcept
+            sys.stdout.flush()
+            sys.stderr.flush()
+            for fd, saved_fd in zip((0, 1, 2), saved_fds):
+                os.dup2(saved_fd, fd)
+                os.close(saved_fd)
+            for client_fd in job["fds"]:
+                os.close(client_fd)
+            os.chdir(cwd)
+
+        if status == 0 and (job["errors"] or app.last_result is False):
+            status = 1
+
+        with contextlib.suppress(OSError):
+            cshell.send_frame(job["sock"], cshell.FRAME_EXIT, struct.pack("!i", status))
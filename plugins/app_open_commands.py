@@ -1,8 +1,41 @@
+import os
+import re
+import glob
 import subprocess
 
 import cmd2
 
-from .aws_misc import *
+
+def list_ssh_config_hosts(ssh_config_path, depth=0):
+
+    hosts = []
+
+    # ssh limits Include nesting as well
+    if depth > 16 or not os.path.isfile(ssh_config_path):
+        return hosts
+
+    with open(ssh_config_path) as fd:
+        for line in fd:
+
+            re_result = re.match( r"Host\s([^*]+)$", line.strip() )
+            if re_result:
+                hostname = re_result.group(1)
+                hosts.append(hostname)
+                continue
+
+            re_result = re.match( r"Include\s+(.+)$", line.strip(), re.IGNORECASE )
+            if re_result:
+                for pattern in re_result.group(1).split():
+
+                    # relative paths are relative to ~/.ssh
+                    pattern = os.path.expanduser(pattern)
+                    if not os.path.isabs(pattern):
+                        pattern = os.path.join(os.path.expanduser("~/.ssh"), pattern)
+
+                    for included_path in sorted(glob.glob(pattern)):
+                        hosts += list_ssh_config_hosts(included_path, depth+1)
+
+    return hosts
 
 
 class AppOpenCommands:
@@ -14,19 +47,7 @@ class AppOpenCommands:
     # completers
 
     def choices_ssh_hostnames(self, arg_tokens):
-
-        choices = []
-
-        ssh_config_path = os.path.expanduser("~/.ssh/config")
-        if os.path.exists(ssh_config_path):
-            with open(ssh_config_path) as fd:
-                for line in fd:
-                    re_result = re.match( r"Host\s([^*]+)$", line.strip() )
-                    if re_result:
-                        hostname = re_result.group(1)
-                        choices.append(hostname)
-
-        return choices
+        return list_ssh_config_hosts( os.path.expanduser("~/.ssh/config") )
 
 
     # --------
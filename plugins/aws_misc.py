@@ -5,9 +5,25 @@ import datetime
 import tempfile
 import gzip
 import json
+import pickle
 import shutil
+import threading
 
 import boto3
+import botocore.config
+
+from .perf_misc import *
+
+
+def create_boto3_client(service_name, region_name=None, endpoint_url=None):
+
+    # All boto3 clients are created here, so that they share the same API call layers
+    api_call_limiter = ApiCallLimiter.instance()
+    client = boto3.client(service_name, region_name=region_name, endpoint_url=endpoint_url, config=api_call_limiter.get_client_config())
+    api_call_limiter.register(client)
+    ApiCallStats.instance().register(client)
+
+    return ApiCallMemo.instance().wrap(client)
 
 
 def get_boto3_client(service_name):
@@ -16,7 +32,7 @@ def get_boto3_client(service_name):
     if "AWS_REGION" in os.environ:
         region_name = os.environ["AWS_REGION"]
 
-    return boto3.client(service_name, region_name=region_name)
+    return create_boto3_client(service_name, region_name=region_name)
 
 
 def get_region():
@@ -64,6 +80,25 @@ def get_all_profiles():
     return profiles
 
 
+account_ids = {}
+
+def get_account_id():
+
+    # account of the current credentials, from ~/.aws/config when the profile names
+    # it, otherwise from STS once per profile and access key
+    profile_name = get_profile()
+    profile = get_all_profiles().get(profile_name, {})
+    if "account" in profile:
+        return profile["account"]
+
+    key = (profile_name, os.environ.get("AWS_ACCESS_KEY_ID"))
+    if key not in account_ids:
+        sts = get_boto3_client("sts")
+        account_ids[key] = sts.get_caller_identity()["Account"]
+
+    return account_ids[key]
+
+
 def get_max_len( d, keys ):
 
     if not isinstance( keys, (list,tuple) ):
@@ -77,6 +112,428 @@ def get_max_len( d, keys ):
     return max_len
 
 
+def parse_time_spec(time_spec):
+
+    # Relative time from now (e.g. 30m, 2h, 7d, 1w), or absolute local time
+    # (e.g. 2024-01-31, "2024-01-31 12:00:00", 20240131_120000)
+
+    now = datetime.datetime.now().astimezone()
+
+    if time_spec=="now":
+        return now
+
+    re_result = re.match( r"^([0-9]+(?:\.[0-9]+)?)([smhdw])$", time_spec.strip() )
+    if re_result:
+        value = float(re_result.group(1))
+        unit = { "s" : 1, "m" : 60, "h" : 60 * 60, "d" : 24 * 60 * 60, "w" : 7 * 24 * 60 * 60 }[re_result.group(2)]
+        return now - datetime.timedelta(seconds=value * unit)
+
+    for fmt in ("%Y%m%d_%H%M%S", "%Y/%m/%d %H:%M:%S", "%Y/%m/%d"):
+        try:
+            return datetime.datetime.strptime(time_spec, fmt).astimezone()
+        except ValueError:
+            pass
+
+    try:
+        dt = datetime.datetime.fromisoformat(time_spec)
+    except ValueError:
+        raise ValueError(f"Invalid time format [{time_spec}]")
+
+    return dt.astimezone()
+
+
+class TokenBucket:
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.capacity = burst if burst else max(1.0, rate)
+        self.tokens = self.capacity
+        self.last_time = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+
+        # block until a token is available
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.last_time) * self.rate)
+                self.last_time = now
+
+                if self.tokens >= 1.0:
+                    self.tokens -= 1.0
+                    return
+
+                wait_time = (1.0 - self.tokens) / self.rate
+
+            time.sleep(wait_time)
+
+
+class ApiCallLimiter:
+
+    # Rate limits HTTP requests with a token bucket shared by all clients and threads,
+    # per (service, region, operation). Off by default, as adaptive retry of botocore
+    # already backs off when AWS throttles, and a fixed cap would serialize fan-outs.
+
+    _instance = None
+
+    @staticmethod
+    def instance():
+        if ApiCallLimiter._instance is None:
+            ApiCallLimiter._instance = ApiCallLimiter()
+        return ApiCallLimiter._instance
+
+    def __init__(self):
+
+        self.max_rps = 0.0
+        self.retry_mode = "adaptive"
+        self.max_attempts = 10
+
+        self.lock = threading.Lock()
+        self.buckets = {}
+
+    def get_client_config(self):
+        return botocore.config.Config(retries={ "mode" : self.retry_mode, "max_attempts" : self.max_attempts })
+
+    def register(self, client):
+
+        region_name = client.meta.region_name
+
+        def on_before_send(event_name, **kwargs):
+            if self.max_rps > 0:
+                _, service_id, operation_name = event_name.split(".")[:3]
+                self.get_bucket(service_id, region_name, operation_name).acquire()
+
+        client.meta.events.register("before-send", on_before_send)
+
+    def get_bucket(self, service_id, region_name, operation_name):
+
+        key = (service_id, region_name, operation_name)
+        with self.lock:
+            bucket = self.buckets.get(key)
+            if bucket is None or bucket.rate != self.max_rps:
+                bucket = TokenBucket(self.max_rps)
+                self.buckets[key] = bucket
+            return bucket
+
+
+class ApiCallStats:
+
+    # Per operation counts, latencies, retries, throttled responses and response sizes
+    # of AWS API calls, for the current command, the last command and the session
+
+    _instance = None
+
+    @staticmethod
+    def instance():
+        if ApiCallStats._instance is None:
+            ApiCallStats._instance = ApiCallStats()
+        return ApiCallStats._instance
+
+    throttling_error_codes = [
+        "Throttling",
+        "ThrottlingException",
+        "ThrottledException",
+        "RequestThrottledException",
+        "TooManyRequestsException",
+        "ProvisionedThroughputExceededException",
+        "RequestLimitExceeded",
+        "SlowDown",
+    ]
+
+    stat_names = [ "calls", "errors", "retries", "throttles", "bytes", "seconds", "max_seconds" ]
+
+    def __init__(self):
+
+        self.lock = threading.Lock()
+
+        self.command_stats = {}
+        self.last_command_line = None
+        self.last_command_stats = {}
+        self.session_stats = {}
+
+        # never reset, for callers measuring a span of their own
+        self.total_calls = 0
+        self.total_seconds = 0.0
+
+    def register(self, client):
+
+        def on_before_call(context, **kwargs):
+            context["cshell_start_time"] = time.perf_counter()
+
+        def on_needs_retry(event_name, response, **kwargs):
+            if response is not None and response[1].get("Error", {}).get("Code") in self.throttling_error_codes:
+                self.add(event_name, throttles=1)
+
+        def on_after_call(event_name, http_response, parsed, context, **kwargs):
+
+            now = time.perf_counter()
+            start_time = context.get("cshell_start_time", now)
+            retries = parsed.get("ResponseMetadata", {}).get("RetryAttempts", 0)
+            num_bytes = int(http_response.headers.get("content-length", 0))
+
+            self.add(
+                event_name,
+                calls = 1,
+                errors = 1 if "Error" in parsed else 0,
+                retries = retries,
+                bytes = num_bytes,
+                seconds = now - start_time,
+            )
+
+            TraceRecorder.instance().add_span(".".join(event_name.split(".")[1:3]), "aws", start_time, now - start_time, { "status" : http_response.status_code, "retries" : retries, "bytes" : num_bytes })
+
+        client.meta.events.register("before-call", on_before_call)
+        client.meta.events.register("needs-retry", on_needs_retry)
+        client.meta.events.register("after-call", on_after_call)
+
+    def add(self, event_name, **values):
+
+        _, service_id, operation_name = event_name.split(".")[:3]
+        key = f"{service_id}.{operation_name}"
+
+        with self.lock:
+            self.total_calls += values.get("calls", 0)
+            self.total_seconds += values.get("seconds", 0.0)
+            stats = self.command_stats.setdefault(key, dict.fromkeys(self.stat_names, 0))
+            for name, value in values.items():
+                if name == "seconds":
+                    stats["max_seconds"] = max(stats["max_seconds"], value)
+                stats[name] += value
+
+    @staticmethod
+    def get_totals(stats_by_operation):
+        totals = dict.fromkeys(ApiCallStats.stat_names, 0)
+        for stats in stats_by_operation.values():
+            for name in ApiCallStats.stat_names:
+                if name == "max_seconds":
+                    totals[name] = max(totals[name], stats[name])
+                else:
+                    totals[name] += stats[name]
+        return totals
+
+    def end_command(self, command_line):
+
+        # Returns stats of the command which just finished. Commands without
+        # API calls don't replace the last command, so that 'awsut stats' can show it.
+
+        with self.lock:
+            command_stats = self.command_stats
+            self.command_stats = {}
+
+            if command_stats:
+                self.last_command_line = command_line
+                self.last_command_stats = command_stats
+
+                for key, stats in command_stats.items():
+                    session_stats = self.session_stats.setdefault(key, dict.fromkeys(self.stat_names, 0))
+                    for name in self.stat_names:
+                        if name == "max_seconds":
+                            session_stats[name] = max(session_stats[name], stats[name])
+                        else:
+                            session_stats[name] += stats[name]
+
+        return command_stats
+
+
+class ApiCallMemo:
+
+    # Coalesces identical in-flight read calls across threads, and memoizes their results
+    # until the end of the current command or for ttl seconds. Only operations listed in
+    # memoized_operations are memoized, so that polled reads (e.g. describe_export_tasks)
+    # always see new data. Calls with a mutating verb (write_prefixes) drop all memoized
+    # results. Other calls, e.g. filter_log_events or start_query, pass through.
+
+    _instance = None
+
+    @staticmethod
+    def instance():
+        if ApiCallMemo._instance is None:
+            ApiCallMemo._instance = ApiCallMemo()
+        return ApiCallMemo._instance
+
+    write_prefixes = (
+        "create_", "update_", "delete_", "put_", "modify_",
+        "batch_delete_", "batch_update_", "batch_put_",
+        "run_instances", "start_instances", "stop_instances", "reboot_", "terminate_",
+        "attach_", "detach_", "associate_", "disassociate_", "register_", "deregister_",
+        "tag_", "untag_", "add_tags", "remove_tags",
+    )
+
+    # reads repeated by helpers and completers within a command, and not polled
+    memoized_operations = {
+        "describe_cluster",
+        "describe_cluster_node",
+        "list_clusters",
+        "list_cluster_nodes",
+        "describe_instances",
+        "describe_log_groups",
+        "describe_log_streams",
+        "list_stacks",
+        "get_caller_identity",
+    }
+
+    stat_names = [ "hits", "coalesced", "misses", "invalidations" ]
+
+    def __init__(self):
+
+        self.ttl = 10.0
+
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.in_flight = {}
+        self.generation = 0
+
+        self.command_stats = dict.fromkeys(self.stat_names, 0)
+        self.last_command_stats = dict.fromkeys(self.stat_names, 0)
+        self.session_stats = dict.fromkeys(self.stat_names, 0)
+
+    def wrap(self, client):
+        return MemoizedClient(client, self)
+
+    def is_memoizable(self, operation_name):
+        return operation_name in self.memoized_operations
+
+    def is_write(self, operation_name):
+        return operation_name.startswith(self.write_prefixes)
+
+    def call(self, client, operation_name, method, kwargs):
+
+        if self.ttl <= 0:
+            return method(**kwargs)
+
+        key = (get_profile(), client.meta.region_name, client.meta.endpoint_url, operation_name, json.dumps(kwargs, sort_keys=True, default=str))
+
+        while True:
+            with self.lock:
+                entry = self.entries.get(key)
+                if entry and time.monotonic() - entry[0] < self.ttl:
+                    self.command_stats["hits"] += 1
+                    return pickle.loads(entry[1])
+
+                event = self.in_flight.get(key)
+                if event is None:
+                    event = threading.Event()
+                    self.in_flight[key] = event
+                    generation = self.generation
+                    break
+
+            # wait for the same call in another thread, and retry if it didn't leave a result
+            event.wait()
+            with self.lock:
+                entry = self.entries.get(key)
+                if entry:
+                    self.command_stats["coalesced"] += 1
+                    return pickle.loads(entry[1])
+
+        try:
+            result = method(**kwargs)
+
+            # callers own and may modify the result, hits get their own copy from the pickle,
+            # which is cheaper than deepcopy for boto3 responses
+            data = pickle.dumps(result, protocol=pickle.HIGHEST_PROTOCOL)
+
+            with self.lock:
+                self.command_stats["misses"] += 1
+                if generation == self.generation:
+                    self.entries[key] = (time.monotonic(), data)
+            return result
+        finally:
+            with self.lock:
+                del self.in_flight[key]
+            event.set()
+
+    def clear(self):
+        with self.lock:
+            self.entries = {}
+            self.generation += 1
+
+    def invalidate(self):
+        with self.lock:
+            self.entries = {}
+            self.generation += 1
+            self.command_stats["invalidations"] += 1
+
+    def end_command(self):
+        with self.lock:
+            self.entries = {}
+            self.generation += 1
+            if not any(self.command_stats.values()):
+                return
+            self.last_command_stats = self.command_stats
+            for name in self.stat_names:
+                self.session_stats[name] += self.command_stats[name]
+            self.command_stats = dict.fromkeys(self.stat_names, 0)
+
+
+class MemoizedClient:
+
+    # boto3 client proxy which routes API methods through ApiCallMemo
+
+    def __init__(self, client, memo):
+        self._client = client
+        self._memo = memo
+
+    def __getattr__(self, name):
+
+        attr = getattr(self._client, name)
+        if name not in self._client.meta.method_to_api_mapping:
+            return attr
+
+        if self._memo.is_memoizable(name):
+            def read(**kwargs):
+                return self._memo.call(self._client, name, attr, kwargs)
+            return read
+
+        if not self._memo.is_write(name):
+            return attr
+
+        def write(**kwargs):
+            try:
+                return attr(**kwargs)
+            finally:
+                self._memo.invalidate()
+        return write
+
+
+class JsonStreamWriter:
+
+    # Writes a JSON object field by field, with list fields item by item,
+    # producing the same text as json.dumps(obj, indent=indent) without holding the whole document
+    def __init__(self, write_func, indent=2):
+        self.write_func = write_func
+        self.indent = indent
+        self.num_fields = 0
+        self.num_items = 0
+
+    def _dumps(self, value, level):
+        return json.dumps(value, indent=self.indent, default=str).replace("\n", "\n" + " " * (self.indent * level))
+
+    def _write_key(self, key):
+        self.write_func(("{\n" if self.num_fields==0 else ",\n") + " " * self.indent + json.dumps(key) + ": ")
+        self.num_fields += 1
+
+    def write_field(self, key, value):
+        self._write_key(key)
+        self.write_func(self._dumps(value, 1))
+
+    def begin_list(self, key):
+        self._write_key(key)
+        self.write_func("[")
+        self.num_items = 0
+
+    def write_items(self, items):
+        for item in items:
+            self.write_func(("\n" if self.num_items==0 else ",\n") + " " * (self.indent * 2) + self._dumps(item, 2))
+            self.num_items += 1
+
+    def end_list(self):
+        self.write_func("]" if self.num_items==0 else "\n" + " " * self.indent + "]")
+
+    def close(self):
+        self.write_func("{}\n" if self.num_fields==0 else "\n}\n")
+
+
 class ProgressDots:
 
     def __init__(self):
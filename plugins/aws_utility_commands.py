@@ -17,17 +17,37 @@ class AwsUtilityCommands:
 
     CATEGORY = "AWS utility commands"
 
+    api_memo_ttl = 10.0
+    api_max_rps = 0.0
+    api_retry_mode = "adaptive"
+    api_max_attempts = 10
 
     def __init__(self, *args, **kwargs):
 
         super().__init__(*args, **kwargs)
 
         user_config = misc.UserConfig.instance()
-        self.aws_config = user_config.get("AwsConfig")
-        self.console_url_modifier_func = getattr(self.aws_config, "console_url_modifier_func", None)
+        self.on_awsut_user_config_reloaded(user_config)
+        user_config.add_reload_listener(self.on_awsut_user_config_reloaded)
 
         self.register_postcmd_hook(self.on_awsut_command_executed)
 
+        self.add_settable(
+            cmd2.Settable('api_memo_ttl', float, 'Seconds to reuse results of identical AWS read calls within a command (0 to disable)', AwsUtilityCommands, onchange_cb=self.on_api_memo_ttl_changed)
+        )
+        ApiCallMemo.instance().ttl = AwsUtilityCommands.api_memo_ttl
+
+        self.add_settable(
+            cmd2.Settable('api_max_rps', float, 'Maximum AWS requests per second, per service, region and API, shared by all threads (0 to disable)', AwsUtilityCommands, onchange_cb=self.on_api_limiter_settings_changed)
+        )
+        self.add_settable(
+            cmd2.Settable('api_retry_mode', str, 'botocore retry mode for AWS API calls', AwsUtilityCommands, choices=["adaptive", "standard", "legacy"], onchange_cb=self.on_api_limiter_settings_changed)
+        )
+        self.add_settable(
+            cmd2.Settable('api_max_attempts', int, 'Maximum attempts for each AWS API call, including retries', AwsUtilityCommands, onchange_cb=self.on_api_limiter_settings_changed)
+        )
+        self.on_api_limiter_settings_changed(None, None, None)
+
         self.cached_ec2_instance_name_choices = []
         self.cached_log_group_name_choices = []
         self.cached_log_stream_name_choices = {}
@@ -45,8 +65,28 @@ class AwsUtilityCommands:
         self.cached_log_stream_name_choices = {}
         self.cached_cf_stack_name_choices = []
 
+        # Tell when AWS slowed down the command
+        totals = ApiCallStats.get_totals(ApiCallStats.instance().end_command(data.statement.raw))
+        if totals["throttles"] or totals["retries"]:
+            self.pwarning(f"AWS API calls were throttled {totals['throttles']} times and retried {totals['retries']} times")
+
         return data
 
+    def on_awsut_user_config_reloaded(self, user_config):
+        self.aws_config = user_config.get("AwsConfig")
+        self.console_url_modifier_func = getattr(self.aws_config, "console_url_modifier_func", None)
+
+    def on_api_memo_ttl_changed(self, param_name, old_value, new_value):
+        ApiCallMemo.instance().ttl = new_value
+
+    def on_api_limiter_settings_changed(self, param_name, old_value, new_value):
+
+        # Applied to clients created after the change
+        api_call_limiter = ApiCallLimiter.instance()
+        api_call_limiter.max_rps = AwsUtilityCommands.api_max_rps
+        api_call_limiter.retry_mode = AwsUtilityCommands.api_retry_mode
+        api_call_limiter.max_attempts = AwsUtilityCommands.api_max_attempts
+
 
     # ----------
     # completers
@@ -96,9 +136,9 @@ class AwsUtilityCommands:
                         break
 
                 if name:
-                    self.cached_cluster_name_choices.append(name)
+                    self.cached_ec2_instance_name_choices.append(name)
 
-        return self.cached_cluster_name_choices
+        return self.cached_ec2_instance_name_choices
 
 
     def choices_log_group_names(self, arg_tokens):
@@ -696,6 +736,7 @@ class AwsUtilityCommands:
                 break
 
             time.sleep(5)
+            ApiCallMemo.instance().clear()
 
     argparser.set_defaults(func=_do_cf_wait)
 
@@ -737,3 +778,57 @@ class AwsUtilityCommands:
 
     argparser.set_defaults(func=_do_cf_open)
 
+
+    # ----------------------
+    # commands - cache-stats
+
+    argparser = subparsers1.add_parser("cache-stats", help="Show how many AWS read calls were served from the per-command memo")
+
+    def _do_cache_stats(self, args):
+
+        memo = ApiCallMemo.instance()
+
+        def print_stats(title, stats):
+            num_calls = stats["hits"] + stats["coalesced"] + stats["misses"]
+            hit_rate = (stats["hits"] + stats["coalesced"]) * 100 / num_calls if num_calls else 0
+            self.poutput(f"{title} : {num_calls} read calls, {stats['misses']} sent to AWS, {stats['hits']} memoized, {stats['coalesced']} coalesced, {stats['invalidations']} invalidations, hit rate {hit_rate:.1f}%")
+
+        print_stats("Last command", memo.last_command_stats)
+        print_stats("Session", memo.session_stats)
+
+    argparser.set_defaults(func=_do_cache_stats)
+
+
+    # ----------------
+    # commands - stats
+
+    argparser = subparsers1.add_parser("stats", help="Show AWS API calls made by the last command and in this session")
+
+    def _do_stats(self, args):
+
+        api_call_stats = ApiCallStats.instance()
+
+        def print_stats(title, stats_by_operation):
+
+            self.poutput(title)
+
+            if not stats_by_operation:
+                self.poutput("    No API calls")
+                self.poutput("")
+                return
+
+            rows = [ (key, stats) for key, stats in sorted(stats_by_operation.items(), key=lambda item: item[1]["seconds"], reverse=True) ]
+            rows.append(("Total", ApiCallStats.get_totals(stats_by_operation)))
+
+            format_string = "    {:<%d} : {:>6} : {:>6} : {:>7} : {:>9} : {:>9} : {:>9} : {:>10}" % max([ len(key) for key, stats in rows ])
+
+            self.poutput(format_string.format("Operation", "Calls", "Errors", "Retries", "Throttles", "Avg ms", "Max ms", "KB"))
+            for key, stats in rows:
+                avg_ms = stats["seconds"] * 1000 / stats["calls"] if stats["calls"] else 0
+                self.poutput(format_string.format(key, stats["calls"], stats["errors"], stats["retries"], stats["throttles"], f"{avg_ms:.1f}", f"{stats['max_seconds']*1000:.1f}", f"{stats['bytes']/1024:.1f}"))
+            self.poutput("")
+
+        print_stats(f"Last command : {api_call_stats.last_command_line}", api_call_stats.last_command_stats)
+        print_stats("Session", api_call_stats.session_stats)
+
+    argparser.set_defaults(func=_do_stats)
@@ -1,15 +1,23 @@
 import os
 import re
 import time
+import datetime
 import json
+import argparse
 import subprocess
 import signal
+import itertools
 import concurrent.futures
 
 import pexpect
 import pexpect.popen_spawn
 import cmd2
 import boto3
+import botocore.exceptions
+from rich.live import Live
+from rich.console import Group
+from rich.table import Table
+from rich.text import Text
 
 import misc
 
@@ -66,8 +74,12 @@ class HyperPodCommands:
 
     CATEGORY = "HyperPod operations"
 
+    # AWS API call settings, and the hooks ending memoization and stats per command
+    PLUGIN_DEPENDENCIES = ["plugins.aws_utility_commands.AwsUtilityCommands"]
+
     sagemaker_service_name = "sagemaker"
     hyperpod_endpoint = os.getenv("HYPERPOD_ENDPOINT", "")
+    ssh_control_persist = "10m"
 
     hyperpod_regions = [
         "us-east-1",
@@ -83,9 +95,11 @@ class HyperPodCommands:
         super().__init__(*args, **kwargs)
 
         user_config = misc.UserConfig.instance()
-        self.aws_config = user_config.get("AwsConfig")
+        self.on_hyperpod_user_config_reloaded(user_config)
+        user_config.add_reload_listener(self.on_hyperpod_user_config_reloaded)
 
         self.register_postcmd_hook(self.on_hyperpod_command_executed)
+        self.register_postloop_hook(self.on_hyperpod_postloop)
 
         self.cached_cluster_name_choices = []
         self.cached_instance_group_name_choices = {}
@@ -99,6 +113,10 @@ class HyperPodCommands:
             cmd2.Settable('sagemaker_service_name', str, 'SageMaker service name', HyperPodCommands)
         )
 
+        self.add_settable(
+            cmd2.Settable('ssh_control_persist', str, 'How long idle SSH master connections stay open (e.g. 10m, 1h)', HyperPodCommands)
+        )
+
     # -----
     # Hooks
     
@@ -111,6 +129,14 @@ class HyperPodCommands:
 
         return data
 
+    def on_hyperpod_postloop(self) -> None:
+
+        # Close SSH master connections started by this shell
+        SshMultiplexer.instance().stop_all()
+
+    def on_hyperpod_user_config_reloaded(self, user_config):
+        self.aws_config = user_config.get("AwsConfig")
+
 
     # -------------
     # boto3 clients
@@ -126,7 +152,37 @@ class HyperPodCommands:
             if "AWS_REGION" in os.environ:
                 region_name = os.environ["AWS_REGION"]
 
-        return boto3.client(HyperPodCommands.sagemaker_service_name, region_name=region_name, endpoint_url=endpoint_url)
+        return create_boto3_client(HyperPodCommands.sagemaker_service_name, region_name=region_name, endpoint_url=endpoint_url)
+
+
+    def get_cluster_metadata(self, sagemaker_client, cluster_name):
+
+        # Cached cluster metadata, calling describe_cluster only on cache miss.
+        # Returns None when the cluster doesn't exist.
+
+        region = get_region()
+        account_id = get_account_id()
+        metadata_cache = ClusterMetadataCache.instance()
+
+        metadata = metadata_cache.get(region, account_id, cluster_name)
+        if metadata is not None:
+            return metadata
+
+        try:
+            cluster = sagemaker_client.describe_cluster(
+                ClusterName = cluster_name
+            )
+        except sagemaker_client.exceptions.ResourceNotFound:
+            metadata_cache.invalidate(region, account_id, cluster_name)
+            return None
+
+        return metadata_cache.put_cluster(cluster)
+
+
+    def get_ssh_multiplexer(self):
+        ssh_multiplexer = SshMultiplexer.instance()
+        ssh_multiplexer.control_persist = HyperPodCommands.ssh_control_persist
+        return ssh_multiplexer
 
 
     # ----------
@@ -204,6 +260,10 @@ class HyperPodCommands:
         except sagemaker_client.exceptions.ResourceNotFound:
             raise cmd2.CompletionError(f"Cluster [{cluster_name}] not found.")
         
+        metadata_cache = ClusterMetadataCache.instance()
+        metadata_cache.put_cluster(cluster)
+        metadata_cache.put_nodes(cluster, nodes)
+
         hostnames = Hostnames.instance()
         hostnames.resolve(sagemaker_client, cluster, nodes)
         
@@ -595,13 +655,44 @@ class HyperPodCommands:
     argparser.set_defaults(func=_do_delete)
 
 
+    # ---
+
+    def _open_columnar_writer(self, args, columns):
+
+        if not args.output_file:
+            self.poutput(f"--output-file is required for {args.output} output.")
+            return None
+
+        try:
+            return ColumnarWriter(args.output_file, args.output, columns)
+        except ImportError as e:
+            self.poutput(str(e))
+            return None
+
+
     # ---
 
     argparser = subparsers1.add_parser("list", help="List clusters in human readable format")
     argparser.add_argument("--all-regions", action="store_true", default=False, help="List clusters in all regions" )
+    argparser.add_argument("--output", action="store", choices=["text", "parquet", "arrow"], default="text", help="Output format. parquet and arrow write a columnar file to --output-file (requires pyarrow)")
+    argparser.add_argument("--output-file", action="store", default=None, completer=cmd2.Cmd.path_complete, help="Output file path for parquet and arrow output")
 
     def _do_list(self, args):
 
+        if args.output != "text":
+
+            columnar_writer = self._open_columnar_writer(args, ColumnarWriter.cluster_columns)
+            if columnar_writer is None:
+                return
+
+            with columnar_writer:
+                region_names = HyperPodCommands.hyperpod_regions if args.all_regions else [None]
+                for region_name in region_names:
+                    columnar_writer.write(list_clusters_all(self.get_sagemaker_client(region_name=region_name)))
+
+            self.poutput(f"Wrote {columnar_writer.num_rows} clusters to {columnar_writer.filename}")
+            return
+
         def _list_single_region(region_name=None):
 
             sagemaker_client = self.get_sagemaker_client(region_name=region_name)
@@ -650,9 +741,33 @@ class HyperPodCommands:
     argparser = subparsers1.add_parser("describe", help="Describe cluster and its nodes in depth")
     argparser.add_argument("cluster_name", metavar="CLUSTER_NAME", action="store", choices_provider=choices_cluster_names, help="Name of cluster")
     argparser.add_argument("--raw", action="store_true", default=False, help="Show raw JSON output from boto3 APIs" )
+    argparser.add_argument("--jsonl", action="store_true", default=False, help="Show raw output from boto3 APIs as JSON Lines (cluster first, then one line per node)" )
+    argparser.add_argument("--output", action="store", choices=["text", "parquet", "arrow"], default="text", help="Output format. parquet and arrow write nodes to a columnar file at --output-file (requires pyarrow)")
+    argparser.add_argument("--output-file", action="store", default=None, completer=cmd2.Cmd.path_complete, help="Output file path for parquet and arrow output")
+    argparser.add_argument("--cached", action="store_true", default=False, help="Show the latest snapshot without calling APIs")
+    argparser.add_argument("--summary", action="store_true", default=False, help="Show only node counts by status per instance group, without resolving hostnames")
+    argparser.add_argument("--group", nargs="+", action="store", default=[], help="Show only these instance groups")
+    argparser.add_argument("--status", nargs="+", action="store", default=[], help="Show only nodes in these statuses (e.g. Pending Failed)")
 
     def _do_describe(self, args):
 
+        if args.cached:
+            snapshot_store = SnapshotStore.instance()
+            snapshot_id = snapshot_store.find(get_region(), get_account_id(), args.cluster_name)
+            if snapshot_id is None:
+                self.poutput(f"Snapshot of cluster [{args.cluster_name}] not found.")
+                return
+
+            snapshot_time, cluster, nodes = snapshot_store.load(snapshot_id)
+
+            hostnames = Hostnames.instance()
+            for node_id, hostname in snapshot_store.get_hostnames([ node["InstanceId"] for node in nodes ]).items():
+                hostnames.add(node_id, hostname)
+
+            self.poutput(f"Snapshot time : {snapshot_time.strftime('%Y/%m/%d %H:%M:%S')}")
+            self._print_cluster_description(cluster, nodes, args)
+            return
+
         sagemaker_client = self.get_sagemaker_client()
 
         try:
@@ -663,19 +778,62 @@ class HyperPodCommands:
             self.poutput(f"Cluster [{args.cluster_name}] not found.")
             return
         
-        cluster_id = cluster["ClusterArn"].split("/")[-1]
-        nodes = list_cluster_nodes_all( sagemaker_client, args.cluster_name )
+        if args.output != "text":
+
+            columnar_writer = self._open_columnar_writer(args, ColumnarWriter.node_columns)
+            if columnar_writer is None:
+                return
+
+            # write page by page without holding all nodes
+            with columnar_writer:
+                for page in list_cluster_nodes_pages( sagemaker_client, args.cluster_name ):
+                    for node in page:
+                        node["ClusterName"] = args.cluster_name
+                    columnar_writer.write(page)
+
+            self.poutput(f"Wrote {columnar_writer.num_rows} nodes to {columnar_writer.filename}")
+            return
+
+        if args.jsonl:
+            # cluster on the first line, then one line per node
+            self.poutput(json.dumps(cluster, default=str))
+            for page in list_cluster_nodes_pages( sagemaker_client, args.cluster_name ):
+                self.poutput("\n".join([ json.dumps(node, default=str) for node in page ]))
+            return
 
         if args.raw:
-            raw_output = {
-                "cluster": cluster,
-                "nodes": nodes,
-            }
-            self.poutput(json.dumps(raw_output, indent=2, default=str))
+            # write nodes as pages arrive, without building the whole document
+            json_writer = JsonStreamWriter(lambda s: self.poutput(s, end=""))
+            json_writer.write_field("cluster", cluster)
+            json_writer.begin_list("nodes")
+            for page in list_cluster_nodes_pages( sagemaker_client, args.cluster_name ):
+                json_writer.write_items(page)
+            json_writer.end_list()
+            json_writer.close()
             return
 
-        hostnames = Hostnames.instance()
-        hostnames.resolve(sagemaker_client, cluster, nodes)
+        nodes = list_cluster_nodes_all( sagemaker_client, args.cluster_name )
+
+        metadata_cache = ClusterMetadataCache.instance()
+        metadata_cache.put_cluster(cluster)
+        metadata_cache.put_nodes(cluster, nodes)
+
+        snapshot_store = SnapshotStore.instance()
+        snapshot_store.save(cluster, nodes)
+
+        def resolve_hostnames(nodes):
+            hostnames = Hostnames.instance()
+            hostnames.resolve_node_ids(sagemaker_client, cluster["ClusterName"], [ node.node_id for node in nodes ])
+            snapshot_store.put_hostnames({ node.node_id : hostnames.get_hostname(node.node_id) for node in nodes })
+
+        self._print_cluster_description(cluster, nodes, args, resolve_hostnames)
+
+    argparser.set_defaults(func=_do_describe)
+
+    def _print_cluster_description(self, cluster, nodes, args, resolve_hostnames=None):
+
+        cluster_id = cluster["ClusterArn"].split("/")[-1]
+        instance_groups = cluster["InstanceGroups"] + cluster["RestrictedInstanceGroups"]
 
         self.poutput(f"Cluster name : {cluster['ClusterName']}")
         self.poutput(f"Cluster Arn : {cluster['ClusterArn']}")
@@ -686,46 +844,350 @@ class HyperPodCommands:
 
         self.poutput("")
 
-        max_hostname_len = 0
+        # Group nodes by instance group in a single pass, applying filters
+        nodes_by_group = {}
+        status_counts_by_group = {}
         for node in nodes:
-            hostname = hostnames.get_hostname(node["InstanceId"])
-            if hostname:
-                max_hostname_len = max(max_hostname_len,len(hostname))
+            node = NodeRecord.from_node(node)
 
-        format_string_ig = "{:<%d} : {} : {}({}=>{})" % (get_max_len(nodes,"InstanceGroupName"))
-        format_string_node = "    {} : {:<%d} : {:<%d} : {} : {}" % (max_hostname_len, get_max_len(nodes,("InstanceStatus","Status"))+1)
+            status_counts = status_counts_by_group.setdefault(node.instance_group_name, {})
+            status_counts[node.status] = status_counts.get(node.status, 0) + 1
 
-        for instance_group in (cluster["InstanceGroups"] + cluster["RestrictedInstanceGroups"]):
+            if args.status and node.status not in args.status:
+                continue
+            nodes_by_group.setdefault(node.instance_group_name, []).append(node)
 
-            self.poutput(format_string_ig.format( instance_group["InstanceGroupName"], instance_group["InstanceType"], instance_group["Status"], instance_group["CurrentCount"], instance_group["TargetCount"] ))
-            
-            for node in nodes:
-                if node["InstanceGroupName"]==instance_group["InstanceGroupName"]:
+        if args.group:
+            instance_groups = [ instance_group for instance_group in instance_groups if instance_group["InstanceGroupName"] in args.group ]
 
-                    instance_group_name = node["InstanceGroupName"]
-                    node_id = node["InstanceId"]
-                    hostname = hostnames.get_hostname(node_id)
-                    if hostname is None:
-                        hostname = ""
-                    node_status = node["InstanceStatus"]["Status"]
-                    ssm_target = f"sagemaker-cluster:{cluster_id}_{instance_group_name}-{node_id}"
+        format_string_ig = "{:<%d} : {} : {}({}=>{})" % (get_max_len(instance_groups,"InstanceGroupName"))
 
-                    if node_status in ["Pending"]:
-                        node_status = "*" + node_status
+        for instance_group in instance_groups:
 
-                    self.poutput(format_string_node.format( node_id, hostname, node_status, node["LaunchTime"].strftime("%Y/%m/%d %H:%M:%S"), ssm_target ))
+            instance_group_name = instance_group["InstanceGroupName"]
 
-                    if "Message" in node["InstanceStatus"] and node["InstanceStatus"]["Message"]:
-                        message = node["InstanceStatus"]["Message"]
-                        self.poutput("")
-                        for line in message.splitlines():
-                            self.poutput(line)
-                        self.poutput("")
-                        self.poutput("---")
+            self.poutput(format_string_ig.format( instance_group_name, instance_group["InstanceType"], instance_group["Status"], instance_group["CurrentCount"], instance_group["TargetCount"] ))
+
+            if args.summary:
+                status_counts = status_counts_by_group.get(instance_group_name, {})
+                self.poutput("    " + ", ".join([ f"{status} : {count}" for status, count in sorted(status_counts.items()) ]))
+                self.poutput("")
+                continue
+
+            group_nodes = nodes_by_group.get(instance_group_name, [])
+
+            # resolve hostnames group by group, so output starts before all are resolved
+            if resolve_hostnames:
+                resolve_hostnames(group_nodes)
+
+            hostnames = Hostnames.instance()
+
+            max_hostname_len = 0
+            max_status_len = 0
+            for node in group_nodes:
+                hostname = hostnames.find_hostname(node.node_id)
+                if hostname:
+                    max_hostname_len = max(max_hostname_len,len(hostname))
+                max_status_len = max(max_status_len,len(node.status))
+
+            format_string_node = "    {} : {:<%d} : {:<%d} : {} : {}" % (max_hostname_len, max_status_len+1)
+
+            for node in group_nodes:
+
+                hostname = hostnames.find_hostname(node.node_id)
+                if hostname is None:
+                    hostname = ""
+                node_status = node.status
+                ssm_target = get_ssm_target(cluster_id, instance_group_name, node.node_id)
+
+                if node_status in ["Pending"]:
+                    node_status = "*" + node_status
+
+                self.poutput(format_string_node.format( node.node_id, hostname, node_status, time.strftime("%Y/%m/%d %H:%M:%S", time.localtime(node.launch_time)), ssm_target ))
+
+                if node.message:
+                    message = node.message
+                    self.poutput("")
+                    for line in message.splitlines():
+                        self.poutput(line)
+                    self.poutput("")
+                    self.poutput("---")
 
             self.poutput("")
 
-    argparser.set_defaults(func=_do_describe)
+
+    # ---
+
+    argparser = subparsers1.add_parser("snapshot", help="Save cluster and node state in the local snapshot store")
+    argparser.add_argument("cluster_name", metavar="CLUSTER_NAME", action="store", choices_provider=choices_cluster_names, help="Name of cluster")
+    argparser.add_argument("--interval", action="store", type=int, default=0, help="Keep taking snapshots at this interval in seconds")
+    argparser.add_argument("--list", action="store_true", default=False, help="List stored snapshots instead of taking one")
+
+    def _do_snapshot(self, args):
+
+        snapshot_store = SnapshotStore.instance()
+
+        if args.list:
+            for snapshot_id, snapshot_time, num_rows in snapshot_store.list(get_region(), get_account_id(), args.cluster_name):
+                snapshot_time = datetime.datetime.fromtimestamp(snapshot_time).astimezone()
+                self.poutput(f"{snapshot_id:>6} : {snapshot_time.strftime('%Y/%m/%d %H:%M:%S')} : {num_rows} node rows")
+            return
+
+        sagemaker_client = self.get_sagemaker_client()
+
+        try:
+            while True:
+
+                try:
+                    cluster = sagemaker_client.describe_cluster(
+                        ClusterName = args.cluster_name
+                    )
+                except sagemaker_client.exceptions.ResourceNotFound:
+                    self.poutput(f"Cluster [{args.cluster_name}] not found.")
+                    return
+
+                nodes = list_cluster_nodes_all( sagemaker_client, args.cluster_name )
+                snapshot_id = snapshot_store.save(cluster, nodes)
+
+                self.poutput(f"Saved snapshot {snapshot_id} of {args.cluster_name} ({len(nodes)} nodes)")
+
+                if not args.interval:
+                    break
+
+                time.sleep(args.interval)
+                ApiCallMemo.instance().clear()
+
+        except KeyboardInterrupt:
+            pass
+
+    argparser.set_defaults(func=_do_snapshot)
+
+
+    # ---
+
+    argparser = subparsers1.add_parser("diff", help="Show changes of a cluster since a snapshot")
+    argparser.add_argument("cluster_name", metavar="CLUSTER_NAME", action="store", choices_provider=choices_cluster_names, help="Name of cluster")
+    argparser.add_argument("--since", action="store", default=None, help="Compare with the latest snapshot at or before this time (e.g. 8h, 1d, '2024-01-31 09:00:00'). Default: previous snapshot")
+    argparser.add_argument("--cached", action="store_true", default=False, help="Compare with the latest snapshot instead of the current state, without calling APIs")
+
+    def _do_diff(self, args):
+
+        try:
+            since = parse_time_spec(args.since) if args.since else None
+        except ValueError as e:
+            self.poutput(str(e))
+            return
+
+        snapshot_store = SnapshotStore.instance()
+        region = get_region()
+        account_id = get_account_id()
+
+        if args.cached:
+            new_snapshot_id = snapshot_store.find(region, account_id, args.cluster_name)
+            if new_snapshot_id is None:
+                self.poutput(f"Snapshot of cluster [{args.cluster_name}] not found.")
+                return
+        else:
+            sagemaker_client = self.get_sagemaker_client()
+
+            try:
+                cluster = sagemaker_client.describe_cluster(
+                    ClusterName = args.cluster_name
+                )
+            except sagemaker_client.exceptions.ResourceNotFound:
+                self.poutput(f"Cluster [{args.cluster_name}] not found.")
+                return
+
+            nodes = list_cluster_nodes_all( sagemaker_client, args.cluster_name )
+            new_snapshot_id = snapshot_store.save(cluster, nodes)
+
+        old_snapshot_id = snapshot_store.find(region, account_id, args.cluster_name, before=since, exclude_snapshot_id=new_snapshot_id)
+        if old_snapshot_id is None:
+            self.poutput(f"No earlier snapshot of cluster [{args.cluster_name}] to compare with.")
+            return
+
+        old_time, old_cluster, old_nodes = snapshot_store.load(old_snapshot_id)
+        new_time, new_cluster, new_nodes = snapshot_store.load(new_snapshot_id)
+
+        changes = diff_cluster_snapshots(old_cluster, old_nodes, new_cluster, new_nodes)
+
+        self.poutput(f"Changes from {old_time.strftime('%Y/%m/%d %H:%M:%S')} to {new_time.strftime('%Y/%m/%d %H:%M:%S')}")
+        self.poutput("")
+
+        num_changes = 0
+
+        for key, old_value, new_value in changes["cluster"]:
+            self.poutput(f"Cluster {key} : {old_value} => {new_value}")
+            num_changes += 1
+
+        for instance_group_name, key, old_value, new_value in changes["instance_groups"]:
+            self.poutput(f"Instance group {instance_group_name} {key} : {old_value} => {new_value}")
+            num_changes += 1
+
+        for node in changes["added"]:
+            self.poutput(f"Added    : {node['InstanceGroupName']}/{node['InstanceId']} ({node['InstanceStatus']['Status']})")
+            num_changes += 1
+
+        for node in changes["removed"]:
+            self.poutput(f"Removed  : {node['InstanceGroupName']}/{node['InstanceId']}")
+            num_changes += 1
+
+        for old_node, new_node in changes["replaced"]:
+            self.poutput(f"Replaced : {old_node['InstanceGroupName']}/{old_node['InstanceId']} => {new_node['InstanceId']} ({new_node['InstanceStatus']['Status']})")
+            num_changes += 1
+
+        for old_node, new_node in changes["status_changed"]:
+            self.poutput(f"Status   : {new_node['InstanceGroupName']}/{new_node['InstanceId']} : {old_node['InstanceStatus']['Status']} => {new_node['InstanceStatus']['Status']}")
+            num_changes += 1
+
+        for old_node, new_node in changes["software_updated"]:
+            self.poutput(f"Software : {new_node['InstanceGroupName']}/{new_node['InstanceId']} : updated at {new_node.get('LastSoftwareUpdateTime')}")
+            num_changes += 1
+
+        if not num_changes:
+            self.poutput("No changes.")
+
+    argparser.set_defaults(func=_do_diff)
+
+
+    # ---
+
+    argparser = subparsers1.add_parser("top", help="Live dashboard of clusters, refreshed incrementally")
+    argparser.add_argument("cluster_names", metavar="CLUSTER_NAME", nargs="+", action="store", choices_provider=choices_cluster_names, help="Name of clusters")
+    argparser.add_argument("--budget", action="store", type=int, default=10, help="Maximum number of API calls per refresh")
+    argparser.add_argument("--min-interval", action="store", type=int, default=5, help="Refresh interval in seconds while clusters are changing")
+    argparser.add_argument("--max-interval", action="store", type=int, default=30, help="Refresh interval in seconds while clusters are quiet")
+
+    def _do_top(self, args):
+
+        sagemaker_client = self.get_sagemaker_client()
+        event_store = EventStore.instance()
+
+        watchers = [ ClusterWatcher(sagemaker_client, cluster_name) for cluster_name in args.cluster_names ]
+
+        state = {
+            "interval" : args.min_interval,
+            "num_calls" : 0,
+            "tick_time" : time.time(),
+            "error" : None,
+        }
+
+        def tick():
+
+            ApiCallMemo.instance().clear()
+
+            num_calls = 0
+            changed = False
+            state["error"] = None
+
+            # throttling and transient errors are shown in the status line, and retried
+            # in the next refresh
+            def try_refresh(watcher, refresh):
+                try:
+                    return refresh()
+                except (botocore.exceptions.ClientError, botocore.exceptions.BotoCoreError) as e:
+                    state["error"] = f"{watcher.cluster_name} : {str(e)}"
+                    return None
+
+            # cheap calls first, for all clusters
+            for watcher in watchers:
+                if num_calls < args.budget:
+                    changed |= bool(try_refresh(watcher, watcher.refresh_cluster))
+                    num_calls += 1
+
+            for watcher in watchers:
+                if num_calls < args.budget and watcher.error is None:
+                    events = try_refresh(watcher, watcher.refresh_events)
+                    if events:
+                        event_store.put_events(events)
+                        changed = True
+                    num_calls += 1
+
+            # node lists, oldest first, as long as the budget allows
+            for watcher in sorted(watchers, key=lambda watcher: watcher.nodes_time):
+                if watcher.nodes_stale and watcher.error is None:
+                    num_pages = watcher.get_node_pages_estimate()
+                    if num_calls + num_pages > args.budget and num_calls > 0:
+                        continue
+                    changed |= bool(try_refresh(watcher, watcher.refresh_nodes))
+                    num_calls += num_pages
+
+            if changed:
+                state["interval"] = args.min_interval
+            else:
+                state["interval"] = min(state["interval"] * 1.5, args.max_interval)
+
+            state["num_calls"] = num_calls
+            state["tick_time"] = time.time()
+
+        try:
+            tick()
+
+            with Live(self._render_top(watchers, state, args), auto_refresh=False, screen=True) as live:
+                while True:
+                    time.sleep(1)
+                    if time.time() - state["tick_time"] >= state["interval"]:
+                        tick()
+                    live.update(self._render_top(watchers, state, args), refresh=True)
+
+        except KeyboardInterrupt:
+            pass
+
+    argparser.set_defaults(func=_do_top)
+
+    def _render_top(self, watchers, state, args):
+
+        now = time.time()
+        renderables = []
+
+        for watcher in watchers:
+
+            if watcher.cluster is None or watcher.error:
+                renderables.append(Text(f"{watcher.cluster_name} : {watcher.error or 'Loading'}", style="bold"))
+                continue
+
+            cluster = watcher.cluster
+            title = f"{cluster['ClusterName']} : {cluster['ClusterStatus']} : nodes updated {int(now - watcher.nodes_time)}s ago"
+
+            status_counts = watcher.get_status_counts()
+            statuses = sorted(set([ status for group_counts in status_counts.values() for status in group_counts.keys() ]))
+
+            table = Table(title=title, title_justify="left", expand=True)
+            table.add_column("Instance group")
+            table.add_column("Type")
+            table.add_column("Status")
+            table.add_column("Current/Target", justify="right")
+            for status in statuses:
+                table.add_column(status, justify="right")
+
+            for instance_group in (cluster["InstanceGroups"] + cluster["RestrictedInstanceGroups"]):
+                group_counts = status_counts.get(instance_group["InstanceGroupName"], {})
+                table.add_row(
+                    instance_group["InstanceGroupName"],
+                    instance_group["InstanceType"],
+                    instance_group["Status"],
+                    f"{instance_group['CurrentCount']}/{instance_group['TargetCount']}",
+                    *[ str(group_counts.get(status, "")) for status in statuses ]
+                )
+
+            renderables.append(table)
+
+            if watcher.recent_changes:
+                lines = [ f"  {time.strftime('%H:%M:%S', time.localtime(change_time))} {description}" for change_time, description in watcher.recent_changes ]
+                renderables.append(Text("Recent node changes\n" + "\n".join(lines)))
+
+            if watcher.recent_events:
+                lines = [ f"  {event['EventTime'].astimezone().strftime('%H:%M:%S')} {event['ResourceType']} {event.get('InstanceGroupName', '')} {event.get('InstanceId', '')} {event['Description']}" for event in watcher.recent_events ]
+                renderables.append(Text("Recent events\n" + "\n".join(lines)))
+
+            renderables.append(Text(""))
+
+        next_tick = max(0, int(state["tick_time"] + state["interval"] - now))
+        renderables.append(Text(f"API calls in last refresh : {state['num_calls']}/{args.budget}, next refresh in {next_tick}s. Ctrl-C to exit.", style="dim"))
+        if state["error"]:
+            renderables.append(Text(f"Error in last refresh : {state['error']}", style="red"))
+
+        return Group(*renderables)
 
 
     # ---
@@ -756,6 +1218,7 @@ class HyperPodCommands:
                     break
 
                 time.sleep(5)
+                ApiCallMemo.instance().clear()
 
         else:
 
@@ -799,6 +1262,7 @@ class HyperPodCommands:
                     break
 
                 time.sleep(5)
+                ApiCallMemo.instance().clear()
 
     argparser.set_defaults(func=_do_wait)
 
@@ -814,28 +1278,31 @@ class HyperPodCommands:
         sagemaker_client = self.get_sagemaker_client()
         logs_client = get_boto3_client("logs")
 
-        try:
-            cluster = sagemaker_client.describe_cluster(
-                ClusterName = args.cluster_name
-            )
-        except sagemaker_client.exceptions.ResourceNotFound:
-            self.poutput(f"Cluster [{args.cluster_name}] not found.")
-            return
+        for retry in [False, True]:
 
-        cluster_id = cluster["ClusterArn"].split("/")[-1]
-        log_group = f"/aws/sagemaker/Clusters/{args.cluster_name}/{cluster_id}"
+            metadata = self.get_cluster_metadata(sagemaker_client, args.cluster_name)
+            if metadata is None:
+                self.poutput(f"Cluster [{args.cluster_name}] not found.")
+                return
 
-        try:
-            streams = list_log_streams_all(logs_client, log_group)
-        except logs_client.exceptions.ResourceNotFoundException:
-            self.poutput(f"Log group [{log_group}] not found.")
-            return
+            log_group = metadata["log_group"]
+
+            try:
+                streams = list_log_streams_all(logs_client, log_group)
+                break
+            except logs_client.exceptions.ResourceNotFoundException:
+                if retry:
+                    self.poutput(f"Log group [{log_group}] not found.")
+                    return
+
+                # the cached cluster may have been re-created, describe it again
+                ClusterMetadataCache.instance().invalidate(get_region(), get_account_id(), args.cluster_name)
 
         # Convert hostname to node id
         if args.node_id.startswith("ip-"):
             nodes = list_cluster_nodes_all( sagemaker_client, args.cluster_name )
             hostnames = Hostnames.instance()
-            hostnames.resolve(sagemaker_client, cluster, nodes)
+            hostnames.resolve_node_ids(sagemaker_client, args.cluster_name, [ node["InstanceId"] for node in nodes ])
             args.node_id = hostnames.get_node_id(args.node_id)
 
         found = False
@@ -867,44 +1334,71 @@ class HyperPodCommands:
     def _do_ssm(self, args):
 
         sagemaker_client = self.get_sagemaker_client()
+        region = get_region()
+        account_id = get_account_id()
+        metadata_cache = ClusterMetadataCache.instance()
 
-        try:
-            cluster = sagemaker_client.describe_cluster(
-                ClusterName = args.cluster_name
-            )
-        except sagemaker_client.exceptions.ResourceNotFound:
-            self.poutput(f"Cluster [{args.cluster_name}] not found.")
-            return
+        # Split instance group name part
+        instance_group_name = None
+        if "/" in args.node_id:
+            instance_group_name, args.node_id = args.node_id.rsplit("/", 1)
 
-        nodes = list_cluster_nodes_all( sagemaker_client, args.cluster_name )
+        # Build the SSM target from cached metadata without API calls, when the node ID is known
+        cluster_id = None
+        metadata = metadata_cache.get(region, account_id, args.cluster_name)
+        if metadata and not args.node_id.startswith("ip-"):
+            if instance_group_name is None:
+                instance_group_name = metadata["node_groups"].get(args.node_id)
+            if instance_group_name is not None:
+                cluster_id = metadata["cluster_id"]
+                node_id = args.node_id
 
-        cluster_id = cluster["ClusterArn"].split("/")[-1]
+        if cluster_id is None:
 
-        # Remove instance group name part
-        if "/" in args.node_id:
-            args.node_id = args.node_id.split("/")[-1]
+            metadata = None
 
-        # Convert hostname to node id
-        if args.node_id.startswith("ip-"):
-            hostnames = Hostnames.instance()
-            hostnames.resolve(sagemaker_client, cluster, nodes)
-            args.node_id = hostnames.get_node_id(args.node_id)
+            try:
+                cluster = sagemaker_client.describe_cluster(
+                    ClusterName = args.cluster_name
+                )
+            except sagemaker_client.exceptions.ResourceNotFound:
+                metadata_cache.invalidate(region, account_id, args.cluster_name)
+                self.poutput(f"Cluster [{args.cluster_name}] not found.")
+                return
 
-        for node in nodes:
-            instance_group_name = node["InstanceGroupName"]
-            node_id = node["InstanceId"]
-            if node_id==args.node_id:
-                break
-        else:
-            self.poutput(f"Node ID [{args.node_id}] not found.")
-            return
+            nodes = list_cluster_nodes_all( sagemaker_client, args.cluster_name )
+
+            metadata_cache.put_cluster(cluster)
+            metadata_cache.put_nodes(cluster, nodes)
+
+            cluster_id = cluster["ClusterArn"].split("/")[-1]
+
+            # Convert hostname to node id
+            if args.node_id.startswith("ip-"):
+                hostnames = Hostnames.instance()
+                hostnames.resolve(sagemaker_client, cluster, nodes)
+                args.node_id = hostnames.get_node_id(args.node_id)
+
+            for node in nodes:
+                instance_group_name = node["InstanceGroupName"]
+                node_id = node["InstanceId"]
+                if node_id==args.node_id:
+                    break
+            else:
+                self.poutput(f"Node ID [{args.node_id}] not found.")
+                return
 
-        ssm_target = f"sagemaker-cluster:{cluster_id}_{instance_group_name}-{node_id}"
+        ssm_target = get_ssm_target(cluster_id, instance_group_name, node_id)
 
         if 1:
             with self.sigint_protection:
                 cmd = ["aws", "ssm", "start-session", "--target", ssm_target]
-                subprocess.run(cmd)
+                with TraceRecorder.instance().span("ssm session", "ssm", { "target" : ssm_target }):
+                    result = subprocess.run(cmd)
+
+            # the cached cluster or node may be gone, look it up again next time
+            if metadata and result.returncode != 0:
+                metadata_cache.invalidate(region, account_id, args.cluster_name)
 
         # use pexpect to automatically switch to ubuntu user
         elif 0:
@@ -939,6 +1433,8 @@ class HyperPodCommands:
     argparser = subparsers2.add_parser('print-config', help='Print SSH config for cluster nodes')
     argparser.add_argument("cluster_name", metavar="CLUSTER_NAME", action="store", choices_provider=choices_cluster_names, help="Name of cluster")
     argparser.add_argument("user", metavar="USER", action="store", choices=["ubuntu","ec2-user"], help="User name")
+    argparser.add_argument("--identity-file", action="store", default=None, help="SSH private key file path to write in the config")
+    argparser.add_argument("--no-multiplexing", action="store_true", default=False, help="Don't add ControlMaster/ControlPersist settings")
 
     def _do_ssh_print_config(self, args):
 
@@ -956,7 +1452,12 @@ class HyperPodCommands:
 
         cluster_id = cluster["ClusterArn"].split("/")[-1]
 
-        profile = get_profile()
+        ssh_multiplexer = self.get_ssh_multiplexer()
+        proxy_command = ssh_multiplexer.get_proxy_command()
+
+        multiplexing_lines = []
+        if not args.no_multiplexing:
+            multiplexing_lines = ssh_multiplexer.get_config_lines()
 
         for instance_group in (cluster["InstanceGroups"] + cluster["RestrictedInstanceGroups"]):
             node_index = 0
@@ -968,11 +1469,15 @@ class HyperPodCommands:
 
                     self.poutput("")                
                     self.poutput(
-                        f"Host {args.cluster_name}-{instance_group_name}-{node_index}\n"
-                        f"    HostName sagemaker-cluster:{cluster_id}_{instance_group_name}-{node_id}\n"
-                        f"    User {args.user}\n"
-                        f"    IdentityFile ~/keys/842413447717-ec2.pem\n"
-                        f"    ProxyCommand aws --profile {profile} --region {get_region()} ssm start-session --target %h --document-name AWS-StartSSHSession --parameters portNumber=%p"
+                        format_ssh_config_entry(
+                            f"{args.cluster_name}-{instance_group_name}-{node_index}",
+                            get_ssm_target(cluster_id, instance_group_name, node_id),
+                            args.user,
+                            args.identity_file,
+                            proxy_command,
+                            multiplexing_lines,
+                        ),
+                        end=""
                     )
 
                     node_index += 1
@@ -982,6 +1487,247 @@ class HyperPodCommands:
     argparser.set_defaults(func=_do_ssh_print_config)
 
 
+    # ---
+
+    argparser = subparsers2.add_parser('sync-config', help='Maintain SSH config include files for cluster nodes under ~/.ssh/config.d')
+    argparser.add_argument("cluster_names", metavar="CLUSTER_NAME", nargs="*", action="store", default=[], choices_provider=choices_cluster_names, help="Name of clusters")
+    argparser.add_argument("--all", action="store_true", default=False, help="Sync all clusters in the region")
+    argparser.add_argument("--user", action="store", choices=["ubuntu","ec2-user"], default="ubuntu", help="User name (default: ubuntu)")
+    argparser.add_argument("--identity-file", action="store", default=None, help="SSH private key file path to write in the config")
+    argparser.add_argument("--no-multiplexing", action="store_true", default=False, help="Don't add ControlMaster/ControlPersist settings")
+    argparser.add_argument("--max-workers", action="store", type=int, default=8, help="Number of clusters to sync in parallel")
+
+    def _do_ssh_sync_config(self, args):
+
+        sagemaker_client = self.get_sagemaker_client()
+
+        cluster_names = args.cluster_names
+        if args.all:
+            cluster_names = [ cluster["ClusterName"] for cluster in list_clusters_all(sagemaker_client) ]
+
+        if not cluster_names:
+            self.poutput("Specify cluster names or --all.")
+            return
+
+        ssh_config_sync = SshConfigSync(
+            self.get_ssh_multiplexer(),
+            user=args.user,
+            identity_file=args.identity_file,
+            multiplexing=not args.no_multiplexing,
+        )
+
+        def sync_single_cluster(cluster_name):
+
+            try:
+                cluster = sagemaker_client.describe_cluster(
+                    ClusterName = cluster_name
+                )
+                nodes = list_cluster_nodes_all( sagemaker_client, cluster_name )
+            except sagemaker_client.exceptions.ResourceNotFound:
+                return cluster_name, None
+
+            return cluster_name, ssh_config_sync.sync(cluster, nodes)
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=args.max_workers) as thread_pool:
+            for cluster_name, result in thread_pool.map(sync_single_cluster, cluster_names):
+                if result is None:
+                    self.poutput(f"Cluster [{cluster_name}] not found.")
+                    continue
+                num_added, num_removed, num_unchanged = result
+                self.poutput(f"{ssh_config_sync.get_config_filename(cluster_name)} : {num_added} added, {num_removed} removed, {num_unchanged} unchanged")
+
+        # Include must be placed before any Host block in ~/.ssh/config
+        include_line = "Include ~/.ssh/config.d/*"
+        ssh_config_path = os.path.expanduser("~/.ssh/config")
+        ssh_config = ""
+        if os.path.exists(ssh_config_path):
+            with open(ssh_config_path) as fd:
+                ssh_config = fd.read()
+
+        if not re.search(r"^\s*Include\s+.*config\.d/", ssh_config, re.MULTILINE | re.IGNORECASE):
+            self.poutput("")
+            self.poutput(f"Add following line at the top of {ssh_config_path} to use these hosts:")
+            self.poutput(f"  {include_line}")
+
+    argparser.set_defaults(func=_do_ssh_sync_config)
+
+
+    # ---
+
+    def _resolve_node_ids(self, sagemaker_client, cluster, nodes, node_ids):
+
+        resolved_node_ids = []
+        for node_id in node_ids:
+
+            # Remove instance group name part
+            if "/" in node_id:
+                node_id = node_id.split("/")[-1]
+
+            # Convert hostname to node id
+            if node_id.startswith("ip-"):
+                hostnames = Hostnames.instance()
+                hostnames.resolve(sagemaker_client, cluster, nodes)
+                node_id = hostnames.get_node_id(node_id)
+
+            resolved_node_ids.append(node_id)
+
+        return resolved_node_ids
+
+    def _select_running_nodes(self, sagemaker_client, cluster, nodes, instance_group_name, instances):
+
+        node_ids = self._resolve_node_ids(sagemaker_client, cluster, nodes, instances)
+
+        selected_nodes = []
+        for node in nodes:
+            if instance_group_name and node["InstanceGroupName"] != instance_group_name:
+                continue
+            if node_ids and node["InstanceId"] not in node_ids:
+                continue
+            if node["InstanceStatus"]["Status"] != "Running":
+                continue
+            selected_nodes.append(node)
+
+        return selected_nodes
+
+    def _get_ssh_targets(self, cluster, nodes, user, identity_file):
+
+        ssh_multiplexer = self.get_ssh_multiplexer()
+        cluster_name = cluster["ClusterName"]
+        cluster_id = cluster["ClusterArn"].split("/")[-1]
+
+        targets = []
+        for node in nodes:
+            instance_group_name = node["InstanceGroupName"]
+            node_id = node["InstanceId"]
+            host_alias = f"{cluster_name}-{instance_group_name}-{node_id}"
+            ssm_target = get_ssm_target(cluster_id, instance_group_name, node_id)
+            targets.append( (host_alias, ssh_multiplexer.get_ssh_options(ssm_target, user, identity_file)) )
+
+        return targets
+
+
+    # ---
+
+    argparser = subparsers2.add_parser('connect', help='SSH to a cluster node through a shared master connection')
+    argparser.add_argument("cluster_name", metavar="CLUSTER_NAME", action="store", choices_provider=choices_cluster_names, help="Name of cluster")
+    argparser.add_argument("node_id", metavar="NODE_ID", action="store", choices_provider=choices_node_ids_without_cwlog, help="Id of node")
+    argparser.add_argument("--user", action="store", choices=["ubuntu","ec2-user","root"], default="ubuntu", help="User name (default: ubuntu)")
+    argparser.add_argument("--identity-file", action="store", default=None, completer=cmd2.Cmd.path_complete, help="SSH private key file")
+    argparser.add_argument("remote_command", metavar="COMMAND", nargs=argparse.REMAINDER, help="Command to run instead of a login shell")
+
+    def _do_ssh_connect(self, args):
+
+        sagemaker_client = self.get_sagemaker_client()
+        region = get_region()
+        account_id = get_account_id()
+        metadata_cache = ClusterMetadataCache.instance()
+
+        # Split instance group name part
+        instance_group_name = None
+        node_id = args.node_id
+        if "/" in node_id:
+            instance_group_name, node_id = node_id.rsplit("/", 1)
+
+        # Build the target from cached metadata without API calls, so that reconnecting
+        # through the master connection is immediate, as in 'hyperpod ssm'
+        if node_id.startswith("ip-"):
+            node_id = Hostnames.instance().find_node_id(node_id) or node_id
+
+        node = None
+        metadata = metadata_cache.get(region, account_id, args.cluster_name)
+        if metadata and not node_id.startswith("ip-"):
+            if instance_group_name is None:
+                instance_group_name = metadata["node_groups"].get(node_id)
+            if instance_group_name is not None:
+                cluster = { "ClusterName" : args.cluster_name, "ClusterArn" : metadata["cluster_arn"] }
+                node = { "InstanceId" : node_id, "InstanceGroupName" : instance_group_name }
+
+        if node is None:
+
+            try:
+                cluster = sagemaker_client.describe_cluster(
+                    ClusterName = args.cluster_name
+                )
+            except sagemaker_client.exceptions.ResourceNotFound:
+                metadata_cache.invalidate(region, account_id, args.cluster_name)
+                self.poutput(f"Cluster [{args.cluster_name}] not found.")
+                return
+
+            nodes = list_cluster_nodes_all( sagemaker_client, args.cluster_name )
+
+            metadata_cache.put_cluster(cluster)
+            metadata_cache.put_nodes(cluster, nodes)
+
+            node_id = self._resolve_node_ids(sagemaker_client, cluster, nodes, [node_id])[0]
+
+            for node in nodes:
+                if node["InstanceId"]==node_id:
+                    break
+            else:
+                self.poutput(f"Node ID [{node_id}] not found.")
+                return
+
+        host_alias, ssh_options = self._get_ssh_targets(cluster, [node], args.user, args.identity_file)[0]
+
+        # ControlPersist keeps the master alive after this session ends
+        self.get_ssh_multiplexer().track_master(host_alias, ssh_options)
+
+        with self.sigint_protection:
+            cmd = ["ssh", *ssh_options, host_alias, *args.remote_command]
+            subprocess.run(cmd)
+
+    argparser.set_defaults(func=_do_ssh_connect)
+
+
+    # ---
+
+    argparser = subparsers2.add_parser('warm', help='Pre-establish SSH master connections to cluster nodes')
+    argparser.add_argument("cluster_name", metavar="CLUSTER_NAME", action="store", choices_provider=choices_cluster_names, help="Name of cluster")
+    argparser.add_argument("--instance-group-name", action="store", required=False, choices_provider=choices_instance_group_names, help="Instance group name")
+    argparser.add_argument("--instances", nargs="+", action="store", required=False, default=[], choices_provider=choices_node_ids_without_cwlog, help="Instances to target")
+    argparser.add_argument("--user", action="store", choices=["ubuntu","ec2-user","root"], default="ubuntu", help="User name (default: ubuntu)")
+    argparser.add_argument("--identity-file", action="store", default=None, completer=cmd2.Cmd.path_complete, help="SSH private key file")
+    argparser.add_argument("--max-workers", action="store", type=int, default=16, help="Number of connections to establish in parallel")
+
+    def _do_ssh_warm(self, args):
+
+        sagemaker_client = self.get_sagemaker_client()
+
+        try:
+            cluster = sagemaker_client.describe_cluster(
+                ClusterName = args.cluster_name
+            )
+        except sagemaker_client.exceptions.ResourceNotFound:
+            self.poutput(f"Cluster [{args.cluster_name}] not found.")
+            return
+
+        nodes = list_cluster_nodes_all( sagemaker_client, args.cluster_name )
+
+        target_nodes = self._select_running_nodes(sagemaker_client, cluster, nodes, args.instance_group_name, args.instances)
+        targets = self._get_ssh_targets(cluster, target_nodes, args.user, args.identity_file)
+
+        self.poutput(f"Starting SSH master connections to {len(targets)} nodes")
+
+        for host_alias, ok, message, elapsed in self.get_ssh_multiplexer().warm(targets, max_workers=args.max_workers):
+            if ok:
+                self.poutput(f"  {host_alias} : ready ({elapsed:.1f}s)")
+            else:
+                self.poutput(f"  {host_alias} : failed : {message}")
+
+    argparser.set_defaults(func=_do_ssh_warm)
+
+
+    # ---
+
+    argparser = subparsers2.add_parser('close', help='Close SSH master connections started by this shell')
+
+    def _do_ssh_close(self, args):
+        num_closed = self.get_ssh_multiplexer().stop_all()
+        self.poutput(f"Closed {num_closed} SSH master connections")
+
+    argparser.set_defaults(func=_do_ssh_close)
+
+
     # ---
 
     argparser = subparsers2.add_parser('install-key', help='Install SSH public key to all cluster nodes')
@@ -1026,21 +1772,23 @@ class HyperPodCommands:
 
                 self.poutput(f"Installing ssh public key to {node_id} {authorized_keys_path}")
 
-                p = pexpect.popen_spawn.PopenSpawn([*self.aws_config.awscli, "ssm", "start-session", "--target", ssm_target])
-                p.expect(promt)
+                with TraceRecorder.instance().span("ssm session", "ssm", { "target" : ssm_target }):
 
-                cmd = [
-                    f'if ! grep -q "{public_key}" {authorized_keys_path}; then',
-                    f"  echo {public_key} >> {authorized_keys_path}",
-                    f"fi",
-                ]
+                    p = pexpect.popen_spawn.PopenSpawn([*self.aws_config.awscli, "ssm", "start-session", "--target", ssm_target])
+                    p.expect(promt)
 
-                for line in cmd:
-                    p.sendline(line)
+                    cmd = [
+                        f'if ! grep -q "{public_key}" {authorized_keys_path}; then',
+                        f"  echo {public_key} >> {authorized_keys_path}",
+                        f"fi",
+                    ]
 
-                p.expect(promt)
+                    for line in cmd:
+                        p.sendline(line)
 
-                p.kill(signal.SIGINT)
+                    p.expect(promt)
+
+                    p.kill(signal.SIGINT)
 
             for result in thread_pool.map(install_key_to_single_node, nodes):
                 pass
@@ -1114,23 +1862,25 @@ class HyperPodCommands:
             self.poutput(f"Running command in {node_id}")
             self.poutput("")
 
-            p = pexpect.popen_spawn.PopenSpawn([*self.aws_config.awscli, "ssm", "start-session", "--target", ssm_target])
-            
-            # Wait for first prompt
-            p.expect(["# "])
-            print_pexpect_output(p)
+            with TraceRecorder.instance().span("ssm session", "ssm", { "target" : ssm_target }):
 
-            # Customize prompt
-            p.sendline(f'export PS1="{custom_prompt}"')
-            p.expect("\n" + custom_prompt)
-            print_pexpect_output(p)
+                p = pexpect.popen_spawn.PopenSpawn([*self.aws_config.awscli, "ssm", "start-session", "--target", ssm_target])
+                
+                # Wait for first prompt
+                p.expect(["# "])
+                print_pexpect_output(p)
 
-            # Run command
-            p.sendline(args.command)
-            p.expect(custom_prompt)
-            print_pexpect_output(p)
+                # Customize prompt
+                p.sendline(f'export PS1="{custom_prompt}"')
+                p.expect("\n" + custom_prompt)
+                print_pexpect_output(p)
 
-            p.kill(signal.SIGINT)
+                # Run command
+                p.sendline(args.command)
+                p.expect(custom_prompt)
+                print_pexpect_output(p)
+
+                p.kill(signal.SIGINT)
 
             self.poutput("")
             self.poutput("")
@@ -1139,6 +1889,130 @@ class HyperPodCommands:
     argparser.set_defaults(func=_do_run)
 
 
+    # ---
+
+    def _print_transfer_results(self, results, elapsed):
+
+        format_string = "{:<%d} : {:<%d} : {:>10.1f} MB : {:>6.1f}s : {:>8.1f} MB/s" % (get_max_len(results,"host_alias"), get_max_len(results,"status"))
+
+        total_bytes = 0
+        num_failed = 0
+        for result in results:
+            mb = result["bytes"] / (1024 * 1024)
+            throughput = mb / result["seconds"] if result["seconds"] > 0 else 0.0
+            self.poutput(format_string.format(result["host_alias"], result["status"], mb, result["seconds"], throughput))
+            if result["status"]=="failed":
+                num_failed += 1
+                if result["message"]:
+                    self.poutput(f"    {result['message']}")
+            total_bytes += result["bytes"]
+
+        total_mb = total_bytes / (1024 * 1024)
+        self.poutput("")
+        self.poutput(f"Transferred {total_mb:.1f} MB to/from {len(results)-num_failed} nodes in {elapsed:.1f}s ({total_mb/max(elapsed,0.001):.1f} MB/s), {num_failed} failed")
+
+
+    # ---
+
+    argparser = subparsers1.add_parser("push", help="Copy a local file to cluster nodes in parallel")
+    argparser.add_argument("cluster_name", metavar="CLUSTER_NAME", action="store", choices_provider=choices_cluster_names, help="Name of cluster")
+    argparser.add_argument("local_path", metavar="LOCAL_PATH", action="store", completer=cmd2.Cmd.path_complete, help="Local file to copy")
+    argparser.add_argument("remote_path", metavar="REMOTE_PATH", action="store", help="Destination path on the nodes (ending with / to keep the file name)")
+    argparser.add_argument("--instance-group-name", action="store", required=False, choices_provider=choices_instance_group_names, help="Instance group name")
+    argparser.add_argument("--instances", nargs="+", action="store", required=False, default=[], choices_provider=choices_node_ids_without_cwlog, help="Instances to target")
+    argparser.add_argument("--user", action="store", choices=["ubuntu","ec2-user","root"], default="ubuntu", help="User name (default: ubuntu)")
+    argparser.add_argument("--identity-file", action="store", default=None, completer=cmd2.Cmd.path_complete, help="SSH private key file")
+    argparser.add_argument("--max-workers", action="store", type=int, default=16, help="Number of parallel transfers")
+    argparser.add_argument("--fanout", action="store", type=int, default=0, help="Copy to this many nodes from local, then let nodes which have the file copy it to the rest over the cluster network, doubling every round (requires SSH between nodes)")
+    argparser.add_argument("--force", action="store_true", default=False, help="Copy even if the node already has an identical file")
+
+    def _do_push(self, args):
+
+        local_path = os.path.expanduser(args.local_path)
+        if not os.path.isfile(local_path):
+            self.poutput(f"File [{local_path}] not found.")
+            return
+
+        sagemaker_client = self.get_sagemaker_client()
+
+        try:
+            cluster = sagemaker_client.describe_cluster(
+                ClusterName = args.cluster_name
+            )
+        except sagemaker_client.exceptions.ResourceNotFound:
+            self.poutput(f"Cluster [{args.cluster_name}] not found.")
+            return
+
+        nodes = list_cluster_nodes_all( sagemaker_client, args.cluster_name )
+
+        target_nodes = self._select_running_nodes(sagemaker_client, cluster, nodes, args.instance_group_name, args.instances)
+        targets = self._get_ssh_targets(cluster, target_nodes, args.user, args.identity_file)
+
+        peer_hostnames = {}
+        if args.fanout > 0:
+            hostnames = Hostnames.instance()
+            hostnames.resolve(sagemaker_client, cluster, target_nodes)
+            for (host_alias, ssh_options), node in zip(targets, target_nodes):
+                peer_hostnames[host_alias] = hostnames.get_hostname(node["InstanceId"])
+
+        self.poutput(f"Copying {local_path} to {args.remote_path} on {len(targets)} nodes")
+        self.poutput("")
+
+        t0 = time.time()
+        file_transfer = NodeFileTransfer(max_workers=args.max_workers)
+        results = file_transfer.push(targets, local_path, args.remote_path, fanout=args.fanout, peer_hostnames=peer_hostnames, force=args.force)
+
+        self._print_transfer_results(results, time.time() - t0)
+
+    argparser.set_defaults(func=_do_push)
+
+
+    # ---
+
+    argparser = subparsers1.add_parser("pull", help="Copy files from cluster nodes to local in parallel")
+    argparser.add_argument("cluster_name", metavar="CLUSTER_NAME", action="store", choices_provider=choices_cluster_names, help="Name of cluster")
+    argparser.add_argument("remote_path", metavar="REMOTE_PATH", action="store", help="Path on the nodes to copy (wildcards allowed, e.g. '/var/log/nccl*')")
+    argparser.add_argument("local_dir", metavar="LOCAL_DIR", action="store", completer=cmd2.Cmd.path_complete, help="Local directory. Files are stored in LOCAL_DIR/INSTANCE_GROUP/NODE_ID/")
+    argparser.add_argument("--instance-group-name", action="store", required=False, choices_provider=choices_instance_group_names, help="Instance group name")
+    argparser.add_argument("--instances", nargs="+", action="store", required=False, default=[], choices_provider=choices_node_ids_without_cwlog, help="Instances to target")
+    argparser.add_argument("--user", action="store", choices=["ubuntu","ec2-user","root"], default="ubuntu", help="User name (default: ubuntu)")
+    argparser.add_argument("--identity-file", action="store", default=None, completer=cmd2.Cmd.path_complete, help="SSH private key file")
+    argparser.add_argument("--max-workers", action="store", type=int, default=16, help="Number of parallel transfers")
+
+    def _do_pull(self, args):
+
+        sagemaker_client = self.get_sagemaker_client()
+
+        try:
+            cluster = sagemaker_client.describe_cluster(
+                ClusterName = args.cluster_name
+            )
+        except sagemaker_client.exceptions.ResourceNotFound:
+            self.poutput(f"Cluster [{args.cluster_name}] not found.")
+            return
+
+        nodes = list_cluster_nodes_all( sagemaker_client, args.cluster_name )
+
+        target_nodes = self._select_running_nodes(sagemaker_client, cluster, nodes, args.instance_group_name, args.instances)
+        targets = self._get_ssh_targets(cluster, target_nodes, args.user, args.identity_file)
+
+        local_dir = os.path.expanduser(args.local_dir)
+        local_dirnames = {}
+        for (host_alias, ssh_options), node in zip(targets, target_nodes):
+            local_dirnames[host_alias] = os.path.join(local_dir, node["InstanceGroupName"], node["InstanceId"])
+
+        self.poutput(f"Copying {args.remote_path} from {len(targets)} nodes to {local_dir}")
+        self.poutput("")
+
+        t0 = time.time()
+        file_transfer = NodeFileTransfer(max_workers=args.max_workers)
+        results = file_transfer.pull(targets, args.remote_path, local_dirnames)
+
+        self._print_transfer_results(results, time.time() - t0)
+
+    argparser.set_defaults(func=_do_pull)
+
+
     # ---
 
     #_search_capacity_regions = [ "us-east-1", "us-east-2", "us-west-2", "ap-northeast-1" ]
@@ -1200,17 +2074,13 @@ class HyperPodCommands:
 
         sagemaker_client = self.get_sagemaker_client()
 
-        try:
-            cluster = sagemaker_client.describe_cluster(
-                ClusterName = args.cluster_name
-            )
-        except sagemaker_client.exceptions.ResourceNotFound:
+        metadata = self.get_cluster_metadata(sagemaker_client, args.cluster_name)
+        if metadata is None:
             self.poutput(f"Cluster [{args.cluster_name}] not found.")
             return
         
-        try:
-            eks_arn = cluster["Orchestrator"]["Eks"]["ClusterArn"]
-        except KeyError:
+        eks_arn = metadata["eks_arn"]
+        if eks_arn is None:
             self.poutput(f"EKS cluster ARN not found in the HyperPod cluster description.")
             return
 
@@ -1218,7 +2088,7 @@ class HyperPodCommands:
 
         with self.sigint_protection:
             cmd = ["aws", "eks", "update-kubeconfig", "--name", eks_name]
-            subprocess.run(cmd)
+            traced_subprocess_run(cmd)
 
 
     argparser.set_defaults(func=_do_kubeconfig)
@@ -1229,33 +2099,177 @@ class HyperPodCommands:
     argparser = subparsers1.add_parser("events", help="Print historical events")
     argparser.add_argument("cluster_name", metavar="CLUSTER_NAME", action="store", choices_provider=choices_cluster_names, help="Name of HyperPod cluster")
     argparser.add_argument("--format", action="store", choices=["csv", "jsonl"], default="csv", help="Output format (csv or jsonl)")
-    argparser.add_argument("--details", action="store_true", help="Dump detailed JSON description of each event using describe-cluster-event API")
+    argparser.add_argument("--details", action="store_true", help="Dump detailed JSON description of each event using describe-cluster-event API (a details column with parquet and arrow output)")
+    argparser.add_argument("--max-workers", action="store", type=int, default=8, help="Number of parallel describe-cluster-event calls with --details")
+    argparser.add_argument("--max-rps", action="store", type=float, default=10.0, help="Maximum describe-cluster-event calls per second with --details (0 to disable)")
+    argparser.add_argument("--since", action="store", default=None, help="Only events after this time (e.g. 30m, 2h, 7d, 2024-01-31, '2024-01-31 12:00:00')")
+    argparser.add_argument("--until", action="store", default=None, help="Only events before this time (same formats as --since)")
+    argparser.add_argument("--new", action="store_true", default=False, help="Only events not printed by previous 'events' commands for this cluster")
+    argparser.add_argument("--follow", action="store_true", default=False, help="Keep polling and print new events as they arrive")
+    argparser.add_argument("--max-interval", action="store", type=int, default=60, help="Maximum polling interval in seconds with --follow")
+    argparser.add_argument("--output", action="store", choices=["text", "parquet", "arrow"], default="text", help="Output format. parquet and arrow write events to a columnar file at --output-file (requires pyarrow)")
+    argparser.add_argument("--output-file", action="store", default=None, completer=cmd2.Cmd.path_complete, help="Output file path for parquet and arrow output")
 
     def _do_events(self, args):
 
         sagemaker_client = self.get_sagemaker_client()
 
         try:
-            events = list_cluster_events_all( sagemaker_client, args.cluster_name )
-        except sagemaker_client.exceptions.ResourceNotFound:
-            self.poutput(f"Cluster [{args.cluster_name}] not found.")
+            event_time_after = parse_time_spec(args.since) if args.since else None
+            event_time_before = parse_time_spec(args.until) if args.until else None
+        except ValueError as e:
+            self.poutput(str(e))
             return
-        
+
+        if args.follow and event_time_before:
+            self.poutput("--follow and --until can't be used together.")
+            return
+
+        if args.follow and args.output != "text":
+            self.poutput(f"--follow can't be used with {args.output} output.")
+            return
+
+        event_store = EventStore.instance()
+        requested_time_after = event_time_after
+
+        for retry in [False, True]:
+
+            # cursors are keyed by ARN, so that a re-created cluster or a cluster in another
+            # account doesn't resume from a stale cursor
+            metadata = self.get_cluster_metadata(sagemaker_client, args.cluster_name)
+            if metadata is None:
+                self.poutput(f"Cluster [{args.cluster_name}] not found.")
+                return
+
+            cluster_arn = metadata["cluster_arn"]
+            cursor = event_store.get_cursor(cluster_arn) or EventCursor()
+
+            # a copy, as the cursor advances page by page with columnar output
+            new_only_cursor = EventCursor()
+            if args.new:
+                new_only_cursor = EventCursor(cursor.event_time, cursor.event_ids)
+
+            # push the cursor down to the API as a time filter
+            event_time_after = requested_time_after
+            query_time = new_only_cursor.get_query_time()
+            if query_time and (event_time_after is None or query_time > event_time_after):
+                event_time_after = query_time
+
+            fetch_time = time.time()
+            pages = list_cluster_events_pages( sagemaker_client, args.cluster_name, event_time_after=event_time_after, event_time_before=event_time_before )
+            try:
+                first_page = next(pages)
+            except sagemaker_client.exceptions.ResourceNotFound:
+                ClusterMetadataCache.instance().invalidate(get_region(), get_account_id(), args.cluster_name)
+                self.poutput(f"Cluster [{args.cluster_name}] not found.")
+                return
+
+            if retry or not first_page or first_page[0]["ClusterArn"] == cluster_arn:
+                break
+
+            # events of another ARN, the cached cluster was re-created, describe it again
+            ClusterMetadataCache.instance().invalidate(get_region(), get_account_id(), args.cluster_name)
+
+        pages = itertools.chain([first_page], pages)
+
+        if args.output != "text":
+            if not self._write_events_columnar(sagemaker_client, args, pages, new_only_cursor, cursor):
+                return
+        else:
+            events = [ event for page in pages for event in page ]
+            event_store.put_events(events)
+            events = new_only_cursor.filter(events)
+            self._print_events(sagemaker_client, args, events, header=True)
+            cursor.advance(events)
+
+        event_store.add_synced_range(
+            cluster_arn,
+            event_time_after.timestamp() if event_time_after else 0.0,
+            event_time_before.timestamp() if event_time_before else fetch_time
+        )
+
+        # remember the latest event unless the range was closed with --until
+        if event_time_before is None:
+            event_store.put_cursor(cluster_arn, cursor)
+
+        if not args.follow:
+            return
+
+        # Poll quickly while events are arriving, back off while quiet
+        min_interval = 5
+        interval = min_interval
+
+        try:
+            while True:
+
+                time.sleep(interval)
+                ApiCallMemo.instance().clear()
+
+                if not cursor.event_time:
+                    cursor.event_time = (event_time_after or datetime.datetime.now().astimezone()).timestamp()
+
+                fetch_time = time.time()
+                query_time = cursor.get_query_time()
+                events = list_cluster_events_all( sagemaker_client, args.cluster_name, event_time_after=query_time )
+                event_store.put_events(events)
+                event_store.add_synced_range(cluster_arn, query_time.timestamp(), fetch_time)
+                events = cursor.filter(events)
+
+                if events:
+                    events.sort(key=lambda event: event["EventTime"])
+                    self._print_events(sagemaker_client, args, events, header=False)
+                    cursor.advance(events)
+                    event_store.put_cursor(cluster_arn, cursor)
+                    interval = min_interval
+                else:
+                    interval = min(interval * 1.5, args.max_interval)
+
+        except KeyboardInterrupt:
+            pass
+
+    argparser.set_defaults(func=_do_events)
+
+    def _write_events_columnar(self, sagemaker_client, args, pages, new_only_cursor, cursor):
+
+        # write page by page without holding all events, with details when requested
+
+        columns = ColumnarWriter.event_details_columns if args.details else ColumnarWriter.event_columns
+        columnar_writer = self._open_columnar_writer(args, columns)
+        if columnar_writer is None:
+            return False
+
+        event_store = EventStore.instance()
+        token_bucket = TokenBucket(args.max_rps) if args.max_rps > 0 else None
+
+        with columnar_writer:
+            for page in pages:
+                event_store.put_events(page)
+                page = new_only_cursor.filter(page)
+
+                if args.details:
+                    details_by_id = {}
+                    for event_id, details, error in self._get_event_details(sagemaker_client, args.cluster_name, page, args.max_workers, token_bucket):
+                        if error is not None:
+                            self.poutput(f"Error fetching details for event {event_id}: {str(error)}")
+                            continue
+                        details_by_id[event_id] = details
+                    for event in page:
+                        event["Details"] = details_by_id.get(event["EventId"])
+
+                columnar_writer.write(page)
+                cursor.advance(page)
+
+        self.poutput(f"Wrote {columnar_writer.num_rows} events to {columnar_writer.filename}")
+        return True
+
+    def _print_events(self, sagemaker_client, args, events, header):
+
         if args.details:
-            # Fetch detailed event information using describe_cluster_event API
-            for event in events:
-                event_id = event["EventId"]
-                try:
-                    response = sagemaker_client.describe_cluster_event(
-                        ClusterName=args.cluster_name,
-                        EventId=event_id
-                    )
-                    self.poutput(json.dumps(response, default=str, indent=2))
-                except Exception as e:
-                    self.poutput(f"Error fetching details for event {event_id}: {str(e)}")
+            self._print_event_details(sagemaker_client, args.cluster_name, events, args.max_workers, args.max_rps)
         
         elif args.format == "csv":
-            self.poutput(f"Timestamp\tResourceType\tInstanceGroup\tInstance\tDescription")
+            if header:
+                self.poutput(f"Timestamp\tResourceType\tInstanceGroup\tInstance\tDescription")
             for event in events:
                 event_time = event["EventTime"]
                 resource_type = event["ResourceType"]
@@ -1269,8 +2283,159 @@ class HyperPodCommands:
             for event in events:
                 self.poutput(json.dumps(event, default=str))
 
+    # ---
 
-    argparser.set_defaults(func=_do_events)
+    argparser = subparsers1.add_parser("events-query", help="Query historical events in the local event store, across clusters")
+    argparser.add_argument("--cluster", nargs="+", action="store", default=[], choices_provider=choices_cluster_names, help="Cluster names (default: all clusters in the store)")
+    argparser.add_argument("--region", action="store", default=None, help="Region (default: all regions in the store)")
+    argparser.add_argument("--account", action="store", default=None, help="AWS account ID (default: all accounts in the store)")
+    argparser.add_argument("--since", action="store", default=None, help="Only events after this time (e.g. 30m, 2h, 7d, 2024-01-31)")
+    argparser.add_argument("--until", action="store", default=None, help="Only events before this time")
+    argparser.add_argument("--resource-type", action="store", default=None, help="Resource type (e.g. Cluster, InstanceGroup, Instance)")
+    argparser.add_argument("--instance-group-name", action="store", default=None, help="Instance group name")
+    argparser.add_argument("--instance-id", action="store", default=None, help="Instance ID")
+    argparser.add_argument("--match", action="store", default=None, help="Text to search in descriptions (e.g. 'replace')")
+    argparser.add_argument("--group-by", nargs="+", action="store", default=[], choices=list(EventStore.query_columns.keys()), help="Count events grouped by these columns")
+    argparser.add_argument("--limit", action="store", type=int, default=None, help="Maximum number of rows")
+    argparser.add_argument("--format", action="store", choices=["csv", "jsonl"], default="csv", help="Output format (csv or jsonl)")
+    argparser.add_argument("--refresh", action="store_true", default=False, help="Fetch events missing from the store since --since (or from the beginning), of the clusters in the current region and account, before querying")
+
+    def _do_events_query(self, args):
+
+        try:
+            since = parse_time_spec(args.since) if args.since else None
+            until = parse_time_spec(args.until) if args.until else None
+        except ValueError as e:
+            self.poutput(str(e))
+            return
+
+        event_store = EventStore.instance()
+
+        if args.refresh:
+            self._refresh_event_store(event_store, args.cluster, since)
+
+        column_names, rows = event_store.query(
+            cluster_names=args.cluster,
+            region=args.region,
+            account_id=args.account,
+            since=since,
+            until=until,
+            resource_type=args.resource_type,
+            instance_group_name=args.instance_group_name,
+            instance_id=args.instance_id,
+            match=args.match,
+            group_by=args.group_by,
+            limit=args.limit,
+        )
+
+        if not args.group_by:
+            rows = [ (datetime.datetime.fromtimestamp(row[0]).astimezone(), *row[1:]) for row in rows ]
+
+        if args.format=="csv":
+            self.poutput("\t".join(column_names))
+            for row in rows:
+                self.poutput("\t".join([ str(value) for value in row ]))
+
+        elif args.format=="jsonl":
+            for row in rows:
+                self.poutput(json.dumps(dict(zip(column_names, row)), default=str))
+
+    argparser.set_defaults(func=_do_events_query)
+
+    def _refresh_event_store(self, event_store, cluster_names, since):
+
+        sagemaker_client = self.get_sagemaker_client()
+
+        # events are stored by ARN, so that a re-created cluster or a cluster of another
+        # account with the same name has its own sync range
+        if cluster_names:
+            cluster_arns = {}
+            for cluster_name in cluster_names:
+                metadata = self.get_cluster_metadata(sagemaker_client, cluster_name)
+                if metadata is not None:
+                    cluster_arns[cluster_name] = metadata["cluster_arn"]
+        else:
+            cluster_arns = { cluster["ClusterName"] : cluster["ClusterArn"] for cluster in list_clusters_all(sagemaker_client) }
+
+        def fetch_missing_events(cluster_name, cluster_arn):
+
+            # backfill before the synced range if since is older, then catch up to now
+            fetch_time = time.time()
+            for range_from, range_until in event_store.get_unsynced_ranges(cluster_arn, since.timestamp() if since else 0.0, fetch_time):
+                try:
+                    events = list_cluster_events_all(
+                        sagemaker_client,
+                        cluster_name,
+                        event_time_after = datetime.datetime.fromtimestamp(range_from, tz=datetime.timezone.utc) if range_from else None,
+                        event_time_before = datetime.datetime.fromtimestamp(range_until, tz=datetime.timezone.utc) if range_until < fetch_time else None,
+                    )
+                except sagemaker_client.exceptions.ResourceNotFound:
+                    return
+                event_store.put_events(events)
+                event_store.add_synced_range(cluster_arn, range_from, range_until)
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=8) as thread_pool:
+            for _ in thread_pool.map(fetch_missing_events, cluster_arns.keys(), cluster_arns.values()):
+                pass
+
+    def _print_event_details(self, sagemaker_client, cluster_name, events, max_workers, max_rps):
+
+        # 0 disables the limit, as api_max_rps
+        token_bucket = TokenBucket(max_rps) if max_rps > 0 else None
+
+        for event_id, details, error in self._get_event_details(sagemaker_client, cluster_name, events, max_workers, token_bucket):
+
+            if error is not None:
+                self.poutput(f"Error fetching details for event {event_id}: {str(error)}")
+                continue
+
+            self.poutput(json.dumps(details, default=str, indent=2))
+
+    def _get_event_details(self, sagemaker_client, cluster_name, events, max_workers, token_bucket):
+
+        # yields (event ID, details, error) in the order of events
+
+        if not events:
+            return
+
+        # Events are immutable. Fetch details only for events not in the local store yet.
+        cluster_arn = events[0]["ClusterArn"]
+        event_store = EventStore.instance()
+        cached_details = event_store.get_details(cluster_arn, [ event["EventId"] for event in events ])
+
+        def describe_single_event(event):
+
+            event_id = event["EventId"]
+            if event_id in cached_details:
+                return event_id, cached_details[event_id], None
+
+            if token_bucket is not None:
+                token_bucket.acquire()
+            try:
+                response = sagemaker_client.describe_cluster_event(
+                    ClusterName=cluster_name,
+                    EventId=event_id
+                )
+            except Exception as e:
+                return event_id, None, e
+
+            response.pop("ResponseMetadata", None)
+            return event_id, response, None
+
+        new_details = []
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as thread_pool:
+            for event_id, details, error in thread_pool.map(describe_single_event, events):
+
+                yield event_id, details, error
+
+                if error is None and event_id not in cached_details:
+                    new_details.append((event_id, details))
+                    if len(new_details) >= 100:
+                        event_store.put_details(cluster_arn, new_details)
+                        new_details = []
+
+        event_store.put_details(cluster_arn, new_details)
 
 
     # ---
@@ -1,10 +1,23 @@
 import os
+import sys
+import time
+import datetime
+import collections
+import json
+import shlex
+import hashlib
+import sqlite3
+import tempfile
+import subprocess
+import threading
 
 import concurrent.futures
 import boto3
 
 import misc
 
+from .aws_misc import *
+
 
 def list_clusters_all(sagemaker_client):
 
@@ -33,6 +46,16 @@ def list_clusters_all(sagemaker_client):
 def list_cluster_nodes_all(sagemaker_client, cluster_name):
 
     nodes = []
+    for page in list_cluster_nodes_pages(sagemaker_client, cluster_name):
+        nodes += page
+
+    return nodes
+
+
+def list_cluster_nodes_pages(sagemaker_client, cluster_name):
+
+    # yields nodes page by page, for consumers which can start before all pages arrive
+
     next_token = None
 
     while True:
@@ -43,9 +66,10 @@ def list_cluster_nodes_all(sagemaker_client, cluster_name):
         if next_token:
             params["NextToken"] = next_token
 
-        response = sagemaker_client.list_cluster_nodes(**params)
+        with TraceRecorder.instance().span("list_cluster_nodes page", "page", { "cluster" : cluster_name }):
+            response = sagemaker_client.list_cluster_nodes(**params)
 
-        nodes += response["ClusterNodeSummaries"]
+        yield response["ClusterNodeSummaries"]
 
         if "NextToken" in response and response["NextToken"]:
             next_token = response["NextToken"]
@@ -53,12 +77,20 @@ def list_cluster_nodes_all(sagemaker_client, cluster_name):
 
         break
 
-    return nodes
-
 
-def list_cluster_events_all(sagemaker_client, cluster_name):
+def list_cluster_events_all(sagemaker_client, cluster_name, event_time_after=None, event_time_before=None):
 
     events = []
+    for page in list_cluster_events_pages(sagemaker_client, cluster_name, event_time_after, event_time_before):
+        events += page
+
+    return events
+
+
+def list_cluster_events_pages(sagemaker_client, cluster_name, event_time_after=None, event_time_before=None):
+
+    # yields events page by page, for consumers which can start before all pages arrive
+
     next_token = None
 
     while True:
@@ -66,12 +98,17 @@ def list_cluster_events_all(sagemaker_client, cluster_name):
         params = {
             "ClusterName" : cluster_name
         }
+        if event_time_after:
+            params["EventTimeAfter"] = event_time_after
+        if event_time_before:
+            params["EventTimeBefore"] = event_time_before
         if next_token:
             params["NextToken"] = next_token
 
-        response = sagemaker_client.list_cluster_events(**params)
+        with TraceRecorder.instance().span("list_cluster_events page", "page", { "cluster" : cluster_name }):
+            response = sagemaker_client.list_cluster_events(**params)
 
-        events += response["Events"]
+        yield response["Events"]
 
         if "NextToken" in response and response["NextToken"]:
             next_token = response["NextToken"]
@@ -79,8 +116,6 @@ def list_cluster_events_all(sagemaker_client, cluster_name):
 
         break
 
-    return events
-
 
 def list_log_streams_all(logs_client, log_group):
 
@@ -128,14 +163,13 @@ class Hostnames:
         self.hostname_to_node_id = {}
 
     def resolve(self, sagemaker_client, cluster, nodes):
+        self.resolve_node_ids(sagemaker_client, cluster["ClusterName"], [ node["InstanceId"] for node in nodes ])
 
-        cluster_name = cluster["ClusterName"]
+    def resolve_node_ids(self, sagemaker_client, cluster_name, node_ids):
 
         with concurrent.futures.ThreadPoolExecutor(max_workers=16) as thread_pool:
             
-            def resolve_hostname(node):
-
-                node_id = node["InstanceId"]
+            def resolve_hostname(node_id):
 
                 if node_id in self.node_id_to_hostname and self.node_id_to_hostname[node_id]:
                     return self.node_id_to_hostname[node_id]
@@ -145,14 +179,1464 @@ class Hostnames:
 
                 return hostname
 
-            for node, hostname in zip( nodes, thread_pool.map(resolve_hostname, nodes) ):
-                node_id = node["InstanceId"]
+            for node_id, hostname in zip( node_ids, thread_pool.map(resolve_hostname, node_ids) ):
                 self.node_id_to_hostname[node_id] = hostname
                 self.hostname_to_node_id[hostname] = node_id
 
+    def add(self, node_id, hostname):
+        self.node_id_to_hostname[node_id] = hostname
+        self.hostname_to_node_id[hostname] = node_id
+
     def get_hostname(self, node_id):
         return self.node_id_to_hostname[node_id]
 
+    def find_hostname(self, node_id):
+        # None for nodes not resolved yet (e.g. snapshots without stored hostnames)
+        return self.node_id_to_hostname.get(node_id)
+
     def get_node_id(self, hostname):
         return self.hostname_to_node_id[hostname]
 
+    def find_node_id(self, hostname):
+        # None for hostnames not resolved yet in this session
+        return self.hostname_to_node_id.get(hostname)
+
+
+class NodeRecord:
+
+    # Compact form of a ClusterNodeSummaries entry, for node lists held across commands.
+    # Instance group names, instance types and statuses are interned, times are epoch seconds.
+    # Convert from/to boto3 dicts only where nodes come from or go to APIs and stores.
+
+    __slots__ = ("node_id", "instance_group_name", "instance_type", "status", "message", "launch_time", "last_software_update_time")
+
+    def __init__(self, node_id, instance_group_name, instance_type, status, message=None, launch_time=0.0, last_software_update_time=None):
+        self.node_id = node_id
+        self.instance_group_name = sys.intern(instance_group_name)
+        self.instance_type = sys.intern(instance_type)
+        self.status = sys.intern(status)
+        self.message = message if message else None
+        self.launch_time = launch_time
+        self.last_software_update_time = last_software_update_time
+
+    @staticmethod
+    def from_node(node):
+
+        last_software_update_time = node.get("LastSoftwareUpdateTime")
+        if last_software_update_time is not None:
+            last_software_update_time = last_software_update_time.timestamp()
+
+        return NodeRecord(
+            node["InstanceId"],
+            node["InstanceGroupName"],
+            node["InstanceType"],
+            node["InstanceStatus"]["Status"],
+            node["InstanceStatus"].get("Message"),
+            node["LaunchTime"].timestamp(),
+            last_software_update_time,
+        )
+
+    def to_node(self):
+
+        node = {
+            "InstanceGroupName" : self.instance_group_name,
+            "InstanceId" : self.node_id,
+            "InstanceStatus" : { "Status" : self.status },
+            "InstanceType" : self.instance_type,
+            "LaunchTime" : datetime.datetime.fromtimestamp(self.launch_time).astimezone(),
+        }
+
+        if self.message:
+            node["InstanceStatus"]["Message"] = self.message
+
+        if self.last_software_update_time is not None:
+            node["LastSoftwareUpdateTime"] = datetime.datetime.fromtimestamp(self.last_software_update_time).astimezone()
+
+        return node
+
+
+class EventCursor:
+
+    # Time of the latest seen event, and IDs of the events at that time.
+    # Multiple events can share a timestamp, so the time alone is not enough to dedupe.
+
+    def __init__(self, event_time=0.0, event_ids=None):
+        self.event_time = event_time
+        self.event_ids = set(event_ids or [])
+
+    def get_query_time(self):
+
+        if not self.event_time:
+            return None
+
+        # step back a second, filter() drops what was already seen
+        return datetime.datetime.fromtimestamp(self.event_time - 1, tz=datetime.timezone.utc)
+
+    def filter(self, events):
+
+        new_events = []
+        for event in events:
+            event_time = event["EventTime"].timestamp()
+            if event_time < self.event_time:
+                continue
+            if event_time==self.event_time and event["EventId"] in self.event_ids:
+                continue
+            new_events.append(event)
+
+        return new_events
+
+    def advance(self, events):
+
+        for event in events:
+            event_time = event["EventTime"].timestamp()
+            if event_time > self.event_time:
+                self.event_time = event_time
+                self.event_ids = set()
+            if event_time==self.event_time:
+                self.event_ids.add(event["EventId"])
+
+
+class EventStore:
+
+    _instance = None
+
+    @staticmethod
+    def instance():
+        if EventStore._instance is None:
+            EventStore._instance = EventStore()
+        return EventStore._instance
+
+    def __init__(self, filename=None):
+
+        if filename is None:
+            filename = os.path.expanduser("~/.cshell/events.db")
+
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(filename, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+
+        # cluster events are immutable, so details are cached forever
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS event_details ("
+            "  cluster_arn TEXT NOT NULL,"
+            "  event_id TEXT NOT NULL,"
+            "  details TEXT NOT NULL,"
+            "  PRIMARY KEY (cluster_arn, event_id)"
+            ")"
+        )
+
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS events ("
+            "  cluster_arn TEXT NOT NULL,"
+            "  event_id TEXT NOT NULL,"
+            "  region TEXT NOT NULL,"
+            "  cluster_name TEXT NOT NULL,"
+            "  instance_group_name TEXT NOT NULL,"
+            "  instance_id TEXT NOT NULL,"
+            "  resource_type TEXT NOT NULL,"
+            "  event_time REAL NOT NULL,"
+            "  description TEXT NOT NULL,"
+            "  PRIMARY KEY (cluster_arn, event_id)"
+            ")"
+        )
+        self.db.execute("CREATE INDEX IF NOT EXISTS events_cluster ON events (cluster_name, event_time)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS events_instance_group ON events (instance_group_name, event_time)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS events_instance ON events (instance_id, event_time)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS events_resource_type ON events (resource_type, event_time)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS events_time ON events (event_time)")
+
+        # position of the latest event already printed, per cluster ARN
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS event_cursors ("
+            "  cluster_key TEXT PRIMARY KEY,"
+            "  event_time REAL NOT NULL,"
+            "  event_ids TEXT NOT NULL"
+            ")"
+        )
+
+        # Time range in which all events were fetched, per cluster ARN. synced_from is 0
+        # when fetched from the beginning. Fetches which don't overlap the range don't
+        # extend it, so a windowed fetch is never taken as a full sync.
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS event_sync ("
+            "  cluster_arn TEXT PRIMARY KEY,"
+            "  synced_from REAL NOT NULL,"
+            "  synced_until REAL NOT NULL"
+            ")"
+        )
+        self.db.commit()
+
+    def get_cursor(self, cluster_arn):
+
+        with self.lock:
+            row = self.db.execute("SELECT event_time, event_ids FROM event_cursors WHERE cluster_key=?", (cluster_arn,)).fetchone()
+
+        if row is None:
+            return None
+
+        return EventCursor(row[0], json.loads(row[1]))
+
+    def put_cursor(self, cluster_arn, cursor):
+
+        with self.lock:
+            self.db.execute(
+                "INSERT OR REPLACE INTO event_cursors (cluster_key, event_time, event_ids) VALUES (?,?,?)",
+                (cluster_arn, cursor.event_time, json.dumps(sorted(cursor.event_ids)))
+            )
+            self.db.commit()
+
+    def put_events(self, events):
+
+        rows = []
+        for event in events:
+            cluster_arn = event["ClusterArn"]
+            rows.append((
+                cluster_arn,
+                event["EventId"],
+                cluster_arn.split(":")[3],
+                event["ClusterName"],
+                event.get("InstanceGroupName", ""),
+                event.get("InstanceId", ""),
+                event["ResourceType"],
+                event["EventTime"].timestamp(),
+                event["Description"],
+            ))
+
+        with self.lock:
+            self.db.executemany(
+                "INSERT OR IGNORE INTO events (cluster_arn, event_id, region, cluster_name, instance_group_name, instance_id, resource_type, event_time, description) VALUES (?,?,?,?,?,?,?,?,?)",
+                rows
+            )
+            self.db.commit()
+
+    def get_synced_range(self, cluster_arn):
+
+        with self.lock:
+            return self.db.execute("SELECT synced_from, synced_until FROM event_sync WHERE cluster_arn=?", (cluster_arn,)).fetchone()
+
+    def add_synced_range(self, cluster_arn, synced_from, synced_until):
+
+        with self.lock:
+            row = self.db.execute("SELECT synced_from, synced_until FROM event_sync WHERE cluster_arn=?", (cluster_arn,)).fetchone()
+            if row is not None:
+                if synced_from <= row[1] and synced_until >= row[0]:
+                    synced_from, synced_until = min(synced_from, row[0]), max(synced_until, row[1])
+                elif synced_until < row[0]:
+                    # older and disjoint, the more recent range is kept
+                    return
+
+            self.db.execute(
+                "INSERT OR REPLACE INTO event_sync (cluster_arn, synced_from, synced_until) VALUES (?,?,?)",
+                (cluster_arn, synced_from, synced_until)
+            )
+            self.db.commit()
+
+    def get_unsynced_ranges(self, cluster_arn, since, until):
+
+        # (from, until) ranges to fetch, so that events from since to until are all in the store
+
+        row = self.get_synced_range(cluster_arn)
+        if row is None:
+            return [ (since, until) ]
+
+        ranges = []
+        if since < row[0]:
+            ranges.append((since, min(row[0], until)))
+        if row[1] < until:
+            ranges.append((max(row[1], since), until))
+        return ranges
+
+    # column names usable in query()
+    query_columns = {
+        "region" : "region",
+        "cluster" : "cluster_name",
+        "instance-group" : "instance_group_name",
+        "instance" : "instance_id",
+        "resource-type" : "resource_type",
+        "description" : "description",
+        "day" : "date(event_time, 'unixepoch', 'localtime')",
+    }
+
+    def query(self, cluster_names=[], region=None, account_id=None, since=None, until=None, resource_type=None, instance_group_name=None, instance_id=None, match=None, group_by=[], limit=None):
+
+        # Returns (column names, rows)
+
+        conditions = []
+        params = []
+
+        if cluster_names:
+            conditions.append("cluster_name IN (%s)" % ",".join(["?"] * len(cluster_names)))
+            params += cluster_names
+        if region:
+            conditions.append("region=?")
+            params.append(region)
+        if account_id:
+            # arn:aws:sagemaker:REGION:ACCOUNT:cluster/ID
+            conditions.append("cluster_arn LIKE ?")
+            params.append(f"arn:%:sagemaker:%:{account_id}:cluster/%")
+        if since:
+            conditions.append("event_time>=?")
+            params.append(since.timestamp())
+        if until:
+            conditions.append("event_time<?")
+            params.append(until.timestamp())
+        if resource_type:
+            conditions.append("resource_type=?")
+            params.append(resource_type)
+        if instance_group_name:
+            conditions.append("instance_group_name=?")
+            params.append(instance_group_name)
+        if instance_id:
+            conditions.append("instance_id=?")
+            params.append(instance_id)
+        if match:
+            conditions.append("description LIKE ?")
+            params.append(f"%{match}%")
+
+        where = ""
+        if conditions:
+            where = "WHERE " + " AND ".join(conditions)
+
+        if group_by:
+            group_columns = [ self.query_columns[key] for key in group_by ]
+            column_names = [ *group_by, "count" ]
+            sql = f"SELECT {', '.join(group_columns)}, COUNT(*) FROM events {where} GROUP BY {', '.join(group_columns)} ORDER BY COUNT(*) DESC"
+        else:
+            column_names = [ "time", "cluster", "resource-type", "instance-group", "instance", "description" ]
+            sql = f"SELECT event_time, cluster_name, resource_type, instance_group_name, instance_id, description FROM events {where} ORDER BY event_time"
+
+        if limit:
+            sql += f" LIMIT {int(limit)}"
+
+        with self.lock:
+            rows = self.db.execute(sql, params).fetchall()
+
+        return column_names, rows
+
+    def get_details(self, cluster_arn, event_ids):
+
+        details = {}
+
+        with self.lock:
+            # stay under SQLite's limit of host parameters
+            for i in range(0, len(event_ids), 500):
+                chunk = event_ids[i:i+500]
+                placeholders = ",".join(["?"] * len(chunk))
+                for event_id, d in self.db.execute(f"SELECT event_id, details FROM event_details WHERE cluster_arn=? AND event_id IN ({placeholders})", [cluster_arn, *chunk]):
+                    details[event_id] = json.loads(d)
+
+        return details
+
+    def put_details(self, cluster_arn, details):
+
+        # details : list of (event_id, dict)
+
+        with self.lock:
+            self.db.executemany(
+                "INSERT OR REPLACE INTO event_details (cluster_arn, event_id, details) VALUES (?,?,?)",
+                [ (cluster_arn, event_id, json.dumps(d, default=str)) for event_id, d in details ]
+            )
+            self.db.commit()
+
+
+class SnapshotStore:
+
+    # Snapshots of describe_cluster + list_cluster_nodes results.
+    #
+    # Cluster descriptions and node summaries are stored once per distinct content
+    # in "blobs" (deduplicated by hash). A snapshot refers to them through
+    # "snapshot_nodes" rows: a keyframe snapshot lists all nodes, and the other
+    # snapshots list only nodes added, changed (new hash) or removed (NULL hash)
+    # since the previous snapshot of the same cluster. Snapshots are looked up by
+    # account (from the ARN), region and cluster name, and chains older than
+    # retention_days are pruned.
+
+    _instance = None
+
+    @staticmethod
+    def instance():
+        if SnapshotStore._instance is None:
+            SnapshotStore._instance = SnapshotStore()
+        return SnapshotStore._instance
+
+    keyframe_interval = 20
+
+    retention_days = 30
+
+    datetime_keys = [ "LaunchTime", "LastSoftwareUpdateTime", "CreationTime" ]
+
+    def __init__(self, filename=None):
+
+        if filename is None:
+            filename = os.path.expanduser("~/.cshell/snapshots.db")
+
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(filename, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS blobs ("
+            "  hash TEXT PRIMARY KEY,"
+            "  data TEXT NOT NULL"
+            ")"
+        )
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS snapshots ("
+            "  snapshot_id INTEGER PRIMARY KEY AUTOINCREMENT,"
+            "  region TEXT NOT NULL,"
+            "  cluster_name TEXT NOT NULL,"
+            "  cluster_arn TEXT NOT NULL,"
+            "  snapshot_time REAL NOT NULL,"
+            "  parent_id INTEGER,"
+            "  chain_length INTEGER NOT NULL,"
+            "  cluster_hash TEXT NOT NULL"
+            ")"
+        )
+        self.db.execute("CREATE INDEX IF NOT EXISTS snapshots_cluster ON snapshots (region, cluster_name, snapshot_time)")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS snapshot_nodes ("
+            "  snapshot_id INTEGER NOT NULL,"
+            "  node_id TEXT NOT NULL,"
+            "  hash TEXT,"
+            "  PRIMARY KEY (snapshot_id, node_id)"
+            ")"
+        )
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS hostnames ("
+            "  node_id TEXT PRIMARY KEY,"
+            "  hostname TEXT NOT NULL"
+            ")"
+        )
+        self.db.commit()
+
+        # node_id -> hash of the latest snapshot, per snapshot id
+        self.node_hashes_cache = {}
+
+    def _put_blob(self, d):
+        data = json.dumps(d, default=str, sort_keys=True)
+        h = hashlib.sha1(data.encode("utf-8")).hexdigest()
+        self.db.execute("INSERT OR IGNORE INTO blobs (hash, data) VALUES (?,?)", (h, data))
+        return h
+
+    def _get_blob(self, h):
+        data = self.db.execute("SELECT data FROM blobs WHERE hash=?", (h,)).fetchone()[0]
+        d = json.loads(data)
+        for key in self.datetime_keys:
+            if key in d and isinstance(d[key], str):
+                d[key] = datetime.datetime.fromisoformat(d[key])
+        return d
+
+    def _get_node_hashes(self, snapshot_id):
+
+        if snapshot_id in self.node_hashes_cache:
+            return dict(self.node_hashes_cache[snapshot_id])
+
+        # walk back to the keyframe, then apply deltas forward
+        chain = []
+        while snapshot_id is not None:
+            chain.append(snapshot_id)
+            snapshot_id = self.db.execute("SELECT parent_id FROM snapshots WHERE snapshot_id=?", (snapshot_id,)).fetchone()[0]
+
+        node_hashes = {}
+        for snapshot_id in reversed(chain):
+            for node_id, h in self.db.execute("SELECT node_id, hash FROM snapshot_nodes WHERE snapshot_id=?", (snapshot_id,)):
+                if h is None:
+                    node_hashes.pop(node_id, None)
+                else:
+                    node_hashes[node_id] = h
+
+        self.node_hashes_cache = { chain[0] : node_hashes }
+        return dict(node_hashes)
+
+    def save(self, cluster, nodes, snapshot_time=None):
+
+        if snapshot_time is None:
+            snapshot_time = time.time()
+
+        cluster = dict(cluster)
+        cluster.pop("ResponseMetadata", None)
+
+        cluster_arn = cluster["ClusterArn"]
+        region = cluster_arn.split(":")[3]
+        cluster_name = cluster["ClusterName"]
+
+        with self.lock:
+
+            cluster_hash = self._put_blob(cluster)
+            node_hashes = { node["InstanceId"] : self._put_blob(node) for node in nodes }
+
+            parent = self.db.execute(
+                "SELECT snapshot_id, chain_length FROM snapshots WHERE region=? AND cluster_name=? AND cluster_arn=? ORDER BY snapshot_time DESC, snapshot_id DESC LIMIT 1",
+                (region, cluster_name, cluster_arn)
+            ).fetchone()
+
+            if parent is None or parent[1] + 1 >= self.keyframe_interval:
+                parent_id = None
+                chain_length = 0
+                rows = list(node_hashes.items())
+            else:
+                parent_id = parent[0]
+                chain_length = parent[1] + 1
+                parent_node_hashes = self._get_node_hashes(parent_id)
+                rows = [ (node_id, h) for node_id, h in node_hashes.items() if parent_node_hashes.get(node_id) != h ]
+                rows += [ (node_id, None) for node_id in parent_node_hashes.keys() if node_id not in node_hashes ]
+
+            cursor = self.db.execute(
+                "INSERT INTO snapshots (region, cluster_name, cluster_arn, snapshot_time, parent_id, chain_length, cluster_hash) VALUES (?,?,?,?,?,?,?)",
+                (region, cluster_name, cluster_arn, snapshot_time, parent_id, chain_length, cluster_hash)
+            )
+            snapshot_id = cursor.lastrowid
+
+            self.db.executemany(
+                "INSERT INTO snapshot_nodes (snapshot_id, node_id, hash) VALUES (?,?,?)",
+                [ (snapshot_id, node_id, h) for node_id, h in rows ]
+            )
+            self.db.commit()
+
+            self.node_hashes_cache = { snapshot_id : node_hashes }
+
+            self._prune(cluster_arn, snapshot_time - self.retention_days * 24 * 60 * 60)
+
+        return snapshot_id
+
+    def _prune(self, cluster_arn, before):
+
+        # Deltas depend on earlier snapshots back to their keyframe, so only chains
+        # before the latest keyframe taken at or before the time are deleted.
+        keyframe = self.db.execute(
+            "SELECT snapshot_id FROM snapshots WHERE cluster_arn=? AND parent_id IS NULL AND snapshot_time<=? ORDER BY snapshot_id DESC LIMIT 1",
+            (cluster_arn, before)
+        ).fetchone()
+        if keyframe is None:
+            return
+
+        snapshot_ids = [ row[0] for row in self.db.execute("SELECT snapshot_id FROM snapshots WHERE cluster_arn=? AND snapshot_id<?", (cluster_arn, keyframe[0])) ]
+        if not snapshot_ids:
+            return
+
+        self.db.executemany("DELETE FROM snapshot_nodes WHERE snapshot_id=?", [ (snapshot_id,) for snapshot_id in snapshot_ids ])
+        self.db.executemany("DELETE FROM snapshots WHERE snapshot_id=?", [ (snapshot_id,) for snapshot_id in snapshot_ids ])
+        self.db.execute(
+            "DELETE FROM blobs WHERE hash NOT IN (SELECT cluster_hash FROM snapshots) AND hash NOT IN (SELECT hash FROM snapshot_nodes WHERE hash IS NOT NULL)"
+        )
+        self.db.commit()
+
+    @staticmethod
+    def _get_arn_pattern(region, account_id):
+        return f"arn:%:sagemaker:{region}:{account_id}:cluster/%"
+
+    def find(self, region, account_id, cluster_name, before=None, exclude_snapshot_id=None):
+
+        # latest snapshot taken at or before the time
+
+        sql = "SELECT snapshot_id FROM snapshots WHERE region=? AND cluster_name=? AND cluster_arn LIKE ?"
+        params = [region, cluster_name, self._get_arn_pattern(region, account_id)]
+        if before is not None:
+            sql += " AND snapshot_time<=?"
+            params.append(before.timestamp())
+        if exclude_snapshot_id is not None:
+            sql += " AND snapshot_id!=?"
+            params.append(exclude_snapshot_id)
+        sql += " ORDER BY snapshot_time DESC, snapshot_id DESC LIMIT 1"
+
+        with self.lock:
+            row = self.db.execute(sql, params).fetchone()
+
+        return row[0] if row else None
+
+    def list(self, region, account_id, cluster_name):
+
+        with self.lock:
+            return self.db.execute(
+                "SELECT snapshot_id, snapshot_time, (SELECT COUNT(*) FROM snapshot_nodes WHERE snapshot_nodes.snapshot_id=snapshots.snapshot_id) FROM snapshots WHERE region=? AND cluster_name=? AND cluster_arn LIKE ? ORDER BY snapshot_time, snapshot_id",
+                (region, cluster_name, self._get_arn_pattern(region, account_id))
+            ).fetchall()
+
+    def load(self, snapshot_id):
+
+        # Returns (snapshot time, cluster, nodes)
+
+        with self.lock:
+            snapshot_time, cluster_hash = self.db.execute("SELECT snapshot_time, cluster_hash FROM snapshots WHERE snapshot_id=?", (snapshot_id,)).fetchone()
+            cluster = self._get_blob(cluster_hash)
+            nodes = [ self._get_blob(h) for h in self._get_node_hashes(snapshot_id).values() ]
+
+        return datetime.datetime.fromtimestamp(snapshot_time).astimezone(), cluster, nodes
+
+    def put_hostnames(self, hostnames):
+
+        with self.lock:
+            self.db.executemany("INSERT OR REPLACE INTO hostnames (node_id, hostname) VALUES (?,?)", list(hostnames.items()))
+            self.db.commit()
+
+    def get_hostnames(self, node_ids):
+
+        hostnames = {}
+        with self.lock:
+            for node_id in node_ids:
+                row = self.db.execute("SELECT hostname FROM hostnames WHERE node_id=?", (node_id,)).fetchone()
+                if row:
+                    hostnames[node_id] = row[0]
+
+        return hostnames
+
+
+class ClusterMetadataCache:
+
+    # Facts which don't change for the lifetime of a cluster (ARN, ID, log group,
+    # EKS ARN, instance group of each node), persisted so that commands can skip
+    # describe_cluster. Entries are keyed by account, region and cluster name, and
+    # dropped when the cluster is not found, or when describe_cluster returns a
+    # different ARN (cluster re-created).
+
+    _instance = None
+
+    @staticmethod
+    def instance():
+        if ClusterMetadataCache._instance is None:
+            ClusterMetadataCache._instance = ClusterMetadataCache()
+        return ClusterMetadataCache._instance
+
+    def __init__(self, filename=None):
+
+        if filename is None:
+            filename = os.path.expanduser("~/.cshell/cluster_metadata.json")
+
+        self.filename = filename
+        self.lock = threading.Lock()
+
+        try:
+            with open(self.filename) as f:
+                self.entries = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            self.entries = {}
+
+        # drop entries written without account
+        self.entries = { key : entry for key, entry in self.entries.items() if key.count("/")==2 }
+
+    def _save(self):
+        write_file_atomically(self.filename, json.dumps(self.entries, indent=2))
+
+    @staticmethod
+    def _get_key(region, account_id, cluster_name):
+        return f"{account_id}/{region}/{cluster_name}"
+
+    @staticmethod
+    def _get_cluster_key(cluster):
+        # arn:aws:sagemaker:REGION:ACCOUNT:cluster/ID
+        arn_fields = cluster["ClusterArn"].split(":")
+        return ClusterMetadataCache._get_key(arn_fields[3], arn_fields[4], cluster["ClusterName"])
+
+    def get(self, region, account_id, cluster_name):
+        with self.lock:
+            return self.entries.get(self._get_key(region, account_id, cluster_name))
+
+    def put_cluster(self, cluster):
+
+        cluster_name = cluster["ClusterName"]
+        cluster_arn = cluster["ClusterArn"]
+        cluster_id = cluster_arn.split("/")[-1]
+
+        eks_arn = None
+        if "Orchestrator" in cluster and "Eks" in cluster["Orchestrator"]:
+            eks_arn = cluster["Orchestrator"]["Eks"]["ClusterArn"]
+
+        with self.lock:
+            key = self._get_cluster_key(cluster)
+            entry = self.entries.get(key)
+
+            if entry and entry["cluster_arn"] == cluster_arn and entry["eks_arn"] == eks_arn:
+                return entry
+
+            # new or re-created cluster, node mapping is not valid anymore
+            entry = {
+                "cluster_arn" : cluster_arn,
+                "cluster_id" : cluster_id,
+                "log_group" : f"/aws/sagemaker/Clusters/{cluster_name}/{cluster_id}",
+                "eks_arn" : eks_arn,
+                "node_groups" : {},
+            }
+            self.entries[key] = entry
+            self._save()
+
+            return entry
+
+    def put_nodes(self, cluster, nodes):
+
+        with self.lock:
+            entry = self.entries.get(self._get_cluster_key(cluster))
+            if entry is None:
+                return
+
+            node_groups = { node["InstanceId"] : node["InstanceGroupName"] for node in nodes }
+            if node_groups != entry["node_groups"]:
+                entry["node_groups"] = node_groups
+                self._save()
+
+    def invalidate(self, region, account_id, cluster_name):
+        with self.lock:
+            if self.entries.pop(self._get_key(region, account_id, cluster_name), None) is not None:
+                self._save()
+
+
+def diff_cluster_snapshots(old_cluster, old_nodes, new_cluster, new_nodes):
+
+    # Returns a dict of changes between two cluster states
+
+    old_nodes_by_id = { node["InstanceId"] : node for node in old_nodes }
+    new_nodes_by_id = { node["InstanceId"] : node for node in new_nodes }
+
+    added = [ node for node_id, node in new_nodes_by_id.items() if node_id not in old_nodes_by_id ]
+    removed = [ node for node_id, node in old_nodes_by_id.items() if node_id not in new_nodes_by_id ]
+
+    # a node removed and another added in the same instance group is counted as replacement
+    replaced = []
+    added_by_group = {}
+    for node in added:
+        added_by_group.setdefault(node["InstanceGroupName"], []).append(node)
+    for node in list(removed):
+        candidates = added_by_group.get(node["InstanceGroupName"])
+        if candidates:
+            new_node = candidates.pop(0)
+            replaced.append((node, new_node))
+            removed.remove(node)
+            added.remove(new_node)
+
+    status_changed = []
+    software_updated = []
+    for node_id, new_node in new_nodes_by_id.items():
+        old_node = old_nodes_by_id.get(node_id)
+        if old_node is None:
+            continue
+        if old_node["InstanceStatus"]["Status"] != new_node["InstanceStatus"]["Status"]:
+            status_changed.append((old_node, new_node))
+        if old_node.get("LastSoftwareUpdateTime") != new_node.get("LastSoftwareUpdateTime"):
+            software_updated.append((old_node, new_node))
+
+    instance_group_changes = []
+    old_groups = { g["InstanceGroupName"] : g for g in old_cluster.get("InstanceGroups", []) + old_cluster.get("RestrictedInstanceGroups", []) }
+    new_groups = { g["InstanceGroupName"] : g for g in new_cluster.get("InstanceGroups", []) + new_cluster.get("RestrictedInstanceGroups", []) }
+    for name in sorted(set(old_groups.keys()) | set(new_groups.keys())):
+        old_group = old_groups.get(name, {})
+        new_group = new_groups.get(name, {})
+        for key in [ "Status", "CurrentCount", "TargetCount", "InstanceType", "CurrentImageId", "DesiredImageId", "SoftwareUpdateStatus" ]:
+            if old_group.get(key) != new_group.get(key):
+                instance_group_changes.append((name, key, old_group.get(key), new_group.get(key)))
+
+    cluster_changes = []
+    for key in [ "ClusterStatus", "FailureMessage", "NodeRecovery" ]:
+        if old_cluster.get(key) != new_cluster.get(key):
+            cluster_changes.append((key, old_cluster.get(key), new_cluster.get(key)))
+
+    return {
+        "cluster" : cluster_changes,
+        "instance_groups" : instance_group_changes,
+        "added" : added,
+        "removed" : removed,
+        "replaced" : replaced,
+        "status_changed" : status_changed,
+        "software_updated" : software_updated,
+    }
+
+
+def diff_node_records(old_records, new_records):
+
+    # Node changes of diff_cluster_snapshots(), compared on NodeRecord fields without
+    # converting the records back to dicts
+
+    old_records_by_id = { record.node_id : record for record in old_records }
+    new_records_by_id = { record.node_id : record for record in new_records }
+
+    added = [ record for node_id, record in new_records_by_id.items() if node_id not in old_records_by_id ]
+    removed = [ record for node_id, record in old_records_by_id.items() if node_id not in new_records_by_id ]
+
+    # a node removed and another added in the same instance group is counted as replacement
+    replaced = []
+    added_by_group = {}
+    for record in added:
+        added_by_group.setdefault(record.instance_group_name, []).append(record)
+    for record in list(removed):
+        candidates = added_by_group.get(record.instance_group_name)
+        if candidates:
+            new_record = candidates.pop(0)
+            replaced.append((record, new_record))
+            removed.remove(record)
+            added.remove(new_record)
+
+    status_changed = []
+    for node_id, new_record in new_records_by_id.items():
+        old_record = old_records_by_id.get(node_id)
+        if old_record is not None and old_record.status != new_record.status:
+            status_changed.append((old_record, new_record))
+
+    return {
+        "added" : added,
+        "removed" : removed,
+        "replaced" : replaced,
+        "status_changed" : status_changed,
+    }
+
+
+class ClusterWatcher:
+
+    # Keeps the latest known state of a cluster for live views, and refreshes only
+    # what may have changed. describe_cluster is cheap and tells whether instance
+    # groups are settled; the node list is re-fetched only when they are not, when
+    # counts changed, or when the node list gets too old.
+
+    def __init__(self, sagemaker_client, cluster_name, full_refresh_interval=300, max_changes=10, max_events=10):
+
+        self.sagemaker_client = sagemaker_client
+        self.cluster_name = cluster_name
+        self.full_refresh_interval = full_refresh_interval
+
+        self.cluster = None
+        self.nodes = []
+        self.nodes_time = 0
+        self.nodes_stale = True
+        self.error = None
+
+        self.recent_changes = collections.deque(maxlen=max_changes)
+        self.recent_events = collections.deque(maxlen=max_events)
+        self.event_cursor = EventCursor(time.time() - 60 * 60)
+
+    def get_group_signature(self, cluster):
+        return [ (g["InstanceGroupName"], g["Status"], g["CurrentCount"], g["TargetCount"]) for g in cluster["InstanceGroups"] + cluster["RestrictedInstanceGroups"] ]
+
+    def is_settled(self, cluster):
+        if cluster["ClusterStatus"] not in ["InService", "Failed"]:
+            return False
+        for g in cluster["InstanceGroups"] + cluster["RestrictedInstanceGroups"]:
+            if g["Status"] not in ["InService", "Failed"] or g["CurrentCount"] != g["TargetCount"]:
+                return False
+        return True
+
+    def refresh_cluster(self):
+
+        # Returns True when something changed
+
+        try:
+            cluster = self.sagemaker_client.describe_cluster(ClusterName=self.cluster_name)
+        except self.sagemaker_client.exceptions.ResourceNotFound:
+            self.error = "Cluster not found"
+            return False
+
+        self.error = None
+        changed = self.cluster is None or self.get_group_signature(cluster) != self.get_group_signature(self.cluster) or cluster["ClusterStatus"] != self.cluster["ClusterStatus"]
+
+        if changed or not self.is_settled(cluster) or time.time() - self.nodes_time > self.full_refresh_interval:
+            self.nodes_stale = True
+
+        self.cluster = cluster
+        return changed
+
+    def get_node_pages_estimate(self):
+        if self.cluster is None:
+            return 1
+        num_nodes = sum([ g["CurrentCount"] for g in self.cluster["InstanceGroups"] + self.cluster["RestrictedInstanceGroups"] ])
+        return num_nodes // 100 + 1
+
+    def refresh_nodes(self):
+
+        # convert page by page, so full boto3 dicts are never held for the whole cluster
+        nodes = []
+        for page in list_cluster_nodes_pages(self.sagemaker_client, self.cluster_name):
+            nodes += [ NodeRecord.from_node(node) for node in page ]
+
+        if self.nodes_time:
+            now = time.time()
+            changes = diff_node_records(self.nodes, nodes)
+            for node in changes["added"]:
+                self.recent_changes.append((now, f"{node.instance_group_name}/{node.node_id} added ({node.status})"))
+            for node in changes["removed"]:
+                self.recent_changes.append((now, f"{node.instance_group_name}/{node.node_id} removed"))
+            for old_node, new_node in changes["replaced"]:
+                self.recent_changes.append((now, f"{old_node.instance_group_name}/{old_node.node_id} replaced by {new_node.node_id}"))
+            for old_node, new_node in changes["status_changed"]:
+                self.recent_changes.append((now, f"{new_node.instance_group_name}/{new_node.node_id} {old_node.status} => {new_node.status}"))
+            changed = bool(changes["added"] or changes["removed"] or changes["replaced"] or changes["status_changed"])
+        else:
+            changed = False
+
+        self.nodes = nodes
+        self.nodes_time = time.time()
+        self.nodes_stale = False
+
+        return changed
+
+    def refresh_events(self):
+
+        events = list_cluster_events_all(self.sagemaker_client, self.cluster_name, event_time_after=self.event_cursor.get_query_time())
+        events = self.event_cursor.filter(events)
+        events.sort(key=lambda event: event["EventTime"])
+
+        self.event_cursor.advance(events)
+        for event in events:
+            self.recent_events.append(event)
+
+        return events
+
+    def get_status_counts(self):
+
+        # instance group name -> { status -> count }, in one pass over the nodes
+
+        counts = {}
+        for node in self.nodes:
+            group_counts = counts.setdefault(node.instance_group_name, {})
+            group_counts[node.status] = group_counts.get(node.status, 0) + 1
+
+        return counts
+
+
+def get_ssm_target(cluster_id, instance_group_name, node_id):
+    return f"sagemaker-cluster:{cluster_id}_{instance_group_name}-{node_id}"
+
+
+class SshMultiplexer:
+
+    _instance = None
+
+    @staticmethod
+    def instance():
+        if SshMultiplexer._instance is None:
+            SshMultiplexer._instance = SshMultiplexer()
+        return SshMultiplexer._instance
+
+    def __init__(self):
+
+        user_config = misc.UserConfig.instance()
+        self.on_user_config_reloaded(user_config)
+        user_config.add_reload_listener(self.on_user_config_reloaded)
+
+        self.control_dir = os.path.expanduser("~/.cshell/ssh")
+        self.control_persist = "10m"
+
+        # masters started by this shell, to be closed on exit
+        self.started_masters = {}
+        self.lock = threading.Lock()
+
+    def on_user_config_reloaded(self, user_config):
+        self.aws_config = user_config.get("AwsConfig")
+
+    def get_control_path(self):
+
+        # %C is a hash of local host, remote host, port and user. It keeps the path
+        # short enough for unix domain sockets even with long SSM target names.
+        return os.path.join(self.control_dir, "cm-%C")
+
+    def get_proxy_command(self):
+        awscli = " ".join(self.aws_config.awscli)
+        return f"{awscli} --profile {get_profile()} --region {get_region()} ssm start-session --target %h --document-name AWS-StartSSHSession --parameters portNumber=%p"
+
+    def get_config_lines(self):
+
+        os.makedirs(self.control_dir, exist_ok=True)
+
+        return [
+            f"ControlMaster auto",
+            f"ControlPath {self.get_control_path()}",
+            f"ControlPersist {self.control_persist}",
+        ]
+
+    def get_ssh_options(self, ssm_target, user, identity_file=None):
+
+        os.makedirs(self.control_dir, exist_ok=True)
+
+        options = {
+            "HostName" : ssm_target,
+            "User" : user,
+            "ProxyCommand" : self.get_proxy_command(),
+            "ControlMaster" : "auto",
+            "ControlPath" : self.get_control_path(),
+            "ControlPersist" : self.control_persist,
+        }
+
+        if identity_file:
+            options["IdentityFile"] = os.path.expanduser(identity_file)
+
+        ssh_options = []
+        for key, value in options.items():
+            ssh_options += ["-o", f"{key}={value}"]
+
+        return ssh_options
+
+    def is_master_running(self, host_alias, ssh_options):
+        cmd = ["ssh", *ssh_options, "-O", "check", host_alias]
+        result = traced_subprocess_run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        return result.returncode==0
+
+    def start_master(self, host_alias, ssh_options):
+
+        if not self.is_master_running(host_alias, ssh_options):
+
+            # -f -N : authenticate, then keep only the master connection in background
+            cmd = ["ssh", *ssh_options, "-o", "BatchMode=yes", "-f", "-N", host_alias]
+            result = traced_subprocess_run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+            if result.returncode != 0:
+                return False, result.stderr.decode("utf-8").strip()
+
+        with self.lock:
+            self.started_masters[host_alias] = ssh_options
+
+        return True, ""
+
+    def warm(self, targets, max_workers=16):
+
+        # targets : list of (host_alias, ssh_options)
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as thread_pool:
+
+            def warm_single_master(target):
+                host_alias, ssh_options = target
+                t0 = time.time()
+                ok, message = self.start_master(host_alias, ssh_options)
+                return host_alias, ok, message, time.time() - t0
+
+            return list(thread_pool.map(warm_single_master, targets))
+
+    def track_master(self, host_alias, ssh_options):
+        with self.lock:
+            self.started_masters[host_alias] = ssh_options
+
+    def stop_all(self):
+
+        with self.lock:
+            started_masters = self.started_masters
+            self.started_masters = {}
+
+        for host_alias, ssh_options in started_masters.items():
+            cmd = ["ssh", *ssh_options, "-O", "exit", host_alias]
+            traced_subprocess_run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+        return len(started_masters)
+
+
+def format_ssh_config_entry(host_alias, ssm_target, user, identity_file, proxy_command, extra_lines=None):
+
+    lines = [
+        f"Host {host_alias}",
+        f"    HostName {ssm_target}",
+        f"    User {user}",
+    ]
+
+    if identity_file:
+        lines.append(f"    IdentityFile {identity_file}")
+
+    lines.append(f"    ProxyCommand {proxy_command}")
+
+    for line in extra_lines or []:
+        lines.append(f"    {line}")
+
+    return "\n".join(lines) + "\n"
+
+
+def write_file_atomically(filename, data):
+
+    dirname = os.path.dirname(filename)
+    os.makedirs(dirname, exist_ok=True)
+
+    # write to a temporary file in the same directory, then rename over the target
+    fd, tmp_filename = tempfile.mkstemp(dir=dirname, prefix="." + os.path.basename(filename) + ".")
+    try:
+        with os.fdopen(fd, "w") as f:
+            f.write(data)
+        os.replace(tmp_filename, filename)
+    except BaseException:
+        os.unlink(tmp_filename)
+        raise
+
+
+class SshConfigSync:
+
+    def __init__(self, ssh_multiplexer, user, identity_file=None, multiplexing=True):
+
+        self.config_dir = os.path.expanduser("~/.ssh/config.d")
+        self.snapshot_dir = os.path.expanduser("~/.cshell/ssh_sync")
+
+        self.user = user
+        self.identity_file = identity_file
+        self.proxy_command = ssh_multiplexer.get_proxy_command()
+        self.extra_lines = []
+        if multiplexing:
+            self.extra_lines = ssh_multiplexer.get_config_lines()
+
+    def get_config_filename(self, cluster_name):
+        return os.path.join(self.config_dir, f"hyperpod-{cluster_name}")
+
+    def get_snapshot_filename(self, cluster_name):
+        return os.path.join(self.snapshot_dir, f"{cluster_name}.json")
+
+    def load_snapshot(self, cluster_name):
+        try:
+            with open(self.get_snapshot_filename(cluster_name)) as fd:
+                return json.load(fd)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+    def sync(self, cluster, nodes):
+
+        # Returns (added, removed, unchanged) node counts
+
+        cluster_name = cluster["ClusterName"]
+        cluster_arn = cluster["ClusterArn"]
+        cluster_id = cluster_arn.split("/")[-1]
+
+        settings = {
+            "user" : self.user,
+            "identity_file" : self.identity_file,
+            "proxy_command" : self.proxy_command,
+            "extra_lines" : self.extra_lines,
+        }
+
+        snapshot = self.load_snapshot(cluster_name)
+
+        # cluster recreated with the same name, or settings changed : regenerate everything
+        previous_entries = {}
+        invalidated = True
+        if snapshot and snapshot["cluster_arn"]==cluster_arn and snapshot["settings"]==settings:
+            previous_entries = snapshot["nodes"]
+            invalidated = False
+
+        # keep host aliases stable for existing nodes, fill the gaps for new ones
+        used_indices = {}
+        for node in nodes:
+            previous_entry = previous_entries.get(node["InstanceId"])
+            if previous_entry and previous_entry["instance_group"]==node["InstanceGroupName"]:
+                used_indices.setdefault(node["InstanceGroupName"], set()).add(previous_entry["index"])
+
+        entries = {}
+        num_added = 0
+        num_unchanged = 0
+
+        for node in nodes:
+
+            instance_group_name = node["InstanceGroupName"]
+            node_id = node["InstanceId"]
+
+            previous_entry = previous_entries.get(node_id)
+            if previous_entry and previous_entry["instance_group"]==instance_group_name:
+                entries[node_id] = previous_entry
+                num_unchanged += 1
+                continue
+
+            indices = used_indices.setdefault(instance_group_name, set())
+            node_index = 0
+            while node_index in indices:
+                node_index += 1
+            indices.add(node_index)
+
+            entries[node_id] = {
+                "instance_group" : instance_group_name,
+                "index" : node_index,
+                "entry" : format_ssh_config_entry(
+                    f"{cluster_name}-{instance_group_name}-{node_index}",
+                    get_ssm_target(cluster_id, instance_group_name, node_id),
+                    self.user,
+                    self.identity_file,
+                    self.proxy_command,
+                    self.extra_lines,
+                ),
+            }
+            num_added += 1
+
+        num_removed = len(set(previous_entries.keys()) - set(entries.keys()))
+
+        if invalidated or num_added or num_removed:
+
+            sorted_entries = sorted(entries.values(), key=lambda entry: (entry["instance_group"], entry["index"]))
+
+            config = f"# Generated by CraftShell for HyperPod cluster {cluster_name} ({cluster_arn})\n"
+            config += "# Don't edit manually. Regenerate with 'hyperpod ssh sync-config'.\n"
+            for entry in sorted_entries:
+                config += "\n" + entry["entry"]
+
+            write_file_atomically(self.get_config_filename(cluster_name), config)
+
+            write_file_atomically(self.get_snapshot_filename(cluster_name), json.dumps({
+                "cluster_arn" : cluster_arn,
+                "settings" : settings,
+                "nodes" : entries,
+            }))
+
+        return num_added, num_removed, num_unchanged
+
+
+def quote_remote_path(path):
+    # keep leading "~/" expandable by the remote shell
+    if path.startswith("~/"):
+        return '"$HOME"/' + shlex.quote(path[2:])
+    return shlex.quote(path)
+
+
+class NodeFileTransfer:
+
+    def __init__(self, max_workers=16):
+        self.max_workers = max_workers
+
+    @staticmethod
+    def get_local_checksum(filename):
+        h = hashlib.sha256()
+        with open(filename, "rb") as fd:
+            while True:
+                chunk = fd.read(1024 * 1024)
+                if not chunk:
+                    break
+                h.update(chunk)
+        return h.hexdigest()
+
+    @staticmethod
+    def get_remote_checksum(host_alias, ssh_options, remote_path):
+        cmd = ["ssh", *ssh_options, "-o", "BatchMode=yes", host_alias, f"sha256sum {quote_remote_path(remote_path)} 2>/dev/null"]
+        result = traced_subprocess_run(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        if result.returncode != 0:
+            return None
+        return result.stdout.decode("utf-8").split(" ")[0].strip()
+
+    def _run(self, cmd):
+        result = traced_subprocess_run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        return result.returncode==0, result.stderr.decode("utf-8").strip()
+
+    def push(self, targets, local_path, remote_path, fanout=0, peer_hostnames=None, force=False):
+
+        # targets : list of (host_alias, ssh_options)
+        # Returns list of result dicts, one per target
+
+        if remote_path.endswith("/"):
+            remote_path = remote_path + os.path.basename(local_path)
+
+        size = os.path.getsize(local_path)
+        results = { host_alias : {"host_alias" : host_alias, "status" : "", "bytes" : 0, "seconds" : 0.0, "message" : ""} for host_alias, ssh_options in targets }
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers) as thread_pool:
+
+            # skip nodes which already have identical file
+            if not force:
+                local_checksum = self.get_local_checksum(local_path)
+
+                def is_up_to_date(target):
+                    host_alias, ssh_options = target
+                    return self.get_remote_checksum(host_alias, ssh_options, remote_path)==local_checksum
+
+                pending_targets = []
+                for target, up_to_date in zip(targets, thread_pool.map(is_up_to_date, targets)):
+                    if up_to_date:
+                        results[target[0]]["status"] = "skipped"
+                    else:
+                        pending_targets.append(target)
+            else:
+                pending_targets = list(targets)
+
+            def push_from_local(target):
+                host_alias, ssh_options = target
+                t0 = time.time()
+                ok, message = self._run(["scp", "-q", "-p", *ssh_options, local_path, f"{host_alias}:{remote_path}"])
+                return target, ok, message, time.time() - t0
+
+            # without fan-out, all nodes are seeded from local
+            seed_targets = pending_targets
+            if fanout > 0:
+                seed_targets = pending_targets[:fanout]
+
+            sources = []
+            for target, ok, message, elapsed in thread_pool.map(push_from_local, seed_targets):
+                result = results[target[0]]
+                result["seconds"] = elapsed
+                if ok:
+                    result.update(status="copied", bytes=size)
+                    sources.append(target)
+                else:
+                    result.update(status="failed", message=message)
+
+            # nodes which have the file copy it to their peers over the cluster network,
+            # doubling the number of sources every round
+            peer_targets = pending_targets[len(seed_targets):]
+
+            # scp resolves relative paths on the peer from the home directory
+            peer_path = remote_path[2:] if remote_path.startswith("~/") else remote_path
+
+            def push_from_peer(source_and_target):
+                (source_alias, source_ssh_options), target = source_and_target
+                peer_hostname = peer_hostnames[target[0]]
+                remote_cmd = f"scp -q -p -o StrictHostKeyChecking=no -o BatchMode=yes {quote_remote_path(remote_path)} {shlex.quote(peer_hostname + ':' + peer_path)}"
+                t0 = time.time()
+                ok, message = self._run(["ssh", *source_ssh_options, "-o", "BatchMode=yes", source_alias, remote_cmd])
+                return target, source_alias, ok, message, time.time() - t0
+
+            while peer_targets:
+
+                if not sources:
+                    for host_alias, ssh_options in peer_targets:
+                        results[host_alias].update(status="failed", message="No source node available")
+                    break
+
+                round_targets = peer_targets[:len(sources)]
+                peer_targets = peer_targets[len(sources):]
+
+                new_sources = []
+                for target, source_alias, ok, message, elapsed in thread_pool.map(push_from_peer, zip(sources, round_targets)):
+                    result = results[target[0]]
+                    result["seconds"] = elapsed
+                    if ok:
+                        result.update(status=f"copied from {source_alias}", bytes=size)
+                        new_sources.append(target)
+                    else:
+                        result.update(status="failed", message=message)
+
+                sources += new_sources
+
+        return [ results[host_alias] for host_alias, ssh_options in targets ]
+
+    def pull(self, targets, remote_path, local_dirnames):
+
+        # local_dirnames : host_alias -> local directory to store files from the node
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers) as thread_pool:
+
+            def pull_single_node(target):
+
+                host_alias, ssh_options = target
+                local_dirname = local_dirnames[host_alias]
+                os.makedirs(local_dirname, exist_ok=True)
+
+                def get_total_size():
+                    total_size = 0
+                    for place, dirs, files in os.walk(local_dirname):
+                        for filename in files:
+                            total_size += os.path.getsize(os.path.join(place, filename))
+                    return total_size
+
+                size_before = get_total_size()
+
+                # remote path may contain wildcards, expanded by the remote shell
+                t0 = time.time()
+                ok, message = self._run(["scp", "-q", "-p", "-r", *ssh_options, f"{host_alias}:{remote_path}", local_dirname])
+                elapsed = time.time() - t0
+
+                return {
+                    "host_alias" : host_alias,
+                    "status" : "copied" if ok else "failed",
+                    "bytes" : max(get_total_size() - size_before, 0),
+                    "seconds" : elapsed,
+                    "message" : message,
+                }
+
+            return list(thread_pool.map(pull_single_node, targets))
+
+
+class ColumnarWriter:
+
+    # Writes records to Parquet or Arrow IPC files in row groups, so memory
+    # stays bounded by the row group size. pyarrow is imported on first use.
+
+    # columns : list of (column name, type, function to get value from record)
+    # type : "string", "int64" or "timestamp"
+
+    cluster_columns = [
+        ("region", "string", lambda cluster: cluster["ClusterArn"].split(":")[3]),
+        ("cluster_name", "string", lambda cluster: cluster["ClusterName"]),
+        ("cluster_arn", "string", lambda cluster: cluster["ClusterArn"]),
+        ("cluster_status", "string", lambda cluster: cluster["ClusterStatus"]),
+        ("creation_time", "timestamp", lambda cluster: cluster.get("CreationTime")),
+    ]
+
+    node_columns = [
+        ("cluster_name", "string", lambda node: node["ClusterName"]),
+        ("instance_group_name", "string", lambda node: node["InstanceGroupName"]),
+        ("instance_id", "string", lambda node: node["InstanceId"]),
+        ("instance_type", "string", lambda node: node.get("InstanceType")),
+        ("status", "string", lambda node: node["InstanceStatus"]["Status"]),
+        ("message", "string", lambda node: node["InstanceStatus"].get("Message")),
+        ("launch_time", "timestamp", lambda node: node.get("LaunchTime")),
+        ("last_software_update_time", "timestamp", lambda node: node.get("LastSoftwareUpdateTime")),
+    ]
+
+    event_columns = [
+        ("event_id", "string", lambda event: event["EventId"]),
+        ("cluster_arn", "string", lambda event: event["ClusterArn"]),
+        ("cluster_name", "string", lambda event: event["ClusterName"]),
+        ("instance_group_name", "string", lambda event: event.get("InstanceGroupName")),
+        ("instance_id", "string", lambda event: event.get("InstanceId")),
+        ("resource_type", "string", lambda event: event["ResourceType"]),
+        ("event_time", "timestamp", lambda event: event["EventTime"]),
+        ("description", "string", lambda event: event["Description"]),
+    ]
+
+    # with describe_cluster_event results, as JSON
+    event_details_columns = [
+        *event_columns,
+        ("details", "string", lambda event: json.dumps(event["Details"], default=str) if event.get("Details") is not None else None),
+    ]
+
+    def __init__(self, filename, file_format, columns, row_group_size=10000):
+
+        try:
+            import pyarrow
+        except ImportError:
+            raise ImportError("pyarrow is required for Parquet/Arrow output. Install it with 'pip install pyarrow'.")
+
+        self.pa = pyarrow
+        self.filename = os.path.expanduser(filename)
+        self.file_format = file_format
+        self.columns = columns
+        self.row_group_size = row_group_size
+
+        arrow_types = {
+            "string" : pyarrow.string(),
+            "int64" : pyarrow.int64(),
+            "timestamp" : pyarrow.timestamp("us", tz="UTC"),
+        }
+        self.schema = pyarrow.schema([ (name, arrow_types[type_name]) for name, type_name, getter in columns ])
+
+        if file_format=="parquet":
+            import pyarrow.parquet
+            self.writer = pyarrow.parquet.ParquetWriter(self.filename, self.schema)
+        elif file_format=="arrow":
+            import pyarrow.ipc
+            self.writer = pyarrow.ipc.new_file(self.filename, self.schema)
+        else:
+            raise ValueError(f"Unknown file format [{file_format}]")
+
+        self.buffer = [ [] for column in columns ]
+        self.num_buffered = 0
+        self.num_rows = 0
+
+    def write(self, records):
+
+        for record in records:
+            for values, (name, type_name, getter) in zip(self.buffer, self.columns):
+                values.append(getter(record))
+            self.num_buffered += 1
+
+            if self.num_buffered >= self.row_group_size:
+                self.flush()
+
+    def flush(self):
+
+        if not self.num_buffered:
+            return
+
+        batch = self.pa.RecordBatch.from_arrays(
+            [ self.pa.array(values, type=field.type) for values, field in zip(self.buffer, self.schema) ],
+            schema=self.schema
+        )
+        self.writer.write_batch(batch)
+
+        self.num_rows += self.num_buffered
+        self.buffer = [ [] for column in self.columns ]
+        self.num_buffered = 0
+
+    def close(self):
+        self.flush()
+        self.writer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -0,0 +1,386 @@
+import os
+import sys
+import io
+import time
+import datetime
+import json
+import shlex
+import argparse
+import cProfile
+import pstats
+
+import cmd2
+
+from .perf_misc import *
+
+
+def get_api_call_totals():
+
+    # aws_misc (and boto3) is imported only when a plugin using AWS is loaded, so no API calls were made before that
+    aws_misc = sys.modules.get(__package__ + ".aws_misc")
+    if aws_misc is None:
+        return 0, 0.0
+
+    api_call_stats = aws_misc.ApiCallStats.instance()
+    return api_call_stats.total_calls, api_call_stats.total_seconds
+
+
+class PerfCommands:
+
+    CATEGORY = "Performance commands"
+
+    record_metrics = True
+
+    def __init__(self, *args, **kwargs):
+
+        super().__init__(*args, **kwargs)
+
+        self.register_precmd_hook(self.on_perf_command_started)
+        self.register_postcmd_hook(self.on_perf_command_executed)
+
+        self.perf_command_start_time = None
+        self.perf_command_api_calls = 0
+        self.perf_output_bytes = 0
+
+        self.add_settable(
+            cmd2.Settable('record_metrics', bool, 'Record time, API calls and output size of each command in ~/.cshell/metrics.jsonl', PerfCommands)
+        )
+
+
+    # -----
+    # Hooks
+
+    def on_perf_command_started(self, data: cmd2.plugin.PrecommandData) -> cmd2.plugin.PrecommandData:
+
+        self.perf_command_start_time = time.perf_counter()
+        self.perf_command_api_calls = get_api_call_totals()[0]
+        self.perf_output_bytes = 0
+
+        return data
+
+    def on_perf_command_executed(self, data: cmd2.plugin.PostcommandData) -> cmd2.plugin.PostcommandData:
+
+        if self.perf_command_start_time is None:
+            return data
+
+        seconds = time.perf_counter() - self.perf_command_start_time
+
+        TraceRecorder.instance().add_span(data.statement.raw, "command", self.perf_command_start_time, seconds)
+
+        if PerfCommands.record_metrics:
+            MetricsLog.instance().append({
+                "time" : time.time(),
+                "command" : data.statement.command,
+                "subcommand" : self.get_subcommand_name(data.statement),
+                "seconds" : round(seconds, 4),
+                "api_calls" : get_api_call_totals()[0] - self.perf_command_api_calls,
+                "output_bytes" : self.perf_output_bytes,
+            })
+
+        self.perf_command_start_time = None
+
+        return data
+
+    def poutput(self, *objects, **kwargs):
+
+        # Count output size for metrics
+        self.perf_output_bytes += sum([ len(str(o)) for o in objects ]) + len(kwargs.get("end", "\n"))
+        super().poutput(*objects, **kwargs)
+
+    def get_subcommand_name(self, statement):
+
+        # First argument, only when it is a sub-command of the command's argparser
+        command_func = getattr(self, "do_" + statement.command, None)
+        if command_func is None or not statement.arg_list:
+            return ""
+
+        parser = self.command_parsers.get(command_func)
+        if parser is None:
+            return ""
+
+        for action in parser._actions:
+            if isinstance(action, argparse._SubParsersAction) and statement.arg_list[0] in action.choices:
+                return statement.arg_list[0]
+
+        return ""
+
+
+    # --------
+    # commands
+
+    argparser = cmd2.Cmd2ArgumentParser(description="Performance commands")
+    subparsers1 = argparser.add_subparsers(title="sub-commands")
+
+    @cmd2.with_category(CATEGORY)
+    @cmd2.with_argparser(argparser)
+    def do_perf(self, args):
+        func = getattr(args, "func", None)
+        if func is not None:
+            func(self, args)
+        else:
+            self.do_help("perf")
+
+
+    # ---
+
+    argparser = subparsers1.add_parser("report", help="Show command latency percentiles and daily trend from recorded metrics")
+    argparser.add_argument("--days", action="store", type=int, default=7, help="Number of days to include")
+    argparser.add_argument("--command", action="store", default=None, help="Show only commands starting with this (e.g. 'hyperpod describe')")
+    argparser.add_argument("--trend", action="store_true", default=False, help="Show daily p50 per command")
+
+    def _do_report(self, args):
+
+        metrics_log = MetricsLog.instance()
+        records = metrics_log.read(since=time.time() - args.days * 24 * 60 * 60)
+
+        if args.command:
+            records = [ record for record in records if MetricsLog.get_key(record).startswith(args.command) ]
+
+        if not records:
+            self.poutput(f"No metrics recorded in the last {args.days} days.")
+            return
+
+        summary = metrics_log.get_summary(records)
+        keys = sorted(summary.keys(), key=lambda key: summary[key]["p95"] * summary[key]["count"], reverse=True)
+
+        format_string = "{:<%d} : {:>6} : {:>8} : {:>8} : {:>8} : {:>8} : {:>9} : {:>10}" % max([ len(key) for key in keys + ["Command"] ])
+
+        self.poutput(format_string.format("Command", "Count", "p50 s", "p95 s", "p99 s", "Max s", "API calls", "Output KB"))
+        for key in keys:
+            stats = summary[key]
+            self.poutput(format_string.format(key, stats["count"], f"{stats['p50']:.3f}", f"{stats['p95']:.3f}", f"{stats['p99']:.3f}", f"{stats['max']:.3f}", f"{stats['api_calls']:.1f}", f"{stats['output_bytes']/1024:.1f}"))
+
+        if args.trend:
+
+            trend = metrics_log.get_daily_trend(records)
+            days = sorted(set([ day for seconds_by_day in trend.values() for day in seconds_by_day.keys() ]))
+
+            self.poutput("")
+            self.poutput("Daily p50 seconds")
+
+            format_string = "{:<%d}" % max([ len(key) for key in keys + ["Command"] ]) + " : {:>10}" * len(days)
+
+            self.poutput(format_string.format("Command", *days))
+            for key in keys:
+                self.poutput(format_string.format(key, *[ f"{trend[key][day]:.3f}" if day in trend[key] else "-" for day in days ]))
+
+    argparser.set_defaults(func=_do_report)
+
+
+    # ---
+
+    argparser = subparsers1.add_parser("trace", help="Record spans of commands, API calls, pages, SSM sessions and subprocesses as a Chrome trace")
+    subparsers2 = argparser.add_subparsers(title="sub-commands")
+
+    argparser = subparsers2.add_parser("start", help="Start recording spans")
+
+    def _do_trace_start(self, args):
+        TraceRecorder.instance().start()
+        self.poutput("Started recording trace. Run commands, then 'perf trace stop' to write the trace file.")
+
+    argparser.set_defaults(func=_do_trace_start)
+
+    argparser = subparsers2.add_parser("stop", help="Stop recording and write the trace file")
+    argparser.add_argument("--output-file", action="store", default=None, completer=cmd2.Cmd.path_complete, help="Trace file path (default: ~/.cshell/traces/trace_YYYYMMDD_HHMMSS.json)")
+
+    def _do_trace_stop(self, args):
+
+        trace_recorder = TraceRecorder.instance()
+        if not trace_recorder.enabled:
+            self.poutput("Trace is not being recorded.")
+            return
+
+        filename = args.output_file
+        if filename is None:
+            filename = datetime.datetime.now().strftime("~/.cshell/traces/trace_%Y%m%d_%H%M%S.json")
+        filename = os.path.expanduser(filename)
+
+        num_dropped = trace_recorder.num_dropped
+        num_events = trace_recorder.stop(filename)
+
+        self.poutput(f"Wrote {num_events} trace events to {filename}")
+        if num_dropped:
+            self.poutput(f"Dropped {num_dropped} events after reaching {TraceRecorder.max_events} events")
+        self.poutput("Open it in https://ui.perfetto.dev or chrome://tracing")
+
+    argparser.set_defaults(func=_do_trace_stop)
+
+
+    # ---
+
+    argparser = subparsers1.add_parser("startup-report", help="Show time of startup phases and imports of this shell, compared with the baseline")
+    argparser.add_argument("--limit", action="store", type=int, default=20, help="Number of packages and modules to show")
+    argparser.add_argument("--save-baseline", action="store_true", default=False, help="Save this startup as the baseline (~/.cshell/startup_baseline.json)")
+    argparser.add_argument("--output-file", action="store", default=None, completer=cmd2.Cmd.path_complete, help="Also write the report as JSON")
+
+    def _do_startup_report(self, args):
+
+        startup_profiler = StartupProfiler.instance()
+        report = startup_profiler.get_report()
+        baseline = startup_profiler.load_baseline()
+
+        def format_diff(seconds, baseline_seconds):
+            if baseline_seconds is None:
+                return "-", "-"
+            return f"{baseline_seconds:.3f}", f"{seconds - baseline_seconds:+.3f}"
+
+        baseline_phases = baseline["phases"] if baseline else {}
+        baseline_total = baseline["total"] if baseline else None
+
+        format_string = "{:<20} : {:>8} : {:>8} : {:>8}"
+
+        self.poutput(format_string.format("Phase", "Seconds", "Baseline", "Diff"))
+        for name, seconds in report["phases"].items():
+            self.poutput(format_string.format(name, f"{seconds:.3f}", *format_diff(seconds, baseline_phases.get(name))))
+        self.poutput(format_string.format("total", f"{report['total']:.3f}", *format_diff(report["total"], baseline_total)))
+
+        if report["imports"]:
+
+            packages = StartupProfiler.get_package_times(report["imports"])
+            baseline_packages = StartupProfiler.get_package_times(baseline["imports"]) if baseline and baseline["imports"] else {}
+
+            format_string = "{:<30} : {:>7} : {:>8} : {:>8} : {:>8}"
+
+            self.poutput("")
+            self.poutput(format_string.format("Package", "Modules", "Self s", "Baseline", "Diff"))
+            for name in sorted(packages.keys(), key=lambda name: packages[name]["self"], reverse=True)[:args.limit]:
+                seconds = packages[name]["self"]
+                baseline_seconds = baseline_packages[name]["self"] if name in baseline_packages else (0.0 if baseline_packages else None)
+                self.poutput(format_string.format(name, packages[name]["modules"], f"{seconds:.3f}", *format_diff(seconds, baseline_seconds)))
+
+            # packages which are no longer imported
+            for name in sorted(set(baseline_packages.keys()) - set(packages.keys()), key=lambda name: baseline_packages[name]["self"], reverse=True)[:args.limit]:
+                self.poutput(format_string.format(name, 0, f"{0:.3f}", *format_diff(0.0, baseline_packages[name]["self"])))
+
+            imports = report["imports"]
+            format_string = "{:<50} : {:>8} : {:>12}"
+
+            self.poutput("")
+            self.poutput(format_string.format("Module", "Self s", "Cumulative s"))
+            for name in sorted(imports.keys(), key=lambda name: imports[name]["self"], reverse=True)[:args.limit]:
+                self.poutput(format_string.format(name, f"{imports[name]['self']:.3f}", f"{imports[name]['cumulative']:.3f}"))
+
+        else:
+            self.poutput("")
+            self.poutput("Start the shell with --profile-startup to record import times.")
+
+        if args.save_baseline:
+            startup_profiler.save_baseline(report)
+            self.poutput("")
+            self.poutput(f"Saved the baseline to {startup_profiler.baseline_filename}")
+
+        if args.output_file:
+            filename = os.path.expanduser(args.output_file)
+            with open(filename, "w") as f:
+                json.dump(report, f, indent=2)
+            self.poutput("")
+            self.poutput(f"Wrote the report to {filename}")
+
+    argparser.set_defaults(func=_do_startup_report)
+
+
+    # ---
+
+    argparser = cmd2.Cmd2ArgumentParser(description="Run a command under a profiler and show where its time goes")
+    argparser.add_argument("--sampling", action="store_true", default=False, help="Use a sampling profiler covering all threads, instead of cProfile on the main thread")
+    argparser.add_argument("--interval", action="store", type=float, default=5, help="Sampling interval in milliseconds")
+    argparser.add_argument("--sort", action="store", choices=["cumulative", "tottime", "ncalls"], default="cumulative", help="Sort order of cProfile output")
+    argparser.add_argument("--limit", action="store", type=int, default=25, help="Number of functions to show")
+    argparser.add_argument("--save", action="store", default=None, completer=cmd2.Cmd.path_complete, help="Save cProfile stats to a .prof file (for snakeviz, pstats)")
+    argparser.add_argument("--collapsed", action="store", default=None, completer=cmd2.Cmd.path_complete, help="Save sampled stacks in collapsed format (for flamegraph.pl, speedscope). Implies --sampling")
+    argparser.add_argument("--complete", action="store_true", default=False, help="Profile tab completion of the last word of the command line, instead of running it")
+    argparser.add_argument("command_line", metavar="COMMAND_LINE", nargs=argparse.REMAINDER, help="Command line to profile")
+
+    @cmd2.with_category(CATEGORY)
+    @cmd2.with_argparser(argparser)
+    def do_profile(self, args):
+
+        if not args.command_line:
+            self.poutput("Command line is not specified.")
+            return
+
+        # an empty last word completes a new argument, e.g. profile --complete hyperpod ssm CLUSTER ""
+        if args.complete and args.command_line[-1] == "":
+            line = shlex.join(args.command_line[:-1]) + " "
+        else:
+            line = shlex.join(args.command_line)
+
+        def run():
+            if args.complete:
+                # complete the last word, as the Tab key would
+                text = line.split(" ")[-1]
+                completions = self.complete(text, line, len(line) - len(text), len(line))
+                if completions.error:
+                    return f"{len(completions.to_strings())} completions, error : {completions.error.strip().splitlines()[0]}"
+                return f"{len(completions.to_strings())} completions"
+            self.onecmd(line, add_to_history=False)
+            return None
+
+        sampling = args.sampling or args.collapsed
+
+        api_calls, api_seconds = get_api_call_totals()
+
+        wall_time = time.monotonic()
+        cpu_time = time.process_time()
+
+        if sampling:
+            profiler = SamplingProfiler(interval=args.interval / 1000)
+            profiler.start()
+            try:
+                result = run()
+            finally:
+                profiler.stop()
+        else:
+            profiler = cProfile.Profile()
+            profiler.enable()
+            try:
+                result = run()
+            finally:
+                profiler.disable()
+
+        wall_time = time.monotonic() - wall_time
+        cpu_time = time.process_time() - cpu_time
+        api_calls_end, api_seconds_end = get_api_call_totals()
+        api_calls = api_calls_end - api_calls
+        api_seconds = api_seconds_end - api_seconds
+
+        self.poutput("")
+        self.poutput(f"Profiled : {line}" + (f" (completion, {result})" if result else ""))
+        self.poutput(f"Wall time : {wall_time:.3f}s, Python CPU time (all threads) : {cpu_time:.3f}s, waiting : {max(0.0, wall_time - cpu_time):.3f}s")
+        self.poutput(f"AWS API : {api_calls} calls, {api_seconds:.3f}s total (overlapping when called from threads)")
+        self.poutput("")
+
+        if sampling:
+
+            self.poutput(f"Samples : {profiler.num_samples} at {args.interval}ms")
+            for thread_name, counts in sorted(profiler.get_state_counts().items(), key=lambda item: sum(item[1].values()), reverse=True):
+                self.poutput(f"    {thread_name} : running {counts['cpu']}, waiting {counts['wait']}")
+            self.poutput("")
+
+            function_counts = profiler.get_function_counts()
+            functions = sorted(function_counts.keys(), key=lambda function: function_counts[function]["cpu"] + function_counts[function]["wait"], reverse=True)[:args.limit]
+
+            format_string = "{:>8} : {:>8} : {:>8} : {}"
+            self.poutput(format_string.format("Running", "Waiting", "Self", "Function"))
+            for function in functions:
+                counts = function_counts[function]
+                self.poutput(format_string.format(counts["cpu"], counts["wait"], counts["self"], function))
+
+            if args.collapsed:
+                filename = os.path.expanduser(args.collapsed)
+                profiler.write_collapsed(filename)
+                self.poutput("")
+                self.poutput(f"Saved collapsed stacks to {filename}")
+
+        else:
+
+            stream = io.StringIO()
+            stats = pstats.Stats(profiler, stream=stream)
+            stats.strip_dirs().sort_stats(args.sort).print_stats(args.limit)
+            self.poutput(stream.getvalue().strip("\n"))
+
+            if args.save:
+                filename = os.path.expanduser(args.save)
+                profiler.dump_stats(filename)
+                self.poutput("")
+                self.poutput(f"Saved cProfile stats to {filename}")
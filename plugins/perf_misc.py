@@ -0,0 +1,475 @@
+import os
+import sys
+import time
+import datetime
+import json
+import builtins
+import importlib
+import importlib.util
+import itertools
+import threading
+import subprocess
+import contextlib
+
+
+def get_percentile(sorted_values, percent):
+
+    # nearest-rank percentile of a sorted list
+    if not sorted_values:
+        return 0
+    index = max(0, min(len(sorted_values) - 1, int(len(sorted_values) * percent / 100.0 + 0.5) - 1))
+    return sorted_values[index]
+
+
+class MetricsLog:
+
+    # Append-only log of per-command metrics, one JSON object per line
+
+    _instance = None
+
+    @staticmethod
+    def instance():
+        if MetricsLog._instance is None:
+            MetricsLog._instance = MetricsLog()
+        return MetricsLog._instance
+
+    def __init__(self, filename=None):
+
+        if filename is None:
+            filename = os.path.expanduser("~/.cshell/metrics.jsonl")
+
+        self.filename = filename
+        self.lock = threading.Lock()
+
+    def append(self, record):
+
+        os.makedirs(os.path.dirname(self.filename), exist_ok=True)
+
+        line = json.dumps(record) + "\n"
+        with self.lock:
+            with open(self.filename, "a") as f:
+                f.write(line)
+
+    def read(self, since=None):
+
+        # since : epoch seconds
+        records = []
+
+        try:
+            f = open(self.filename)
+        except FileNotFoundError:
+            return records
+
+        with f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # partially written line
+                    continue
+                if since is not None and record["time"] < since:
+                    continue
+                records.append(record)
+
+        return records
+
+    @staticmethod
+    def get_key(record):
+        if record["subcommand"]:
+            return f"{record['command']} {record['subcommand']}"
+        return record["command"]
+
+    def get_summary(self, records):
+
+        # command key -> { count, p50, p95, p99, max, api_calls, output_bytes }
+
+        records_by_key = {}
+        for record in records:
+            records_by_key.setdefault(self.get_key(record), []).append(record)
+
+        summary = {}
+        for key, key_records in records_by_key.items():
+            seconds = sorted([ record["seconds"] for record in key_records ])
+            summary[key] = {
+                "count" : len(key_records),
+                "p50" : get_percentile(seconds, 50),
+                "p95" : get_percentile(seconds, 95),
+                "p99" : get_percentile(seconds, 99),
+                "max" : seconds[-1],
+                "api_calls" : sum([ record["api_calls"] for record in key_records ]) / len(key_records),
+                "output_bytes" : sum([ record["output_bytes"] for record in key_records ]) / len(key_records),
+            }
+
+        return summary
+
+    def get_daily_trend(self, records):
+
+        # command key -> { date string -> p50 seconds }
+
+        seconds_by_key_and_day = {}
+        for record in records:
+            day = datetime.datetime.fromtimestamp(record["time"]).strftime("%Y/%m/%d")
+            seconds_by_key_and_day.setdefault(self.get_key(record), {}).setdefault(day, []).append(record["seconds"])
+
+        trend = {}
+        for key, seconds_by_day in seconds_by_key_and_day.items():
+            trend[key] = { day : get_percentile(sorted(seconds), 50) for day, seconds in seconds_by_day.items() }
+
+        return trend
+
+
+class TraceRecorder:
+
+    # Records spans (command, API call, page, SSM session, subprocess) with thread IDs,
+    # and writes them in Chrome trace format, for chrome://tracing and Perfetto.
+    # Recording is off until start() is called, and spans cost nothing while off.
+
+    _instance = None
+
+    @staticmethod
+    def instance():
+        if TraceRecorder._instance is None:
+            TraceRecorder._instance = TraceRecorder()
+        return TraceRecorder._instance
+
+    max_events = 1000000
+
+    def __init__(self):
+        self.enabled = False
+        self.lock = threading.Lock()
+        self.events = []
+        self.thread_ids = set()
+        self.num_dropped = 0
+
+    def start(self):
+        with self.lock:
+            self.events = []
+            self.thread_ids = set()
+            self.num_dropped = 0
+            self.enabled = True
+
+    def stop(self, filename):
+
+        # Returns number of events written
+
+        with self.lock:
+            self.enabled = False
+            events = self.events
+            self.events = []
+
+        os.makedirs(os.path.dirname(os.path.abspath(filename)), exist_ok=True)
+        with open(filename, "w") as f:
+            json.dump({ "traceEvents" : events, "displayTimeUnit" : "ms" }, f)
+
+        return len(events)
+
+    def add_span(self, name, category, start_time, duration, args=None):
+
+        # start_time and duration : seconds from time.perf_counter()
+
+        if not self.enabled:
+            return
+
+        pid = os.getpid()
+        tid = threading.get_ident()
+
+        event = {
+            "name" : name,
+            "cat" : category,
+            "ph" : "X",
+            "ts" : start_time * 1000000,
+            "dur" : duration * 1000000,
+            "pid" : pid,
+            "tid" : tid,
+        }
+        if args:
+            event["args"] = args
+
+        with self.lock:
+            if len(self.events) >= self.max_events:
+                self.num_dropped += 1
+                return
+
+            if tid not in self.thread_ids:
+                self.thread_ids.add(tid)
+                self.events.append({ "name" : "thread_name", "ph" : "M", "pid" : pid, "tid" : tid, "args" : { "name" : threading.current_thread().name } })
+
+            self.events.append(event)
+
+    @contextlib.contextmanager
+    def span(self, name, category, args=None):
+
+        if not self.enabled:
+            yield
+            return
+
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_span(name, category, start_time, time.perf_counter() - start_time, args)
+
+
+def traced_subprocess_run(cmd, **kwargs):
+
+    # subprocess.run, recorded as a span while tracing
+    with TraceRecorder.instance().span(os.path.basename(cmd[0]), "subprocess", { "cmd" : " ".join(cmd) }):
+        return subprocess.run(cmd, **kwargs)
+
+
+class SamplingProfiler:
+
+    # Samples stacks of all threads at a fixed interval, with low overhead and without
+    # the main-thread-only limitation of cProfile. A sample whose innermost Python frame
+    # is a known blocking call (socket, ssl, select, lock/thread wait, subprocess) is
+    # counted as waiting, other samples as running Python code.
+
+    wait_frames = [
+        ("ssl.py", "read"),
+        ("ssl.py", "recv_into"),
+        ("ssl.py", "do_handshake"),
+        ("socket.py", "readinto"),
+        ("socket.py", "create_connection"),
+        ("selectors.py", "select"),
+        ("threading.py", "wait"),
+        ("threading.py", "_wait_for_tstate_lock"),
+        ("queue.py", "get"),
+        ("thread.py", "_worker"),
+        ("subprocess.py", "_try_wait"),
+        ("subprocess.py", "_communicate"),
+        ("pty_spawn.py", "read_nonblocking"),
+    ]
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.stacks = {}
+        self.num_samples = 0
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, name="SamplingProfiler", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        self.thread.join()
+
+    def _run(self):
+
+        thread_names = {}
+
+        while not self.stop_event.wait(self.interval):
+
+            for thread in threading.enumerate():
+                thread_names[thread.ident] = thread.name
+
+            for thread_id, frame in sys._current_frames().items():
+
+                if thread_id == self.thread.ident:
+                    continue
+
+                leaf = (os.path.basename(frame.f_code.co_filename), frame.f_code.co_name)
+                state = "wait" if leaf in self.wait_frames else "cpu"
+
+                stack = []
+                while frame is not None:
+                    stack.append(f"{frame.f_code.co_name} ({os.path.basename(frame.f_code.co_filename)}:{frame.f_code.co_firstlineno})")
+                    frame = frame.f_back
+                stack.append(thread_names.get(thread_id, str(thread_id)))
+                stack.reverse()
+
+                key = (tuple(stack), state)
+                self.stacks[key] = self.stacks.get(key, 0) + 1
+
+            self.num_samples += 1
+
+    def get_state_counts(self):
+
+        # thread name -> { "cpu" : samples, "wait" : samples }
+        counts = {}
+        for (stack, state), count in self.stacks.items():
+            thread_counts = counts.setdefault(stack[0], { "cpu" : 0, "wait" : 0 })
+            thread_counts[state] += count
+        return counts
+
+    def get_function_counts(self):
+
+        # function -> { "cpu", "wait", "self" } samples, counting each function once per stack
+        counts = {}
+        for (stack, state), count in self.stacks.items():
+            for function in set(stack[1:]):
+                function_counts = counts.setdefault(function, { "cpu" : 0, "wait" : 0, "self" : 0 })
+                function_counts[state] += count
+            if len(stack) > 1:
+                counts[stack[-1]]["self"] += count
+        return counts
+
+    def write_collapsed(self, filename):
+
+        # One line per stack, "frame;frame;frame count", as read by flamegraph.pl and speedscope
+        with open(filename, "w") as f:
+            for (stack, state), count in sorted(self.stacks.items()):
+                f.write(";".join(stack) + f";[{state}] {count}\n")
+
+
+
+class StartupProfiler:
+
+    # Time of startup phases (config reload, plugin registration, history load, startup
+    # script), and optionally of each module import. Import timing wraps __import__ and
+    # importlib.import_module, so it has to be enabled before the modules of interest are
+    # imported. Imports through other importlib functions, or through an import_module
+    # bound before enabling, are not timed on their own and count toward the importer.
+
+    _instance = None
+
+    @staticmethod
+    def instance():
+        if StartupProfiler._instance is None:
+            StartupProfiler._instance = StartupProfiler()
+        return StartupProfiler._instance
+
+    def __init__(self, baseline_filename=None):
+
+        if baseline_filename is None:
+            baseline_filename = os.path.expanduser("~/.cshell/startup_baseline.json")
+
+        self.baseline_filename = baseline_filename
+        self.start_time = time.perf_counter()
+        self.end_time = None
+        self.phases = {}
+        self.imports = {}
+        self.import_stack = []
+        self.import_thread_id = None
+        self.original_import = None
+        self.original_import_module = None
+
+    def enable_import_timing(self):
+
+        if self.original_import is not None:
+            return
+
+        self.import_thread_id = threading.get_ident()
+        self.original_import = builtins.__import__
+        builtins.__import__ = self.timed_import
+        self.original_import_module = importlib.import_module
+        importlib.import_module = self.timed_import_module
+
+    def disable_import_timing(self):
+
+        if self.original_import is None:
+            return
+
+        builtins.__import__ = self.original_import
+        importlib.import_module = self.original_import_module
+        self.original_import = None
+        self.original_import_module = None
+
+    @staticmethod
+    def get_absolute_name(name, globals, level):
+
+        if level == 0 or not globals:
+            return name
+
+        package = globals.get("__package__") or ""
+        if level > 1:
+            package = package.rsplit(".", level - 1)[0]
+        return package + "." + name if name else package
+
+    def timed_import(self, name, globals=None, locals=None, fromlist=(), level=0):
+
+        if threading.get_ident() != self.import_thread_id:
+            return self.original_import(name, globals, locals, fromlist, level)
+
+        return self.time_import(self.get_absolute_name(name, globals, level), self.original_import, name, globals, locals, fromlist, level)
+
+    def timed_import_module(self, name, package=None):
+
+        if threading.get_ident() != self.import_thread_id:
+            return self.original_import_module(name, package)
+
+        return self.time_import(importlib.util.resolve_name(name, package), self.original_import_module, name, package)
+
+    def time_import(self, absolute_name, func, *args):
+
+        num_modules = len(sys.modules)
+
+        # each frame collects the time of nested imports, which is subtracted from its
+        # self time, and the modules they loaded, which aren't attributed to it
+        self.import_stack.append([0.0, set()])
+        t0 = time.perf_counter()
+        try:
+            return func(*args)
+        finally:
+            seconds = time.perf_counter() - t0
+            nested_seconds, nested_modules = self.import_stack.pop()
+
+            # modules are added to the end of sys.modules as they start loading
+            new_modules = list(itertools.islice(sys.modules, num_modules, None)) if len(sys.modules) > num_modules else []
+            if self.import_stack:
+                self.import_stack[-1][0] += seconds
+                self.import_stack[-1][1].update(new_modules)
+
+            # Only imports which loaded modules are recorded, under the requested module if
+            # it's one of them, or else the first of them, e.g. 'package.x' of 'from . import x'.
+            # A module is loaded by one frame only, so re-entrant imports of the same module
+            # don't count toward its cumulative time again.
+            own_modules = [ module for module in new_modules if module not in nested_modules ]
+            if own_modules:
+                key = absolute_name if absolute_name in own_modules else own_modules[0]
+                times = self.imports.setdefault(key, [0.0, 0.0])
+                times[0] += seconds - nested_seconds
+                times[1] += seconds
+
+    def add_phase(self, name, seconds):
+        self.phases[name] = self.phases.get(name, 0.0) + seconds
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_phase(name, time.perf_counter() - t0)
+
+    def end(self):
+
+        # called when the first prompt is about to show
+        if self.end_time is None:
+            self.end_time = time.perf_counter()
+            self.disable_import_timing()
+
+    def get_report(self):
+
+        end_time = self.end_time if self.end_time is not None else time.perf_counter()
+
+        return {
+            "time" : time.time(),
+            "total" : end_time - self.start_time,
+            "phases" : dict(self.phases),
+            "imports" : { name : { "self" : times[0], "cumulative" : times[1] } for name, times in self.imports.items() },
+        }
+
+    @staticmethod
+    def get_package_times(imports):
+
+        # top-level package -> { "self" : seconds, "modules" : count }
+        packages = {}
+        for name, times in imports.items():
+            package = packages.setdefault(name.split(".")[0], { "self" : 0.0, "modules" : 0 })
+            package["self"] += times["self"]
+            package["modules"] += 1
+        return packages
+
+    def load_baseline(self):
+        try:
+            with open(self.baseline_filename) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def save_baseline(self, report):
+        os.makedirs(os.path.dirname(self.baseline_filename), exist_ok=True)
+        with open(self.baseline_filename, "w") as f:
+            json.dump(report, f, indent=2)